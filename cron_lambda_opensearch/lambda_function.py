@@ -4,7 +4,8 @@ import json
 from opensearchpy import OpenSearch, RequestsHttpConnection
 import os
 from dotenv import load_dotenv
-from utils.parse_to_document_objects import parse_to_document_objects
+from utils.parse_to_document_objects import iter_document_objects
+from utils.dynamodb_scan import ParallelScan
 from utils.general_utils import sanitize_metadata
 from utils.opensearch import update_documents
 
@@ -23,25 +24,12 @@ def lambda_handler(event, context):
             )
         }
     
-    table = dynamodb.Table(table_name)
-
     try:
 
-        all_items = []
-        last_evaluated_key = None
-
-        while True:
-            scan_params = {}
-            if last_evaluated_key:
-                scan_params['ExclusiveStartKey'] = last_evaluated_key
-
-            response = table.scan(**scan_params)
-            all_items.extend(response['Items'])
-            last_evaluated_key = response.get('LastEvaluatedKey')
-            if not last_evaluated_key:
-                break
-        
-        documents = parse_to_document_objects(all_items)
+        # The segments are scanned in parallel and the items are parsed as they arrive, only the
+        # changed documents are kept in memory
+        scan = ParallelScan(table_name)
+        documents = iter_document_objects(scan, scan.key_names)
         response = update_documents(documents)
         if response == None:
             return {
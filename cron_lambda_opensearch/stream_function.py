@@ -0,0 +1,35 @@
+import json
+import os
+from dotenv import load_dotenv
+from utils.stream_records import documents_for_records
+from utils.opensearch import upsert_changes
+
+load_dotenv()
+
+def lambda_handler(event, context):
+    records = event.get('Records', [])
+    if not records:
+        return {
+            'statusCode': 200,
+            'body': json.dumps(
+                {
+                    'message': 'No records to index'
+                }
+            )
+        }
+    # The table of the stream, arn:aws:dynamodb:<region>:<account>:table/<table>/stream/<label>
+    table_name = os.environ.get('SnippetsTable') or os.getenv('TABLE_NAME') or records[0]['eventSourceARN'].split('/')[1]
+
+    # Errors are not caught, the invocation fails and Lambda retries the batch (upserts and deletes are
+    # idempotent), until the records expire or the retry limit of the event source mapping is reached
+    metadata_ids_to_delete, documents = documents_for_records(records, table_name)
+    summary = upsert_changes(documents, metadata_ids_to_delete)
+    return {
+        'statusCode': 200,
+        'body': json.dumps(
+            {
+                'message': f'Applied {len(records)} stream records, {len(documents)} documents indexed and {len(metadata_ids_to_delete)} ids replaced or deleted',
+                'summary': summary
+            }, default=str
+        )
+    }
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from opensearchpy.exceptions import ConnectionError, ConnectionTimeout, TransportError
+
+# Bulk requests are flushed at whichever limit is reached first, well below the request size limits
+BULK_MAX_BYTES = int(os.environ.get('BULK_MAX_BYTES', str(5 * 1024 * 1024)))
+BULK_MAX_DOCUMENTS = int(os.environ.get('BULK_MAX_DOCUMENTS', '500'))
+# Requests in flight while the next batch is being filled, this bounds the memory held by the writer
+BULK_MAX_IN_FLIGHT = int(os.environ.get('BULK_MAX_IN_FLIGHT', '2'))
+BULK_MAX_ATTEMPTS = int(os.environ.get('BULK_MAX_ATTEMPTS', '4'))
+BULK_BACKOFF_SECONDS = float(os.environ.get('BULK_BACKOFF_SECONDS', '1'))
+# true writes the documents under an _id derived from their metadata.key (the table key of the snippet,
+# the metadata.id of the program and course documents), so concurrent writers of the same document
+# overwrite each other instead of adding copies. Off by default, the documents get generated ids.
+BULK_DOCUMENT_IDS = os.environ.get('BULK_DOCUMENT_IDS', 'false').lower() == 'true'
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+def document_id(key):
+    """
+
+    The _id of a document, a hash of its metadata.key so it stays within the _id size limit. The
+    metadata.id is derived from the title and is shared by snippets with the same title, it is not used.
+
+    Args:
+        key (str): The metadata.key of the document
+
+    Returns:
+        str: The _id, None if the document has no metadata.key
+    """
+    if not key:
+        return None
+    return hashlib.sha256(str(key).encode('utf-8')).hexdigest()
+
+def _retryable(error):
+    # A timed out request may have been applied, retrying it could index its documents twice
+    if isinstance(error, ConnectionTimeout):
+        return False
+    if isinstance(error, ConnectionError):
+        return True
+    return isinstance(error, TransportError) and error.status_code in RETRYABLE_STATUSES
+
+class BulkWriter:
+    def __init__(
+            self,
+            client,
+            index,
+            max_bytes=BULK_MAX_BYTES,
+            max_documents=BULK_MAX_DOCUMENTS,
+            max_in_flight=BULK_MAX_IN_FLIGHT,
+            max_attempts=BULK_MAX_ATTEMPTS
+            ):
+        """
+
+        Streaming bulk writer: documents are added one at a time and sent in batches bounded by size and
+        count, in background threads so the batches are written while the next embeddings are computed.
+        Only the items that failed with a retryable status are sent again, with jittered backoff.
+
+        Args:
+            client (OpenSearch): The OpenSearch client
+            index (str): The index to write to
+            max_bytes (int): Maximum size of a bulk request body
+            max_documents (int): Maximum documents per bulk request
+            max_in_flight (int): Maximum bulk requests sent concurrently
+            max_attempts (int): Attempts per document before it is counted as failed
+        """
+        self.client = client
+        self.index = index
+        self.max_bytes = max_bytes
+        self.max_documents = max_documents
+        self.max_attempts = max_attempts
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.futures = []
+        self.batch = []
+        self.batch_bytes = 0
+        self.counters = {'indexed': 0, 'replaced': 0, 'retried': 0, 'failed': 0, 'requests': 0, 'bytes': 0}
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def add(self, document, key=None):
+        """
+
+        Queue a document, sending the current batch first if the document does not fit in it.
+
+        Args:
+            document (dict): The document source
+            key (str): The metadata.key of the document, its _id is derived from it
+        """
+        action = {"_index": self.index}
+        doc_id = document_id(key) if BULK_DOCUMENT_IDS else None
+        if doc_id is not None:
+            action["_id"] = doc_id
+        action = json.dumps({"index": action})
+        source = json.dumps(document)
+        size = len(action) + len(source) + 2
+        if self.batch and (self.batch_bytes + size > self.max_bytes or len(self.batch) >= self.max_documents):
+            self.flush()
+        self.batch.append((action, source))
+        self.batch_bytes += size
+
+    def flush(self):
+        if not self.batch:
+            return
+        batch, self.batch, self.batch_bytes = self.batch, [], 0
+        # Blocks while max_in_flight requests are pending, so batches do not pile up in memory
+        self.slots.acquire()
+        future = self.executor.submit(self._write, batch)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def _count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def _fail(self, count, error):
+        with self.lock:
+            self.counters['failed'] += count
+            if len(self.errors) < 5:
+                self.errors.append(error)
+
+    def _write(self, batch):
+        for attempt in range(self.max_attempts):
+            body = "".join(f"{action}\n{source}\n" for action, source in batch)
+            self._count('requests')
+            self._count('bytes', len(body))
+            try:
+                response = self.client.bulk(body=body)
+            except Exception as e:
+                if not _retryable(e) or attempt == self.max_attempts - 1:
+                    self._fail(len(batch), str(e))
+                    return
+                retry = batch
+            else:
+                retry = []
+                for item, entry in zip(response['items'], batch):
+                    result = next(iter(item.values()))
+                    status = result.get('status', 500)
+                    if status < 300:
+                        self._count('indexed')
+                        # An existing _id was overwritten, the index holds one document for both
+                        if result.get('result') == 'updated':
+                            self._count('replaced')
+                    elif status in RETRYABLE_STATUSES and attempt < self.max_attempts - 1:
+                        retry.append(entry)
+                    else:
+                        self._fail(1, result.get('error', status))
+                if not retry:
+                    return
+            self._count('retried', len(retry))
+            batch = retry
+            time.sleep(random.uniform(0, BULK_BACKOFF_SECONDS * 2 ** attempt))
+
+    def close(self):
+        """
+
+        Send the last batch and wait for all the requests.
+
+        Returns:
+            dict: The numbers of indexed (replaced ones included), replaced, retried and failed documents, requests and bytes sent, and the first errors
+        """
+        self.flush()
+        for future in self.futures:
+            future.result()
+        self.executor.shutdown()
+        summary = dict(self.counters)
+        summary['errors'] = self.errors
+        print(f"Bulk indexing summary for {self.index}: {summary}")
+        return summary
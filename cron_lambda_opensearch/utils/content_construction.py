@@ -171,6 +171,7 @@ def create_content_for_specific_course(programs: dict, language: str) -> list[Do
                 metadata={
                     "program": program_name,
                     "id": f"all_programs_{program_name}_en",
+                    "key": f"all_programs_{program_name}_en",
                     "last_modified": last_modified,
                     "language": "en"
                 }
@@ -181,6 +182,7 @@ def create_content_for_specific_course(programs: dict, language: str) -> list[Do
                 metadata={
                     "program": program_name,
                     "id": f"all_programs_{program_name}_fr",
+                    "key": f"all_programs_{program_name}_fr",
                     "last_modified": last_modified,
                     "language": "fr"
                 }
@@ -194,7 +196,7 @@ def create_overall_snippet_courses_en(courses: dict) -> Document:
     for k, v in courses.items():   
         if k != 'modified':
             content += f"\nCourse: {k}\n Number of snippets: {v}\n"
-    return Document(page_content=content, metadata={"id": "all_courses_en", "language": "en", "last_modified": courses['modified']})
+    return Document(page_content=content, metadata={"id": "all_courses_en", "key": "all_courses_en", "language": "en", "last_modified": courses['modified']})
 
 def create_overall_snippet_courses_fr(courses: dict) -> Document:
     content = "Information for all courses: "
@@ -202,4 +204,4 @@ def create_overall_snippet_courses_fr(courses: dict) -> Document:
     for k, v in courses.items():   
         if k != 'modified':
             content += f"\nCourse: {k}\n Number of snippets: {v}\n"
-    return Document(page_content=content, metadata={"id": "all_courses_fr", "language": "fr", "last_modified": courses['modified']})
+    return Document(page_content=content, metadata={"id": "all_courses_fr", "key": "all_courses_fr", "language": "fr", "last_modified": courses['modified']})
@@ -0,0 +1,200 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+EMBEDDING_CONCURRENCY = int(os.environ.get('EMBEDDING_CONCURRENCY', '8'))
+# Requests per second, the rate starts at EMBEDDING_RATE and adapts between EMBEDDING_MIN_RATE and EMBEDDING_MAX_RATE
+EMBEDDING_RATE = float(os.environ.get('EMBEDDING_RATE', '20'))
+EMBEDDING_MIN_RATE = float(os.environ.get('EMBEDDING_MIN_RATE', '1'))
+EMBEDDING_MAX_RATE = float(os.environ.get('EMBEDDING_MAX_RATE', '50'))
+EMBEDDING_MAX_ATTEMPTS = int(os.environ.get('EMBEDDING_MAX_ATTEMPTS', '6'))
+EMBEDDING_BACKOFF_SECONDS = float(os.environ.get('EMBEDDING_BACKOFF_SECONDS', '0.5'))
+EMBEDDING_MAX_BACKOFF_SECONDS = float(os.environ.get('EMBEDDING_MAX_BACKOFF_SECONDS', '20'))
+
+THROTTLING_CODES = {'ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException'}
+RETRYABLE_CODES = THROTTLING_CODES | {'ServiceUnavailableException', 'ModelNotReadyException', 'InternalServerException', 'ModelTimeoutException'}
+
+def _error_code(error):
+    # BedrockEmbeddings wraps the botocore error in a ValueError, look through the chain and the message
+    while error is not None:
+        if isinstance(error, ClientError):
+            return error.response.get('Error', {}).get('Code')
+        for code in RETRYABLE_CODES:
+            if code in str(error):
+                return code
+        error = error.__cause__ or error.__context__
+    return None
+
+class AdaptiveTokenBucket:
+    def __init__(self, rate=EMBEDDING_RATE, min_rate=EMBEDDING_MIN_RATE, max_rate=EMBEDDING_MAX_RATE):
+        """
+
+        Token bucket shared by the workers. The rate is halved on throttling, at most once per second as
+        the workers throttled by the same burst all report it, and grows back by one request per second
+        for every rate worth of successful requests (AIMD).
+
+        Args:
+            rate (float): The initial rate in requests per second
+            min_rate (float): The lowest rate
+            max_rate (float): The highest rate
+        """
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.decreased = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                # Bursts are capped at one second worth of requests
+                self.tokens = min(self.tokens + (now - self.updated) * self.rate, max(self.rate, 1.0))
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.rate + 1.0 / self.rate, self.max_rate)
+
+    def on_throttle(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.decreased >= 1.0:
+                self.rate = max(self.rate / 2.0, self.min_rate)
+                self.decreased = now
+            self.tokens = 0.0
+
+class EmbeddingPipeline:
+    def __init__(self, embedding, concurrency=EMBEDDING_CONCURRENCY, bucket=None, max_attempts=EMBEDDING_MAX_ATTEMPTS, cache=None):
+        """
+
+        Embedding the documents concurrently through a bounded worker pool, rate limited by an
+        adaptive token bucket, with retries and jittered exponential backoff on throttling.
+        The vectors are returned in the order of the texts. With a cache, only the cache misses go to Bedrock.
+
+        Args:
+            embedding: The embedding model, with embed_query(text)
+            concurrency (int): The number of concurrent requests
+            bucket (AdaptiveTokenBucket): The rate limiter
+            max_attempts (int): The attempts per text before giving up
+            cache (EmbeddingCache): The persistent embedding cache
+        """
+        self.embedding = embedding
+        self.concurrency = concurrency
+        self.bucket = bucket or AdaptiveTokenBucket()
+        self.max_attempts = max_attempts
+        self.cache = cache
+        self.counters = {'embedded': 0, 'retries': 0, 'throttles': 0}
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _embed(self, text):
+        for attempt in range(self.max_attempts):
+            self.bucket.acquire()
+            try:
+                vector = self.embedding.embed_query(text)
+            except Exception as e:
+                code = _error_code(e)
+                if code not in RETRYABLE_CODES or attempt == self.max_attempts - 1:
+                    raise
+                if code in THROTTLING_CODES:
+                    self._count('throttles')
+                    self.bucket.on_throttle()
+                self._count('retries')
+                # Full jitter, the workers throttled together do not retry together
+                time.sleep(random.uniform(0, min(EMBEDDING_MAX_BACKOFF_SECONDS, EMBEDDING_BACKOFF_SECONDS * 2 ** attempt)))
+                continue
+            self.bucket.on_success()
+            self._count('embedded')
+            return vector
+
+    def _embed_cached(self, text):
+        vector = self.cache.get(text) if self.cache is not None else None
+        if vector is None:
+            vector = self._embed(text)
+            if self.cache is not None:
+                self.cache.put(text, vector)
+        return vector
+
+    def iter_embedded(self, items, text=lambda item: item.page_content):
+        """
+
+        Embed the items, yielding (item, vector) pairs in the order of the items as soon as the vector and
+        the previous ones are available. Only a window of a few items per worker is read ahead, so the
+        items can be a stream, e.g. documents parsed while the table is being scanned.
+
+        Args:
+            items (iterable): The items to embed, Documents by default
+            text (callable): Returns the text to embed of an item
+
+        Returns:
+            generator: The (item, vector) pairs
+        """
+        start = time.perf_counter()
+        count = 0
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for item in items:
+                pending.append((item, executor.submit(self._embed_cached, text(item))))
+                count += 1
+                if len(pending) >= self.concurrency * 4:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+            while pending:
+                item, future = pending.popleft()
+                yield item, future.result()
+        self.seconds += time.perf_counter() - start
+        print(f"Embeddings of {count} documents: {self.stats()}")
+
+    def iter_embeddings(self, texts):
+        """
+
+        Embed the texts, yielding each vector in the order of the texts.
+
+        Args:
+            texts (iterable): The texts to embed
+
+        Returns:
+            generator: The vectors
+        """
+        for _, vector in self.iter_embedded(texts, text=lambda text: text):
+            yield vector
+
+    def embed_documents(self, texts):
+        """
+
+        Embed the texts.
+
+        Args:
+            texts (list): The texts to embed
+
+        Returns:
+            list: The vectors, in the order of the texts
+        """
+        return list(self.iter_embeddings(texts))
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats['seconds'] = round(self.seconds, 2)
+        stats['documents_per_second'] = round(stats['embedded'] / self.seconds, 2) if self.seconds else None
+        stats['concurrency'] = self.concurrency
+        stats['rate'] = round(self.bucket.rate, 2)
+        if self.cache is not None:
+            stats.update(self.cache.stats())
+        return stats
@@ -5,11 +5,17 @@ import uuid
 from langchain_aws import BedrockEmbeddings
 from utils.S3TimeStampManager import S3TimestampManager
 import os
+from utils.vector_snapshot import SnapshotWriter, update_snapshot, VECTOR_SNAPSHOT_BUCKET
+from utils.embedding_pipeline import EmbeddingPipeline
+from utils.embedding_cache import EmbeddingCache
+from utils.bulk_writer import BulkWriter, BULK_DOCUMENT_IDS
 REGION = os.environ.get('REGION')
 SERVICE = 'aoss'
 HOST = os.environ.get('HOST')
 PORT = int(os.environ.get('PORT'))
 INDEX = os.environ.get('INDEX')
+EMBEDDING_MODEL_ID = 'amazon.titan-embed-text-v2:0'
+EMBEDDING_DIMENSION = 1024
 CREDENTIALS = boto3.Session().get_credentials()
 AWSAUTH = AWSV4SignerAuth(
     credentials=CREDENTIALS,
@@ -29,13 +35,102 @@ client = OpenSearch(
     timeout=300
 )
 
+def delete_documents(metadata_ids, index=INDEX, client=client):
+    """
+
+    Deleting the documents with the given metadata.id from the OpenSearch index. With BULK_DOCUMENT_IDS
+    updated documents are overwritten through their _id, this removes deleted documents and the copies
+    indexed under generated ids
+
+    Args:
+        metadata_ids (set): The metadata.id of the documents to delete
+        index (str): The index to delete the documents from
+        client (OpenSearch): The OpenSearch client
+    """
+    if not metadata_ids:
+        return
+    print(f"Deleting {len(metadata_ids)} outdated documents")
+    for metadata_id in metadata_ids:
+        delete_response = client.delete_by_query(
+            index=index,
+            body={
+                "query": {
+                    "term": {
+                        "metadata.id": metadata_id
+                    }
+                }
+            },
+            refresh=True
+        )
+        if delete_response.get('failures') or delete_response.get('deleted', 0) == 0:
+            print(f"Warning: Issue deleting document with metadata.id={metadata_id}: {delete_response}")
+
+def embed_documents(documents):
+    """
+
+    Embedding the documents of a stream batch before anything is written, the vectors of a batch are
+    all available before the index is changed. The embedding cache is not used: it is one S3 object of
+    every vector, downloading and rewriting it would cost more than embedding the few documents of a
+    batch, and concurrent batches would overwrite each other's additions.
+
+    Args:
+        documents (list): The documents to embed
+
+    Returns:
+        list: The vectors, in the order of the documents
+    """
+    embedding = BedrockEmbeddings(model_id=EMBEDDING_MODEL_ID, region_name="ca-central-1")
+    pipeline = EmbeddingPipeline(embedding)
+    return list(pipeline.iter_embeddings([doc.page_content for doc in documents]))
+
+def index_documents(documents, index=INDEX, client=client, snapshot=None, vectors=None):
+    """
+
+    Embedding the documents and writing them to the OpenSearch index
+
+    Args:
+        documents (list): The documents to index
+        index (str): The index to write the documents to
+        client (OpenSearch): The OpenSearch client
+        snapshot (SnapshotWriter): Where the documents and vectors are staged for the vector snapshot, None when it is disabled
+        vectors (list): The vectors of the documents from embed_documents, None to embed them while they are written
+
+    Returns:
+        dict: The bulk writer summary
+    """
+    cache = None
+    if vectors is None:
+        embedding = BedrockEmbeddings(model_id=EMBEDDING_MODEL_ID, region_name="ca-central-1")
+        # Unchanged contents are served from the embedding cache, only the misses go to Bedrock
+        cache = EmbeddingCache(EMBEDDING_MODEL_ID, EMBEDDING_DIMENSION)
+        cache.load()
+        # The Bedrock calls run concurrently, the vectors come back in the order of the documents.
+        # The vectors drive the loop so the pipeline runs to completion and reports its throughput
+        pipeline = EmbeddingPipeline(embedding, cache=cache)
+        vectors = pipeline.iter_embeddings([doc.page_content for doc in documents])
+    # Batches are written in the background while the next documents are embedded
+    writer = BulkWriter(client, index)
+    for vector, doc in zip(vectors, documents):
+        document = {
+            "text": doc.page_content,
+            "metadata": doc.metadata,
+            "page_content": doc.page_content,
+            "vector_field": vector
+        }
+        writer.add(document, doc.metadata.get('key'))
+        if snapshot is not None:
+            snapshot.add(doc.page_content, doc.metadata, vector)
+    if cache is not None:
+        cache.save()
+    return writer.close()
+
 def update_documents(documents, index=INDEX, client=client):
     """
     
     Upserting the documents into the OpenSearch index
 
     Args:
-        documents (list): The list of documents to upsert
+        documents (iterable): The documents to check for updates, a list or a stream such as iter_document_objects
         index (str): The index to upsert the documents to
         client (OpenSearch): The OpenSearch client
     
@@ -49,59 +144,77 @@ def update_documents(documents, index=INDEX, client=client):
     
     docs_to_update = []
     metadata_ids_to_delete = set()
-    embedding = BedrockEmbeddings(model_id="amazon.titan-embed-text-v2:0", region_name="ca-central-1")
-    print(f"Checking {len(documents)} documents for updates")
+    # Only the changed documents are kept, the documents can be a stream of the whole table
+    checked = 0
     for doc in documents:
+        checked += 1
         if doc.metadata['last_modified'] > last_update:
             docs_to_update.append(doc)
 
             if 'id' in doc.metadata:
                 metadata_ids_to_delete.add(doc.metadata['id'])
+    print(f"Checked {checked} documents, {len(docs_to_update)} to update")
 
-    if metadata_ids_to_delete:
-        print(f"Deleting {len(metadata_ids_to_delete)} outdated documents")
-        for metadata_id in metadata_ids_to_delete:
-            delete_response = client.delete_by_query(
-                index=index,
-                body={
-                    "query": {
-                        "term": {
-                            "metadata.id": metadata_id
-                        }
-                    }
-                },
-                refresh=True
-            )
-            if delete_response.get('failures') or delete_response.get('deleted', 0) == 0:
-                print(f"Warning: Issue deleting document with metadata.id={metadata_id}: {delete_response}")
-    bulk_data = []
-    embedding = BedrockEmbeddings(model_id="amazon.titan-embed-text-v2:0", region_name="ca-central-1")
-    
-    for doc in docs_to_update:
-        action = {
-            "index": {
-                "_index": index,
-            }
-        }
-        document = {
-            "text": doc.page_content,
-            "metadata": doc.metadata,
-            "page_content": doc.page_content,
-            "vector_field": embedding.embed_query(doc.page_content)
-        }
-        bulk_data.append(action)
-        bulk_data.append(document)
-    
-    if bulk_data:
+    delete_documents(metadata_ids_to_delete, index, client)
+    if not docs_to_update:
         timemanager.update_timestamp_key(BUCKET, KEY)
-        response = client.bulk(body=bulk_data)
-        failures = response.get('errors', False)
-        if failures:
-            print(f"Bulk indexing had errors: {response}")
-        else:
-            print(f"Successfully indexed {len(docs_to_update)} documents")
-        return response
-    
-    timemanager.update_timestamp_key(BUCKET, KEY)
-    print("No documents to index")
-    return None
+        print("No documents to index")
+        return None
+
+    # The vectors are only kept for the snapshot when it is enabled, staged on disk rather than in memory
+    snapshot = SnapshotWriter() if VECTOR_SNAPSHOT_BUCKET else None
+    try:
+        summary = index_documents(docs_to_update, index, client, snapshot)
+        if summary['failed']:
+            # Raised before the timestamp moves, the next run picks the same documents up again
+            raise Exception(f"Bulk indexing had {summary['failed']} failed documents: {summary['errors']}")
+        print(f"Successfully indexed {summary['indexed']} documents")
+        update_snapshot(snapshot, metadata_ids_to_delete)
+        timemanager.update_timestamp_key(BUCKET, KEY)
+    finally:
+        if snapshot is not None:
+            snapshot.abort()
+    return summary
+
+def upsert_changes(documents, metadata_ids_to_delete, index=INDEX, client=client):
+    """
+
+    Applying the changes of a batch of stream records: indexing the new documents, deleting the
+    removed ones and updating the vector snapshot. The S3 timestamp of the cron run is not moved.
+
+    With BULK_DOCUMENT_IDS the new documents overwrite the previous ones through their _id, the live
+    documents stay searchable and only the metadata.id no document was indexed under (removed or
+    renamed) are deleted, once the bulk write succeeded. With generated ids the previous documents
+    cannot be told apart from the new ones, every metadata.id is deleted before the write, once the
+    batch is embedded.
+
+    Args:
+        documents (list): The documents to index
+        metadata_ids_to_delete (set): The metadata.id of the documents replaced or removed
+        index (str): The index to upsert the documents to
+        client (OpenSearch): The OpenSearch client
+
+    Returns:
+        dict: The bulk writer summary, None if there was nothing to index
+    """
+    vectors = embed_documents(documents) if documents else []
+    if BULK_DOCUMENT_IDS:
+        stale_ids = set(metadata_ids_to_delete) - {doc.metadata.get('id') for doc in documents}
+    else:
+        delete_documents(metadata_ids_to_delete, index, client)
+        stale_ids = set()
+    summary = None
+    snapshot = SnapshotWriter() if VECTOR_SNAPSHOT_BUCKET else None
+    try:
+        if documents:
+            summary = index_documents(documents, index, client, snapshot, vectors)
+            if summary['failed']:
+                # Raised so the batch is retried, the deletes and the successful writes are repeated safely
+                raise Exception(f"Bulk indexing had {summary['failed']} failed documents: {summary['errors']}")
+            print(f"Successfully indexed {summary['indexed']} documents")
+        delete_documents(stale_ids, index, client)
+        update_snapshot(snapshot, metadata_ids_to_delete)
+    finally:
+        if snapshot is not None:
+            snapshot.abort()
+    return summary
@@ -4,75 +4,152 @@ from utils.general_utils import *
 from utils.content_construction import *
 logger = logging.getLogger(__name__)
 
-def parse_to_document_objects(metadata):
-    logger.info("Converting metadata to Document objects")
+def _count_snippet(programs, snippet):
+    course = snippet['course']
+    if course not in programs:
+        programs[course] = 1
+        programs['modified'] = snippet.get('modified')
+    else:
+        programs[course] += 1
+        programs['modified'] = min(programs['modified'], snippet.get('modified'))
+
+def _add_program_info(program_info_en, program_info_fr, snippet):
+    english_data = snippet.get('English', {})
+    french_data = snippet.get('French', {})
+    program_name = format_course_name(snippet['course'])
+    if program_name not in program_info_en:
+        program_info_en[program_name] = {}
+    if program_name not in program_info_fr:
+        program_info_fr[program_name] = {}
+    program_info_en[program_name][english_data['title']] = create_english_program_info(english_data, last_modified=snippet.get('modified'))
+    program_info_fr[program_name][french_data['title']] = create_french_program_info(french_data, last_modified=snippet.get('modified'))
+
+def snippet_documents(snippet, key_names=()):
+    """
+
+    Converting one snippet to its French and English Document objects
+
+    Args:
+        snippet (dict): The snippet item
+        key_names (tuple): The key attribute names of the table, the documents carry the table key of the snippet in metadata.key
+
+    Returns:
+        list: The Document objects, without the languages missing their PDF content
+    """
+    english_data = snippet.get('English', {})
+    french_data = snippet.get('French', {})
+    en_pdf_con = english_data.get("pdf_content")
+    if en_pdf_con != "" and en_pdf_con != None:
+        english_doc = Document(
+            page_content=construct_content_for_embedding_en(english_data, course=snippet['course']),
+            metadata = sanitize_metadata({k: replace_null(v) for k, v in english_data.items() if k != 'pdf_content'}, language='en'),
+    )
+    else:
+        logger.warning(f"Skipping English document for {english_data.get("title")} due to missing PDF content")
+        english_doc = None
+
+    fr_pdf_con = french_data.get("pdf_content")
+    if fr_pdf_con != "" and fr_pdf_con != None:
+        french_doc = Document(
+            page_content=construct_content_for_embedding_fr(french_data, course=snippet['course']),
+            metadata = sanitize_metadata({k: replace_null(v) for k, v in french_data.items() if k != 'pdf_content'}, language='fr'),
+        )
+    else:
+        logger.warning(f"Skipping French document for {french_data.get("title")} due to missing PDF content")
+        french_doc = None
+
     documents = []
+    if french_doc != None:
+        french_doc.metadata['last_modified'] = snippet.get('modified')
+        if key_names:
+            french_doc.metadata['key'] = snippet_key(snippet, key_names, 'fr')
+        documents.append(french_doc)
+        logger.info(f"Converted snippet {french_data.get("title")} to Document object")
+
+    if english_doc != None:
+        english_doc.metadata['last_modified'] = snippet.get('modified')
+        if key_names:
+            english_doc.metadata['key'] = snippet_key(snippet, key_names, 'en')
+        documents.append(english_doc)
+        logger.info(f"Converted snippet {english_data.get("title")} to Document object")
+    return documents
+
+def program_documents(snippets):
+    """
+
+    Creating the program documents (all the snippets of a program) of the programs of the snippets
+
+    Args:
+        snippets (iterable): Every snippet of the programs to create
+
+    Returns:
+        list: The English then the French program documents
+    """
+    program_info_en = {}
+    program_info_fr = {}
+    for snippet in snippets:
+        try:
+            _add_program_info(program_info_en, program_info_fr, snippet)
+        except Exception as e:
+            logger.error(f"Program information failed: {str(e)}", exc_info=True)
+    return create_content_for_specific_course(program_info_en, language='en') + create_content_for_specific_course(program_info_fr, language='fr')
+
+def course_documents(snippets):
+    """
+
+    Creating the English and French documents listing every course with its number of snippets
+
+    Args:
+        snippets (iterable): Every snippet of the table, only course and modified are read
+
+    Returns:
+        list: The English and French course documents, empty if there are no snippets
+    """
+    programs_en = {}
+    programs_fr = {}
+    for snippet in snippets:
+        _count_snippet(programs_en, snippet)
+        _count_snippet(programs_fr, snippet)
+    if not programs_en:
+        return []
+    return [create_overall_snippet_courses_en(programs_en), create_overall_snippet_courses_fr(programs_fr)]
+
+def iter_document_objects(metadata, key_names=()):
+    """
+
+    Converting the snippets to Document objects as they are read. The snippet documents are yielded
+    one by one, the program and course documents once all the snippets have been read.
+
+    Args:
+        metadata (iterable): The snippet items, e.g. a ParallelScan
+        key_names (tuple): The key attribute names of the table, e.g. ParallelScan.key_names, the snippet documents carry their table key in metadata.key
+
+    Returns:
+        generator: The Document objects
+    """
+    logger.info("Converting metadata to Document objects")
     programs_en = {}
     programs_fr = {}
     program_info_en = {}
     program_info_fr = {}
     for snippet in metadata:
         try:
-            english_data = snippet.get('English', {})
-            french_data = snippet.get('French', {})
-            course = snippet['course']
-            if course not in programs_en:
-                programs_en[course] = 1
-                programs_en['modified'] = snippet.get('modified')
-            else:
-                programs_en[course] += 1
-                programs_en['modified'] = min(programs_en['modified'], snippet.get('modified'))
-            if course not in programs_fr:
-                programs_fr[course] = 1
-                programs_fr['modified'] = snippet.get('modified')
-            else:
-                programs_fr[course] += 1
-                programs_fr['modified'] = min(programs_fr['modified'], snippet.get('modified'))
-            program_name = format_course_name(snippet['course'])
-            if program_name not in program_info_en:
-                program_info_en[program_name] = {}
-            if program_name not in program_info_fr:
-                program_info_fr[program_name] = {}
-            program_info_en[program_name][english_data['title']] = create_english_program_info(english_data, last_modified=snippet.get('modified'))
-            program_info_fr[program_name][french_data['title']] = create_french_program_info(french_data, last_modified=snippet.get('modified'))
-            en_pdf_con = english_data.get("pdf_content")
-            if en_pdf_con != "" and en_pdf_con != None:
-                english_doc = Document(
-                    page_content=construct_content_for_embedding_en(english_data, course=snippet['course']),
-                    metadata = sanitize_metadata({k: replace_null(v) for k, v in english_data.items() if k != 'pdf_content'}, language='en'),
-            )
-            else:
-                logger.warning(f"Skipping English document for {english_data.get("title")} due to missing PDF content")
-                english_doc = None
-
-            fr_pdf_con = french_data.get("pdf_content")
-            if fr_pdf_con != "" and fr_pdf_con != None:
-                french_doc = Document(
-                    page_content=construct_content_for_embedding_fr(french_data, course=snippet['course']),
-                    metadata = sanitize_metadata({k: replace_null(v) for k, v in french_data.items() if k != 'pdf_content'}, language='fr'),
-                )
-            else:
-                logger.warning(f"Skipping French document for {french_data.get("title")} due to missing PDF content")
-                french_doc = None
-            
-            if french_doc != None:
-                french_doc.metadata['last_modified'] = snippet.get('modified')
-                documents.extend([french_doc])
-                logger.info(f"Converted snippet {french_data.get("title")} to Document object")
-            
-            if english_doc != None:
-                english_doc.metadata['last_modified'] = snippet.get('modified')
-                documents.extend([english_doc])
-                logger.info(f"Converted snippet {english_data.get("title")} to Document object")
+            _count_snippet(programs_en, snippet)
+            _count_snippet(programs_fr, snippet)
+            _add_program_info(program_info_en, program_info_fr, snippet)
+            documents = snippet_documents(snippet, key_names)
         except Exception as e:
             logger.error(f"Document conversion failed: {str(e)}", exc_info=True)
             continue
+        yield from documents
     specific_program_en = create_content_for_specific_course(program_info_en, language='en')
     specific_program_fr = create_content_for_specific_course(program_info_fr, language='fr')
     overall_en = create_overall_snippet_courses_en(programs_en)
     overall_fr = create_overall_snippet_courses_fr(programs_fr)
-    documents.extend(specific_program_en)
-    documents.extend(specific_program_fr)
-    documents.extend([overall_en])
-    documents.extend([overall_fr])
-    return documents
\ No newline at end of file
+    yield from specific_program_en
+    yield from specific_program_fr
+    yield overall_en
+    yield overall_fr
+
+def parse_to_document_objects(metadata, key_names=()):
+    return list(iter_document_objects(metadata, key_names))
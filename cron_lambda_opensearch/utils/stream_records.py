@@ -0,0 +1,162 @@
+import os
+import boto3
+from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.types import TypeDeserializer
+from utils.dynamodb_scan import ParallelScan, SNIPPET_ATTRIBUTES
+from utils.general_utils import create_id, format_course_name, item_key
+from utils.parse_to_document_objects import snippet_documents, program_documents, course_documents
+
+# Optional global secondary index of the snippets table with course as partition key, projecting the
+# snippet attributes, so a program is read with a query instead of a filtered scan
+SNIPPETS_COURSE_INDEX = os.environ.get('SNIPPETS_COURSE_INDEX')
+
+DESERIALIZER = TypeDeserializer()
+
+def _deserialize(image):
+    return {name: DESERIALIZER.deserialize(value) for name, value in image.items()}
+
+def _with_keys(attributes, key_names):
+    return attributes + tuple(name for name in key_names if name not in attributes)
+
+def _snippet_ids(snippet):
+    ids = set()
+    for language, data in (('en', 'English'), ('fr', 'French')):
+        title = snippet.get(data, {}).get('title')
+        if title:
+            ids.add(create_id(title, language))
+    return ids
+
+def collapse_records(records):
+    """
+
+    Collapsing the stream records of a batch to one change per snippet, the images before the first
+    record and the image after the last one
+
+    Args:
+        records (list): The DynamoDB stream records, in the order of the stream
+
+    Returns:
+        tuple: The changes by snippet key and the key attribute names of the table
+    """
+    changes = {}
+    key_names = ()
+    for record in records:
+        data = record['dynamodb']
+        event_name = record['eventName']
+        keys = _deserialize(data['Keys'])
+        key_names = tuple(sorted(keys))
+        if event_name in ('MODIFY', 'REMOVE') and 'OldImage' not in data:
+            raise ValueError("The stream must use the NEW_AND_OLD_IMAGES view type, the record has no OldImage")
+        if event_name in ('INSERT', 'MODIFY') and 'NewImage' not in data:
+            raise ValueError("The stream must use the NEW_AND_OLD_IMAGES view type, the record has no NewImage")
+        change = changes.setdefault(item_key(keys, key_names), {'old': [], 'new': None, 'membership': False})
+        if 'OldImage' in data:
+            change['old'].append(_deserialize(data['OldImage']))
+        change['new'] = _deserialize(data['NewImage']) if event_name != 'REMOVE' else None
+        # Inserts and removes change the number of snippets of a course
+        if event_name in ('INSERT', 'REMOVE'):
+            change['membership'] = True
+    return changes, key_names
+
+def _overlay(items, changes, key_names):
+    # The table may not show the batch yet (eventually consistent index), its images win
+    snippets = {item_key(item, key_names): item for item in items}
+    for key, change in changes.items():
+        snippets.pop(key, None)
+        if change['new'] is not None:
+            snippets[key] = change['new']
+    return list(snippets.values())
+
+def read_course_snippets(table_name, courses, key_names):
+    """
+
+    Reading every snippet of the courses, with the course index if there is one, otherwise with a
+    parallel scan filtered on the courses
+
+    Args:
+        table_name (str): The snippets table
+        courses (set): The courses to read
+        key_names (tuple): The key attributes of the table, projected to match the stream records
+
+    Returns:
+        generator: The snippet items
+    """
+    attributes = _with_keys(SNIPPET_ATTRIBUTES, key_names)
+    if not SNIPPETS_COURSE_INDEX:
+        yield from ParallelScan(
+            table_name,
+            attributes=attributes,
+            filter_expression=Attr('course').is_in(sorted(courses)),
+            consistent_read=True
+        )
+        return
+    table = boto3.resource('dynamodb').Table(table_name)
+    names = {f"#a{i}": name for i, name in enumerate(attributes)}
+    for course in sorted(courses):
+        params = {
+            'IndexName': SNIPPETS_COURSE_INDEX,
+            'KeyConditionExpression': Key('course').eq(course),
+            'ProjectionExpression': ", ".join(names),
+            'ExpressionAttributeNames': names,
+        }
+        while True:
+            response = table.query(**params)
+            yield from response['Items']
+            if 'LastEvaluatedKey' not in response:
+                break
+            params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def documents_for_records(records, table_name):
+    """
+
+    Turning a batch of stream records into the documents to delete and to index: the EN/FR documents
+    of the changed snippets, the program documents of the courses they belong (or belonged) to, and the
+    course documents when snippets were added, removed or moved to another course
+
+    Args:
+        records (list): The DynamoDB stream records of the invocation
+        table_name (str): The snippets table
+
+    Returns:
+        tuple: The metadata.id to delete and the Document objects to index
+    """
+    changes, key_names = collapse_records(records)
+    metadata_ids_to_delete = set()
+    documents = []
+    courses = set()
+    courses_changed = False
+    for change in changes.values():
+        old_courses = set()
+        for image in change['old']:
+            metadata_ids_to_delete |= _snippet_ids(image)
+            old_courses.add(image.get('course'))
+        new = change['new']
+        if new is not None:
+            try:
+                snippet_docs = snippet_documents(new, key_names)
+            except Exception as e:
+                print(f"Document conversion failed for {new.get('English', {}).get('title')}: {str(e)}")
+                snippet_docs = []
+            documents.extend(snippet_docs)
+            metadata_ids_to_delete |= {doc.metadata['id'] for doc in snippet_docs}
+            if old_courses - {new.get('course')}:
+                courses_changed = True
+            old_courses.add(new.get('course'))
+        courses_changed = courses_changed or change['membership']
+        courses |= {course for course in old_courses if course}
+    print(f"{len(records)} stream records, {len(changes)} snippets changed in {len(courses)} courses")
+
+    if courses:
+        snippets = _overlay(read_course_snippets(table_name, courses, key_names), changes, key_names)
+        for course in courses:
+            program_name = format_course_name(course)
+            metadata_ids_to_delete |= {f"all_programs_{program_name}_en", f"all_programs_{program_name}_fr"}
+        # A course whose last snippet was removed has no program documents left
+        documents.extend(program_documents(snippet for snippet in snippets if snippet.get('course') in courses))
+
+    if courses_changed:
+        # The course counts need every snippet, only course and modified are read
+        scan = ParallelScan(table_name, attributes=_with_keys(('course', 'modified'), key_names), consistent_read=True)
+        metadata_ids_to_delete |= {'all_courses_en', 'all_courses_fr'}
+        documents.extend(course_documents(_overlay(scan, changes, key_names)))
+    return metadata_ids_to_delete, documents
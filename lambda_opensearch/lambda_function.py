@@ -3,8 +3,10 @@ import json
 import boto3
 from botocore.exceptions import ClientError
 from dotenv import load_dotenv
-from utils.parse_to_document_objects import parse_to_document_objects
+from utils.parse_to_document_objects import iter_document_objects
+from utils.dynamodb_scan import ParallelScan
 from utils.opensearch import upsert_documents
+from utils.stream_consumer import pause_stream_consumer, resume_stream_consumer
 load_dotenv()
 
 dynamodb = boto3.resource('dynamodb')
@@ -25,31 +27,22 @@ def lambda_handler(event, context):
             )
         }
     
-    table = dynamodb.Table(table_name)
-
+    paused = False
     try:
+        # Stream changes made during the rebuild would go to the generation being replaced, the stream
+        # handler waits and applies them to the new generation after the swap
+        paused = pause_stream_consumer()
 
-        all_items = []
-        last_evaluated_key = None
-
-        while True:
-            scan_params = {}
-            if last_evaluated_key:
-                scan_params['ExclusiveStartKey'] = last_evaluated_key
-
-            response = table.scan(**scan_params)
-            all_items.extend(response['Items'])
-            last_evaluated_key = response.get('LastEvaluatedKey')
-            if not last_evaluated_key:
-                break
-        
-        documents = parse_to_document_objects(all_items)
+        # The segments are scanned in parallel and the items flow through parsing, embedding and
+        # bulk writing as they arrive, the table is never held in memory
+        scan = ParallelScan(table_name)
+        documents = iter_document_objects(scan, scan.key_names)
         upsert_documents(documents)
         return {
             'statusCode': 200,
             'body': json.dumps(
                 {
-                    'message': f'Successfully retrieved {len(all_items)} items from {table_name} and upserted in OpenSearch'
+                    'message': f'Successfully retrieved {scan.scanned_count} items from {table_name} and upserted in OpenSearch'
                 }, default=str
             )
         }
@@ -73,6 +66,9 @@ def lambda_handler(event, context):
                 'error': str(e)
             })
         }
+    finally:
+        if paused:
+            resume_stream_consumer()
     
 if __name__ == "__main__":
     val = lambda_handler({}, {})
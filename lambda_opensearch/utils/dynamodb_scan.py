@@ -0,0 +1,123 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+
+SCAN_TOTAL_SEGMENTS = int(os.environ.get('SCAN_TOTAL_SEGMENTS', '4'))
+# Pages buffered between the scan and the parsing, the scan pauses when the consumer falls behind
+SCAN_MAX_BUFFERED_PAGES = int(os.environ.get('SCAN_MAX_BUFFERED_PAGES', '8'))
+# The attributes read by parse_to_document_objects
+SNIPPET_ATTRIBUTES = ('course', 'modified', 'English', 'French')
+
+_DONE = object()
+
+def table_key_names(table_name):
+    """
+
+    The key attribute names of a table, sorted like the Keys of its stream records
+
+    Args:
+        table_name (str): The table name
+
+    Returns:
+        tuple: The partition key name, and the sort key name if the table has one
+    """
+    table = boto3.resource('dynamodb').Table(table_name)
+    return tuple(sorted(key['AttributeName'] for key in table.key_schema))
+
+class ParallelScan:
+    def __init__(
+            self,
+            table_name,
+            total_segments=SCAN_TOTAL_SEGMENTS,
+            attributes=SNIPPET_ATTRIBUTES,
+            max_buffered_pages=SCAN_MAX_BUFFERED_PAGES,
+            filter_expression=None,
+            consistent_read=False
+            ):
+        """
+
+        Parallel scan of a DynamoDB table, one worker per segment, yielding the items as the pages arrive.
+        Iterating it again scans the table again. The key attributes are always read, they identify the
+        documents of an item (key_names).
+
+        Args:
+            table_name (str): The table name
+            total_segments (int): The number of segments scanned concurrently
+            attributes (tuple): The projected attributes, the key attributes included, all attributes if None
+            max_buffered_pages (int): The pages held in memory before the workers wait for the consumer
+            filter_expression (ConditionBase): Only yield the matching items, e.g. Attr('course').is_in(courses)
+            consistent_read (bool): Strongly consistent reads, at twice the read capacity
+        """
+        self.table_name = table_name
+        self.total_segments = total_segments
+        self.key_names = table_key_names(table_name)
+        if attributes:
+            attributes = tuple(attributes) + tuple(name for name in self.key_names if name not in attributes)
+        self.attributes = attributes
+        self.max_buffered_pages = max_buffered_pages
+        self.filter_expression = filter_expression
+        self.consistent_read = consistent_read
+        self.scanned_count = 0
+
+    def _scan_params(self, segment):
+        params = {'Segment': segment, 'TotalSegments': self.total_segments}
+        if self.attributes:
+            # Placeholders, some attribute names are DynamoDB reserved words
+            names = {f"#a{i}": name for i, name in enumerate(self.attributes)}
+            params['ProjectionExpression'] = ", ".join(names)
+            params['ExpressionAttributeNames'] = names
+        if self.filter_expression is not None:
+            params['FilterExpression'] = self.filter_expression
+        if self.consistent_read:
+            params['ConsistentRead'] = True
+        return params
+
+    def _put(self, pages, stopped, item):
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _scan_segment(self, segment, pages, stopped):
+        try:
+            # boto3 resources are not thread safe, each worker has its own
+            table = boto3.session.Session().resource('dynamodb').Table(self.table_name)
+            params = self._scan_params(segment)
+            while True:
+                response = table.scan(**params)
+                if not self._put(pages, stopped, response['Items']):
+                    return
+                if 'LastEvaluatedKey' not in response:
+                    return
+                params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        finally:
+            self._put(pages, stopped, _DONE)
+
+    def __iter__(self):
+        pages = queue.Queue(maxsize=self.max_buffered_pages)
+        stopped = threading.Event()
+        self.scanned_count = 0
+        executor = ThreadPoolExecutor(max_workers=self.total_segments)
+        futures = [executor.submit(self._scan_segment, segment, pages, stopped) for segment in range(self.total_segments)]
+        try:
+            done = 0
+            while done < self.total_segments:
+                page = pages.get()
+                if page is _DONE:
+                    done += 1
+                    continue
+                self.scanned_count += len(page)
+                yield from page
+            # Raises the first scan error
+            for future in futures:
+                future.result()
+        finally:
+            # Stops the workers when the consumer stops early or fails
+            stopped.set()
+            executor.shutdown(wait=True)
+        print(f"Scanned {self.scanned_count} items from {self.table_name} in {self.total_segments} segments")
@@ -0,0 +1,122 @@
+import hashlib
+import io
+import os
+import threading
+import boto3
+import numpy as np
+from botocore.exceptions import ClientError
+
+EMBEDDING_CACHE_BUCKET = os.environ.get('EMBEDDING_CACHE_BUCKET')
+EMBEDDING_CACHE_PREFIX = os.environ.get('EMBEDDING_CACHE_PREFIX', 'embedding_cache')
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class EmbeddingCache:
+    def __init__(self, model_id, dimension, bucket=EMBEDDING_CACHE_BUCKET, prefix=EMBEDDING_CACHE_PREFIX, s3_client=None):
+        """
+
+        Persistent cache of the document embeddings, keyed by (model id, dimension, SHA-256 of the page_content).
+        All the vectors of a model and dimension are one S3 object, loaded in bulk at the start of a run
+        and written back at the end, so unchanged snippets are never embedded again.
+
+        Args:
+            model_id (str): The embedding model ID
+            dimension (int): The embedding dimension
+            bucket (str): The S3 bucket, the cache is disabled if None
+            prefix (str): The S3 prefix
+            s3_client: The S3 client
+        """
+        self.model_id = model_id
+        self.dimension = dimension
+        self.bucket = bucket
+        self.key = f"{prefix}/{model_id}/{dimension}/embeddings.npz"
+        self.s3_client = s3_client
+        self.vectors = {}
+        # The hashes looked up in this run
+        self.used = set()
+        self.added = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _client(self):
+        if self.s3_client is None:
+            self.s3_client = boto3.client('s3')
+        return self.s3_client
+
+    def load(self):
+        """
+
+        Load all the cached vectors of the model and dimension.
+
+        Returns:
+            int: The number of cached vectors
+        """
+        if not self.bucket:
+            return 0
+        try:
+            response = self._client().get_object(Bucket=self.bucket, Key=self.key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                print(f"No embedding cache at s3://{self.bucket}/{self.key}, starting empty")
+                return 0
+            raise
+        with np.load(io.BytesIO(response['Body'].read()), allow_pickle=False) as data:
+            hashes, vectors = data['hashes'], data['vectors']
+        if vectors.ndim != 2 or vectors.shape[1] != self.dimension:
+            print(f"Ignoring embedding cache of shape {vectors.shape}, expected dimension {self.dimension}")
+            return 0
+        self.vectors = dict(zip(hashes.tolist(), vectors))
+        print(f"Loaded {len(self.vectors)} cached embeddings from s3://{self.bucket}/{self.key}")
+        return len(self.vectors)
+
+    def get(self, text):
+        key = content_hash(text)
+        vector = self.vectors.get(key)
+        with self.lock:
+            self.used.add(key)
+            if vector is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return vector.tolist() if vector is not None else None
+
+    def put(self, text, vector):
+        with self.lock:
+            self.vectors[content_hash(text)] = np.asarray(vector, dtype=np.float32)
+            self.added += 1
+
+    def save(self, prune=False):
+        """
+
+        Write the cache back to S3, when vectors were added or dropped.
+
+        Args:
+            prune (bool): Only keep the vectors looked up in this run, e.g. the documents of a full reindex
+        """
+        if not self.bucket:
+            return
+        vectors = self.vectors
+        if prune:
+            with self.lock:
+                vectors = {key: vector for key, vector in self.vectors.items() if key in self.used}
+        if not self.added and len(vectors) == len(self.vectors):
+            return
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            hashes=np.asarray(list(vectors), dtype='<U64'),
+            vectors=np.asarray(list(vectors.values()), dtype=np.float32).reshape(-1, self.dimension)
+        )
+        self._client().put_object(Bucket=self.bucket, Key=self.key, Body=buffer.getvalue())
+        print(f"Saved {len(vectors)} embeddings to s3://{self.bucket}/{self.key}, {self.added} new")
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'cache_hits': self.hits,
+                'cache_misses': self.misses,
+                'cache_hit_ratio': round(self.hits / lookups, 3) if lookups else None,
+            }
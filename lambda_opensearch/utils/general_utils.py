@@ -1,3 +1,4 @@
+import json
 from utils.count_options import count_options
 
 def create_id(original_title: str, language: str) -> str:
@@ -20,6 +21,35 @@ def create_id(original_title: str, language: str) -> str:
 
     return original_title.strip().lower().replace(" ", "_") + f"_{language}"
 
+def item_key(item: dict, key_names: tuple) -> str:
+    """
+    The table key of an item, its key attribute values in the order of key_names
+
+    Args:
+        item (dict): The table item, or the Keys of a stream record
+        key_names (tuple): The key attribute names of the table
+
+    Returns:
+        str: The key, unique in the table unlike the title
+    """
+
+    return json.dumps([item.get(name) for name in key_names], default=str)
+
+def snippet_key(snippet: dict, key_names: tuple, language: str) -> str:
+    """
+    The key of the document of a snippet in one language, the _id of the document is derived from it
+
+    Args:
+        snippet (dict): The snippet item
+        key_names (tuple): The key attribute names of the table
+        language (str): The language of the document, either 'en' or 'fr'
+
+    Returns:
+        str: The table key of the snippet followed by the language
+    """
+
+    return json.dumps([snippet.get(name) for name in key_names] + [language], default=str)
+
 
 def replace_null(item):
     return item if item else ""
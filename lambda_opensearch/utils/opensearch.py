@@ -3,11 +3,24 @@ from requests_aws4auth import AWS4Auth
 import boto3
 from langchain_aws import BedrockEmbeddings
 import os
+import re
+import time
+from utils.vector_snapshot import SnapshotWriter, VECTOR_SNAPSHOT_BUCKET
+from utils.embedding_pipeline import EmbeddingPipeline
+from utils.embedding_cache import EmbeddingCache
+from utils.bulk_writer import BulkWriter
 SERVICE = 'aoss'
 PORT = int(os.environ.get('PORT'))
 HOST = os.environ.get('HOST')
 REGION = os.environ.get('REGION')
 INDEX = os.environ.get('INDEX')
+EMBEDDING_MODEL_ID = 'amazon.titan-embed-text-v2:0'
+EMBEDDING_DIMENSION = 1024
+# blue_green builds a new versioned index and moves the INDEX alias to it, in_place deletes and rebuilds INDEX
+REINDEX_MODE = os.environ.get('REINDEX_MODE', 'blue_green')
+# Generations kept after a swap, the current one included, to roll back by moving the alias
+REINDEX_KEEP_GENERATIONS = int(os.environ.get('REINDEX_KEEP_GENERATIONS', '2'))
+REINDEX_COUNT_TIMEOUT_SECONDS = int(os.environ.get('REINDEX_COUNT_TIMEOUT_SECONDS', '120'))
 
 CREDENTIALS = boto3.Session().get_credentials()
 AWSAUTH = AWS4Auth(
@@ -32,23 +45,15 @@ client = OpenSearch(
     timeout=300,
 )
 
-def upsert_documents(documents, index=INDEX, client=client):
+def create_index(index, client=client):
     """
-    
-    Upserting the documents into the OpenSearch index
+
+    Create an index with the mapping and the KNN settings of the snippets
 
     Args:
-        documents (list): The list of documents to upsert
-        index (str): The index to upsert the documents to
+        index (str): The index name
         client (OpenSearch): The OpenSearch client
-    
     """
-    # Total update of the index
-    if client.indices.exists(index=INDEX):
-        print(f"Deleting existing index: {INDEX}")
-        client.indices.delete(index=INDEX)
-        print(f"Index {INDEX} deleted successfully.")
-
     index_mapping = {
         "mappings": {
             "properties": {
@@ -63,7 +68,7 @@ def upsert_documents(documents, index=INDEX, client=client):
                 },
                 "vector_field": {
                     "type": "knn_vector",
-                    "dimension": 1024,
+                    "dimension": EMBEDDING_DIMENSION,
                     "method": {  # Add explicit method configuration
                         "name": "hnsw",
                         "space_type": "l2",
@@ -86,34 +91,176 @@ def upsert_documents(documents, index=INDEX, client=client):
         }
     }
     client.indices.create(index=index, body=index_mapping)
+
+def wait_for_count(index, expected, client=client, timeout=REINDEX_COUNT_TIMEOUT_SECONDS):
+    """
+
+    Refresh the index and wait until it counts the expected documents
+
+    Args:
+        index (str): The index name
+        expected (int): The number of documents indexed
+        client (OpenSearch): The OpenSearch client
+        timeout (int): Seconds to wait for the documents to become searchable
+
+    Returns:
+        bool: True if the index holds the expected documents
+    """
+    try:
+        client.indices.refresh(index=index)
+    except Exception as e:
+        # OpenSearch Serverless refreshes on its own schedule, the count below waits for it
+        print(f"Refresh of {index} not available: {str(e)}")
+    deadline = time.monotonic() + timeout
+    while True:
+        count = client.count(index=index)['count']
+        if count == expected:
+            return True
+        if count > expected or time.monotonic() >= deadline:
+            print(f"Index {index} counts {count} documents, {expected} expected")
+            return False
+        time.sleep(5)
+
+def swap_alias(alias, index, client=client):
+    """
+
+    Point the alias at the index, in one atomic update of the aliases. On the first run the alias name
+    is still a concrete index, it is removed in the same update.
+
+    Args:
+        alias (str): The alias the orchestrator queries, INDEX
+        index (str): The new generation
+        client (OpenSearch): The OpenSearch client
+    """
+    actions = []
+    if client.indices.exists_alias(name=alias):
+        for current in client.indices.get_alias(name=alias):
+            actions.append({"remove": {"index": current, "alias": alias}})
+    elif client.indices.exists(index=alias):
+        actions.append({"remove_index": {"index": alias}})
+    actions.append({"add": {"index": index, "alias": alias}})
+    client.indices.update_aliases(body={"actions": actions})
+    print(f"Alias {alias} now points at {index}")
+
+def delete_old_generations(alias, client=client, keep=REINDEX_KEEP_GENERATIONS):
+    """
+
+    Delete the generations of the alias beyond the newest keep ones, never the one the alias points at
+
+    Args:
+        alias (str): The alias, generations are named <alias>-<timestamp>
+        client (OpenSearch): The OpenSearch client
+        keep (int): The number of generations to keep
+    """
+    current = set(client.indices.get_alias(name=alias)) if client.indices.exists_alias(name=alias) else set()
+    generations = sorted(
+        (name for name in client.indices.get(index=f"{alias}-*") if re.fullmatch(rf"{re.escape(alias)}-\d{{14}}", name)),
+        reverse=True
+    )
+    for generation in generations[keep:]:
+        if generation in current:
+            continue
+        client.indices.delete(index=generation)
+        print(f"Deleted old generation {generation}")
+
+def upsert_documents(documents, index=INDEX, client=client):
+    """
     
-    bulk_data = []
-    embedding = BedrockEmbeddings(model_id="amazon.titan-embed-text-v2:0", region_name="ca-central-1")
-    print("Upserting")
-    for doc in documents:
-        action = {
-            "index": {
-                "_index": index,
-            }
-        }
-        document = {
-            "text": doc.page_content,
-            "metadata": doc.metadata,
-            "page_content": doc.page_content,
-            "vector_field": embedding.embed_query(doc.page_content)
-        }
-        bulk_data.append(action)
-        bulk_data.append(document)
+    Upserting the documents into the OpenSearch index. In blue_green mode the documents are loaded into
+    a new generation of the index and the index alias is moved to it once the counts match, queries never
+    see a missing or partial index.
 
-    if bulk_data:
-        response = client.bulk(body=bulk_data)
-        failures = response.get('errors', False)
+    Args:
+        documents (iterable): The documents to upsert, a list or a stream such as iter_document_objects
+        index (str): The index (alias in blue_green mode) to upsert the documents to
+        client (OpenSearch): The OpenSearch client
+    
+    """
+    if REINDEX_MODE == 'blue_green':
+        alias = index
+        index = f"{alias}-{time.strftime('%Y%m%d%H%M%S', time.gmtime())}"
+        print(f"Building generation {index} of {alias}")
+    else:
+        alias = None
+        # Total update of the index
+        if client.indices.exists(index=index):
+            print(f"Deleting existing index: {index}")
+            client.indices.delete(index=index)
+            print(f"Index {index} deleted successfully.")
+    create_index(index, client)
+    
+    embedding = BedrockEmbeddings(model_id=EMBEDDING_MODEL_ID, region_name="ca-central-1")
+    print("Upserting")
+    # Unchanged contents are served from the embedding cache, only the misses go to Bedrock
+    cache = EmbeddingCache(EMBEDDING_MODEL_ID, EMBEDDING_DIMENSION)
+    cache.load()
+    # The Bedrock calls run concurrently, the vectors come back in the order of the documents,
+    # and batches are written in the background while the next documents are embedded
+    pipeline = EmbeddingPipeline(embedding, cache=cache)
+    writer = BulkWriter(client, index)
+    # The vectors are only kept for the snapshot when it is enabled, staged on disk rather than in memory
+    snapshot = SnapshotWriter() if VECTOR_SNAPSHOT_BUCKET else None
+    try:
+        count = 0
+        try:
+            for doc, vector in pipeline.iter_embedded(documents):
+                count += 1
+                document = {
+                    "text": doc.page_content,
+                    "metadata": doc.metadata,
+                    "page_content": doc.page_content,
+                    "vector_field": vector
+                }
+                writer.add(document, doc.metadata.get('key'))
+                if snapshot is not None:
+                    snapshot.add(doc.page_content, doc.metadata, vector)
+        except Exception:
+            # The documents are a stream, a scan or embedding error surfaces here
+            writer.close()
+            if alias is not None:
+                print(f"Indexing failed, deleting incomplete generation {index}, {alias} unchanged")
+                client.indices.delete(index=index)
+            raise
+        # A full reindex sees every document, the vectors of contents that no longer exist are dropped
+        cache.save(prune=True)
 
+        summary = writer.close()
+        if count == 0:
+            if alias is not None:
+                client.indices.delete(index=index)
+            print("No documents to index")
+            return None
+        failures = summary['failed'] > 0
         if failures:
-            print(f"Bulk indexing had errors: {response}")
+            print(f"Bulk indexing had {summary['failed']} failed documents: {summary['errors']}")
+        elif summary['replaced']:
+            # Every document of a full reindex has its own key, an overwrite means a document was lost
+            print(f"{summary['replaced']} documents were written under the _id of another document, their metadata.key is not unique")
+            failures = True
+        elif alias is not None and not wait_for_count(index, summary['indexed'], client):
+            failures = True
         else:
-            print(f"Successfully indexed {len(documents)} documents")
+            print(f"Successfully indexed {summary['indexed']} documents")
+            if alias is not None:
+                try:
+                    swap_alias(alias, index, client)
+                except Exception:
+                    print(f"Could not move {alias} to {index}, deleting the new generation")
+                    client.indices.delete(index=index)
+                    raise
+                try:
+                    delete_old_generations(alias, client)
+                except Exception as e:
+                    print(f"Could not delete the old generations of {alias}: {str(e)}")
+            if snapshot is not None:
+                snapshot.close()
 
-        return response
-    print("No documents to index")
-    return None
+        if failures and alias is not None:
+            # The alias still points at the previous generation, queries are not affected
+            print(f"Deleting incomplete generation {index}, {alias} unchanged")
+            client.indices.delete(index=index)
+        return summary
+    finally:
+        if snapshot is not None:
+            # The staged partitions are removed whether the snapshot was written or not
+            snapshot.abort()
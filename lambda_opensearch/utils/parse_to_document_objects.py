@@ -4,9 +4,20 @@ from utils.general_utils import *
 from utils.content_construction import *
 logger = logging.getLogger(__name__)
 
-def parse_to_document_objects(metadata):
+def iter_document_objects(metadata, key_names=()):
+    """
+
+    Converting the snippets to Document objects as they are read. The snippet documents are yielded
+    one by one, the program and course documents once all the snippets have been read.
+
+    Args:
+        metadata (iterable): The snippet items, e.g. a ParallelScan
+        key_names (tuple): The key attribute names of the table, e.g. ParallelScan.key_names, the snippet documents carry their table key in metadata.key
+
+    Returns:
+        generator: The Document objects
+    """
     logger.info("Converting metadata to Document objects")
-    documents = []
     programs_en = {}
     programs_fr = {}
     program_info_en = {}
@@ -57,12 +68,16 @@ def parse_to_document_objects(metadata):
             
             if french_doc != None:
                 french_doc.metadata['last_modified'] = snippet.get('modified')
-                documents.extend([french_doc])
+                if key_names:
+                    french_doc.metadata['key'] = snippet_key(snippet, key_names, 'fr')
+                yield french_doc
                 logger.info(f"Converted snippet {french_data.get("title")} to Document object")
             
             if english_doc != None:
                 english_doc.metadata['last_modified'] = snippet.get('modified')
-                documents.extend([english_doc])
+                if key_names:
+                    english_doc.metadata['key'] = snippet_key(snippet, key_names, 'en')
+                yield english_doc
                 logger.info(f"Converted snippet {english_data.get("title")} to Document object")
         except Exception as e:
             logger.error(f"Document conversion failed: {str(e)}", exc_info=True)
@@ -71,8 +86,10 @@ def parse_to_document_objects(metadata):
     specific_program_fr = create_content_for_specific_course(program_info_fr, language='fr')
     overall_en = create_overall_snippet_courses_en(programs_en)
     overall_fr = create_overall_snippet_courses_fr(programs_fr)
-    documents.extend(specific_program_en)
-    documents.extend(specific_program_fr)
-    documents.extend([overall_en])
-    documents.extend([overall_fr])
-    return documents
\ No newline at end of file
+    yield from specific_program_en
+    yield from specific_program_fr
+    yield overall_en
+    yield overall_fr
+
+def parse_to_document_objects(metadata, key_names=()):
+    return list(iter_document_objects(metadata, key_names))
@@ -0,0 +1,88 @@
+import os
+import time
+import boto3
+
+# Event source mapping of the stream handler (cron_lambda_opensearch/stream_function.py) on the snippets
+# table stream, paused while a full reindex builds the next generation
+STREAM_EVENT_SOURCE_UUID = os.environ.get('STREAM_EVENT_SOURCE_UUID')
+STREAM_PAUSE_TIMEOUT_SECONDS = int(os.environ.get('STREAM_PAUSE_TIMEOUT_SECONDS', '300'))
+# Tag set on the mapping while a reindex holds it disabled
+STREAM_PAUSE_TAG = os.environ.get('STREAM_PAUSE_TAG', 'paused-by-full-reindex')
+
+def _set_enabled(enabled, lambda_client=None, timeout=STREAM_PAUSE_TIMEOUT_SECONDS):
+    lambda_client = lambda_client or boto3.client('lambda')
+    lambda_client.update_event_source_mapping(UUID=STREAM_EVENT_SOURCE_UUID, Enabled=enabled)
+    expected = 'Enabled' if enabled else 'Disabled'
+    deadline = time.monotonic() + timeout
+    while True:
+        state = lambda_client.get_event_source_mapping(UUID=STREAM_EVENT_SOURCE_UUID)['State']
+        if state == expected:
+            print(f"Stream event source mapping {STREAM_EVENT_SOURCE_UUID} {state.lower()}")
+            return
+        if time.monotonic() >= deadline:
+            raise Exception(f"Stream event source mapping {STREAM_EVENT_SOURCE_UUID} still {state} after {timeout} seconds")
+        time.sleep(2)
+
+def _pause_marker(lambda_client):
+    mapping = lambda_client.get_event_source_mapping(UUID=STREAM_EVENT_SOURCE_UUID)
+    arn = mapping['EventSourceMappingArn']
+    tags = lambda_client.list_tags(Resource=arn).get('Tags', {})
+    return mapping['State'], arn, STREAM_PAUSE_TAG in tags
+
+def pause_stream_consumer(lambda_client=None):
+    """
+
+    Pause the stream handler before a full reindex scans the table. The stream records written meanwhile
+    stay in the stream, and are applied to the new generation once the consumer is resumed after the
+    swap. A batch still running when the mapping is disabled only carries changes made before the scan
+    starts, which the scan reads as well.
+
+    The mapping is tagged with STREAM_PAUSE_TAG before it is disabled. A reindex stopped by the Lambda
+    timeout never reaches its resume, the tag is still set at the next run, which takes the pause over
+    and resumes the mapping when it finishes. A mapping disabled without the tag was disabled by an
+    operator and is left disabled.
+
+    Args:
+        lambda_client: The Lambda client
+
+    Returns:
+        bool: True if the consumer is paused by a reindex and has to be resumed, False if no
+        STREAM_EVENT_SOURCE_UUID is configured or it was disabled by an operator
+    """
+    if not STREAM_EVENT_SOURCE_UUID:
+        return False
+    lambda_client = lambda_client or boto3.client('lambda')
+    state, arn, marked = _pause_marker(lambda_client)
+    if state == 'Disabled':
+        if marked:
+            print(f"Stream event source mapping {STREAM_EVENT_SOURCE_UUID} still paused by an earlier reindex, taken over")
+            return True
+        print(f"Stream event source mapping {STREAM_EVENT_SOURCE_UUID} disabled by an operator, left as is")
+        return False
+    # The marker is set first, a run stopped between the two calls still finds it
+    lambda_client.tag_resource(Resource=arn, Tags={STREAM_PAUSE_TAG: str(int(time.time()))})
+    try:
+        _set_enabled(False, lambda_client)
+    except Exception:
+        # The reindex does not start, the consumer must not stay disabled
+        resume_stream_consumer(lambda_client)
+        raise
+    return True
+
+def resume_stream_consumer(lambda_client=None):
+    """
+
+    Resume the stream handler and clear the pause marker, it continues from the last record it
+    processed. The stream keeps records for 24 hours, a consumer paused longer loses them and the cron
+    run reconciles the changes.
+
+    Args:
+        lambda_client: The Lambda client
+    """
+    if not STREAM_EVENT_SOURCE_UUID:
+        return
+    lambda_client = lambda_client or boto3.client('lambda')
+    _set_enabled(True, lambda_client)
+    # Cleared only once the mapping is enabled, a failed resume is retried by the next run
+    arn = lambda_client.get_event_source_mapping(UUID=STREAM_EVENT_SOURCE_UUID)['EventSourceMappingArn']
+    lambda_client.untag_resource(Resource=arn, TagKeys=[STREAM_PAUSE_TAG])
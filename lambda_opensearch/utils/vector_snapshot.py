@@ -0,0 +1,414 @@
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import uuid
+import boto3
+import numpy as np
+from botocore.exceptions import ClientError
+
+VECTOR_SNAPSHOT_BUCKET = os.environ.get('VECTOR_SNAPSHOT_BUCKET')
+VECTOR_SNAPSHOT_PREFIX = os.environ.get('VECTOR_SNAPSHOT_PREFIX', 'vector_snapshot')
+# Local directory where the partitions are staged before the upload, the Lambda ephemeral storage
+VECTOR_SNAPSHOT_TMP_DIR = os.environ.get('VECTOR_SNAPSHOT_TMP_DIR', '/tmp')
+# Deltas appended to the manifest before the updates compact them into a new base version
+VECTOR_SNAPSHOT_MAX_DELTAS = int(os.environ.get('VECTOR_SNAPSHOT_MAX_DELTAS', '20'))
+# Unreferenced versions and deltas are deleted once older than this, readers may still be downloading them
+VECTOR_SNAPSHOT_RETENTION_SECONDS = int(os.environ.get('VECTOR_SNAPSHOT_RETENTION_SECONDS', '3600'))
+VECTOR_SNAPSHOT_COMMIT_ATTEMPTS = int(os.environ.get('VECTOR_SNAPSHOT_COMMIT_ATTEMPTS', '5'))
+# Vectors copied to the .npy file per chunk, bounds the memory of the conversion
+CONVERT_CHUNK_ROWS = 4096
+
+# The manifest changed since it was read (412), or another conditional write is in progress (409)
+CONFLICT_CODES = {'PreconditionFailed', 'ConditionalRequestConflict', '412', '409'}
+
+def _put(s3_client, key, body):
+    s3_client.put_object(Bucket=VECTOR_SNAPSHOT_BUCKET, Key=f"{VECTOR_SNAPSHOT_PREFIX}/{key}", Body=body)
+
+def _upload(s3_client, key, path):
+    # Streamed from disk, in multipart uploads for the large partitions
+    s3_client.upload_file(path, VECTOR_SNAPSHOT_BUCKET, f"{VECTOR_SNAPSHOT_PREFIX}/{key}")
+
+def _get(s3_client, key):
+    response = s3_client.get_object(Bucket=VECTOR_SNAPSHOT_BUCKET, Key=f"{VECTOR_SNAPSHOT_PREFIX}/{key}")
+    return response['Body'].read()
+
+def _new_name():
+    # Unique even for writers starting within the same second, and sorted by time
+    return f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+
+def read_manifest(s3_client):
+    """
+
+    Read the manifest of the vector snapshot with its ETag
+
+    Args:
+        s3_client: The S3 client
+
+    Returns:
+        tuple: The manifest and its ETag, (None, None) if there is no snapshot
+    """
+    try:
+        response = s3_client.get_object(Bucket=VECTOR_SNAPSHOT_BUCKET, Key=f"{VECTOR_SNAPSHOT_PREFIX}/manifest.json")
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None, None
+        raise
+    manifest = json.loads(response['Body'].read())
+    manifest.setdefault('deltas', [])
+    return manifest, response['ETag']
+
+def _put_manifest(s3_client, manifest, etag=None):
+    # With an ETag the manifest is only replaced if nobody wrote it since it was read
+    params = {}
+    if etag is not None:
+        params['IfMatch'] = etag
+    try:
+        s3_client.put_object(
+            Bucket=VECTOR_SNAPSHOT_BUCKET,
+            Key=f"{VECTOR_SNAPSHOT_PREFIX}/manifest.json",
+            Body=json.dumps(manifest).encode('utf-8'),
+            **params
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] in CONFLICT_CODES:
+            return False
+        raise
+    return True
+
+def collect_garbage(s3_client, manifest, retention=VECTOR_SNAPSHOT_RETENTION_SECONDS):
+    """
+
+    Delete the versions and deltas the manifest no longer references, once older than the retention
+
+    Args:
+        s3_client: The S3 client
+        manifest (dict): The manifest just written
+        retention (int): Seconds an unreferenced version is kept, for readers still downloading it and
+            for deltas uploaded but not committed yet
+
+    Returns:
+        int: The number of objects deleted
+    """
+    referenced = {manifest['version']} | {delta['id'] for delta in manifest.get('deltas', [])}
+    cutoff = time.time() - retention
+    keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=VECTOR_SNAPSHOT_BUCKET, Prefix=f"{VECTOR_SNAPSHOT_PREFIX}/"):
+        for item in page.get('Contents', []):
+            parts = item['Key'][len(VECTOR_SNAPSHOT_PREFIX) + 1:].split('/', 1)
+            if len(parts) < 2 or parts[0] in referenced or item['LastModified'].timestamp() > cutoff:
+                continue
+            keys.append(item['Key'])
+    for start in range(0, len(keys), 1000):
+        s3_client.delete_objects(
+            Bucket=VECTOR_SNAPSHOT_BUCKET,
+            Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]], 'Quiet': True}
+        )
+    if keys:
+        print(f"Deleted {len(keys)} objects of unreferenced snapshot versions")
+    return len(keys)
+
+class SnapshotWriter:
+    def __init__(self, s3_client=None, tmp_dir=VECTOR_SNAPSHOT_TMP_DIR):
+        """
+
+        Streaming writer of a vector snapshot version or delta. Each entry is appended to partition files
+        under tmp_dir, the raw float32 vectors and the documents as JSON lines, so a full reindex never holds
+        the vectors in memory. The partitions are converted to .npy files and uploaded under a unique name,
+        the manifest is written last, so readers only see complete versions: close() writes a new base
+        version, close_delta() appends the documents to the current version as a delta.
+
+        Args:
+            s3_client: The S3 client
+            tmp_dir (str): The directory where the partitions are staged
+        """
+        self.s3_client = s3_client or boto3.client('s3')
+        self.directory = tempfile.mkdtemp(prefix='vector_snapshot_', dir=tmp_dir)
+        self.partitions = {}
+        self.count = 0
+        self.ids = set()
+
+    def _partition(self, language, dimension):
+        partition = self.partitions.get(language)
+        if partition is None:
+            partition = {
+                "vectors": open(os.path.join(self.directory, f"{language}_vectors.f32"), 'wb'),
+                "documents": open(os.path.join(self.directory, f"{language}_documents.jsonl"), 'w', encoding='utf-8'),
+                "dimension": dimension,
+                "count": 0,
+            }
+            self.partitions[language] = partition
+        elif partition["dimension"] != dimension:
+            raise ValueError(f"Vector of dimension {dimension} in the {language} partition of dimension {partition['dimension']}")
+        return partition
+
+    def add(self, page_content, metadata, vector):
+        """
+
+        Append a document and its vector to the partition of its language
+
+        Args:
+            page_content (str): The content of the document
+            metadata (dict): The metadata of the document, its language selects the partition
+            vector (list): The embedding of the document
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        partition = self._partition(metadata.get('language', 'unknown'), vector.shape[0])
+        partition["vectors"].write(vector.tobytes())
+        if partition["count"]:
+            partition["documents"].write("\n")
+        partition["documents"].write(json.dumps({"page_content": page_content, "metadata": metadata}, ensure_ascii=False))
+        partition["count"] += 1
+        self.count += 1
+        if metadata.get('id'):
+            self.ids.add(metadata['id'])
+
+    def _convert(self, language, partition):
+        # The raw vectors become the .npy file and its norms, a chunk at a time
+        raw_path = partition["vectors"].name
+        vectors_path = os.path.join(self.directory, f"{language}_vectors.npy")
+        norms_path = os.path.join(self.directory, f"{language}_norms.npy")
+        shape = (partition["count"], partition["dimension"])
+        raw = np.memmap(raw_path, dtype=np.float32, mode='r', shape=shape)
+        vectors = np.lib.format.open_memmap(vectors_path, mode='w+', dtype=np.float32, shape=shape)
+        norms = np.empty(shape[0], dtype=np.float32)
+        for start in range(0, shape[0], CONVERT_CHUNK_ROWS):
+            chunk = raw[start:start + CONVERT_CHUNK_ROWS]
+            vectors[start:start + CONVERT_CHUNK_ROWS] = chunk
+            norms[start:start + CONVERT_CHUNK_ROWS] = np.einsum('ij,ij->i', chunk, chunk)
+        vectors.flush()
+        del raw, vectors
+        os.remove(raw_path)
+        np.save(norms_path, norms)
+        return vectors_path, norms_path
+
+    def _upload_partitions(self, name):
+        languages = {}
+        for language, partition in self.partitions.items():
+            partition["vectors"].close()
+            partition["documents"].close()
+            vectors_path, norms_path = self._convert(language, partition)
+            files = {
+                "vectors": f"{language}_vectors.npy",
+                "norms": f"{language}_norms.npy",
+                "documents": f"{language}_documents.jsonl",
+            }
+            _upload(self.s3_client, f"{name}/{files['vectors']}", vectors_path)
+            _upload(self.s3_client, f"{name}/{files['norms']}", norms_path)
+            _upload(self.s3_client, f"{name}/{files['documents']}", partition["documents"].name)
+            languages[language] = files
+        return languages
+
+    def close(self, etag=None):
+        """
+
+        Upload the partitions as a new base version and point the manifest at it, dropping the deltas.
+        The versions no longer referenced are then garbage collected. The staged files are removed.
+
+        Args:
+            etag (str): Only replace the manifest if it still has this ETag, None to replace it anyway
+
+        Returns:
+            str: The version written, None if the manifest changed since etag
+        """
+        try:
+            version = _new_name()
+            manifest = {"version": version, "languages": self._upload_partitions(version), "deltas": []}
+            if not _put_manifest(self.s3_client, manifest, etag):
+                print(f"Vector snapshot manifest changed meanwhile, version {version} not used")
+                return None
+            print(f"Wrote vector snapshot {version} with {self.count} documents")
+            try:
+                collect_garbage(self.s3_client, manifest)
+            except Exception as e:
+                print(f"Could not delete the old vector snapshot versions: {str(e)}")
+            return version
+        finally:
+            self.abort()
+
+    def close_delta(self, metadata_ids_to_delete):
+        """
+
+        Upload the partitions as a delta and append it to the manifest, with a conditional put retried
+        until no other writer changed the manifest in between. Readers drop the documents of the previous
+        version and deltas whose metadata.id the delta deletes or holds. The staged files are removed.
+
+        Args:
+            metadata_ids_to_delete (set): The metadata.id of the documents replaced or removed
+
+        Returns:
+            dict: The manifest committed, None if there is no snapshot to update or nothing changed
+        """
+        try:
+            deleted = sorted(set(metadata_ids_to_delete) | self.ids)
+            if not deleted:
+                return None
+            manifest, etag = read_manifest(self.s3_client)
+            if manifest is None:
+                print("No vector snapshot to update, run the full reindex to create it")
+                return None
+            name = _new_name()
+            delta = {"id": name, "languages": self._upload_partitions(name), "deleted": deleted}
+            for attempt in range(VECTOR_SNAPSHOT_COMMIT_ATTEMPTS):
+                if attempt:
+                    time.sleep(random.uniform(0, 0.2 * 2 ** attempt))
+                    manifest, etag = read_manifest(self.s3_client)
+                    if manifest is None:
+                        print("Vector snapshot removed meanwhile, delta not committed")
+                        return None
+                manifest["deltas"].append(delta)
+                if _put_manifest(self.s3_client, manifest, etag):
+                    print(f"Appended delta {name} to vector snapshot {manifest['version']} with {self.count} documents and {len(deleted)} ids replaced")
+                    return manifest
+            # Raised so the changes are retried, the uploaded delta is garbage collected
+            raise Exception(f"Could not commit delta {name} after {VECTOR_SNAPSHOT_COMMIT_ATTEMPTS} attempts, the manifest kept changing")
+        finally:
+            self.abort()
+
+    def abort(self):
+        """
+
+        Remove the staged files without writing anything, safe to call after close()
+        """
+        for partition in self.partitions.values():
+            partition["vectors"].close()
+            partition["documents"].close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def write_snapshot(entries, s3_client=None):
+    """
+
+    Write a new version of the vector snapshot read by the orchestrator, one partition per language.
+    The partitions are written first and the manifest last, so readers only see complete versions.
+
+    Args:
+        entries (iterable): (page_content, metadata, vector) tuples
+        s3_client: The S3 client
+
+    Returns:
+        str: The version written, None if no snapshot bucket is configured
+    """
+    if not VECTOR_SNAPSHOT_BUCKET:
+        return None
+    writer = SnapshotWriter(s3_client)
+    try:
+        for page_content, metadata, vector in entries:
+            writer.add(page_content, metadata, vector)
+    except Exception:
+        writer.abort()
+        raise
+    return writer.close()
+
+def iter_snapshot(manifest, s3_client=None):
+    """
+
+    Iterate the documents of a snapshot: the base version and its deltas in order, without the documents
+    a later delta deleted or replaced
+
+    Args:
+        manifest (dict): The manifest of the snapshot
+        s3_client: The S3 client
+
+    Returns:
+        generator: (page_content, metadata, vector) tuples
+    """
+    s3_client = s3_client or boto3.client('s3')
+    segments = [(manifest['version'], manifest['languages'], [])]
+    segments += [(delta['id'], delta['languages'], delta['deleted']) for delta in manifest.get('deltas', [])]
+    # The ids deleted by the deltas after each segment
+    deleted_after = []
+    deleted = set()
+    for _, _, segment_deleted in reversed(segments):
+        deleted_after.append(set(deleted))
+        deleted |= set(segment_deleted)
+    deleted_after.reverse()
+
+    for (name, languages, _), deleted in zip(segments, deleted_after):
+        for files in languages.values():
+            vectors = np.load(io.BytesIO(_get(s3_client, f"{name}/{files['vectors']}")))
+            lines = _get(s3_client, f"{name}/{files['documents']}").decode('utf-8').splitlines()
+            documents = [json.loads(line) for line in lines if line.strip()]
+            for document, vector in zip(documents, vectors):
+                if document["metadata"].get('id') not in deleted:
+                    yield document["page_content"], document["metadata"], vector
+
+def read_snapshot(s3_client=None):
+    """
+
+    Read the current vector snapshot, the base version merged with its deltas
+
+    Args:
+        s3_client: The S3 client
+
+    Returns:
+        list: (page_content, metadata, vector) tuples, None if there is no snapshot
+    """
+    if not VECTOR_SNAPSHOT_BUCKET:
+        return None
+    s3_client = s3_client or boto3.client('s3')
+    manifest, _ = read_manifest(s3_client)
+    if manifest is None:
+        return None
+    return list(iter_snapshot(manifest, s3_client))
+
+def compact_snapshot(s3_client=None):
+    """
+
+    Merge the deltas into a new base version. The manifest is replaced only if no delta was appended
+    meanwhile, otherwise the compaction is left to a later update.
+
+    Args:
+        s3_client: The S3 client
+
+    Returns:
+        str: The version written, None if there was nothing to compact or the manifest changed
+    """
+    if not VECTOR_SNAPSHOT_BUCKET:
+        return None
+    s3_client = s3_client or boto3.client('s3')
+    manifest, etag = read_manifest(s3_client)
+    if manifest is None or not manifest['deltas']:
+        return None
+    writer = SnapshotWriter(s3_client)
+    try:
+        for page_content, metadata, vector in iter_snapshot(manifest, s3_client):
+            writer.add(page_content, metadata, vector)
+    except Exception:
+        writer.abort()
+        raise
+    print(f"Compacting {len(manifest['deltas'])} deltas into a new vector snapshot version")
+    return writer.close(etag)
+
+def update_snapshot(snapshot, metadata_ids_to_delete, s3_client=None):
+    """
+
+    Append the updated documents to the vector snapshot as a delta, instead of rewriting it, and compact
+    the deltas once there are VECTOR_SNAPSHOT_MAX_DELTAS of them. Nothing is written when there is no
+    snapshot yet, as the changed documents alone would not be a complete index.
+
+    Args:
+        snapshot (SnapshotWriter): The writer holding the updated documents, None if there are none
+        metadata_ids_to_delete (set): The metadata.id of the documents replaced or removed
+        s3_client: The S3 client
+
+    Returns:
+        str: The delta written, None if nothing was written
+    """
+    if not VECTOR_SNAPSHOT_BUCKET:
+        return None
+    s3_client = s3_client or boto3.client('s3')
+    snapshot = snapshot or SnapshotWriter(s3_client)
+    manifest = snapshot.close_delta(metadata_ids_to_delete)
+    if manifest is None:
+        return None
+    if len(manifest['deltas']) >= VECTOR_SNAPSHOT_MAX_DELTAS:
+        try:
+            compact_snapshot(s3_client)
+        except Exception as e:
+            # The delta is committed, a later update compacts again
+            print(f"Could not compact the vector snapshot: {str(e)}")
+    return manifest['deltas'][-1]['id']
@@ -0,0 +1,138 @@
+"""
+Project:
+Dialectic Snippet Bot
+
+Purpose:
+Compare time to first token between rephrasing with the main model and with a separate contextualizer model.
+
+Comments:
+Replays recorded conversations (JSON lines, see conversations.sample.jsonl) through the retrieval chain
+twice per turn, once per setup, interleaved so both see the same Bedrock and OpenSearch conditions. Only
+turns with chat history are replayed, as the rephrase step is skipped without history. The history is
+passed in directly, nothing is read from or written to DynamoDB. Needs the same environment as the
+Lambda (MODEL_NAME, TEMPERATURE, OPENSEARCH_URL, OPENSEARCH_INDEX, REGION, EMBEDDING_MODEL, PROMPTS_*).
+
+Run from langchain_orchestrator/:
+python -m benchmarks.contextualizer_ttft --conversations benchmarks/conversations.sample.jsonl --contextualizer-model <model id>
+"""
+
+import argparse
+import asyncio
+import json
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+from llm_utils import chain_factory as factory
+from llm_utils.history_aware import contextualize_program_prompt, contextualize_q_prompt
+from llm_utils.qa_chat import create_program_prompt, create_snippet_prompt
+from llm_utils.tracing import RequestTrace, StageTracer
+
+def load_conversations(path: str) -> List[Dict[str, Any]]:
+    """
+    Load the recorded turns that have chat history.
+
+    Args:
+        path: JSON lines of {"language", "type_of_chat", "history": [{"role", "content"}], "input"}
+
+    Returns:
+        List: The turns to replay
+    """
+    with open(path, encoding="utf-8") as f:
+        turns = [json.loads(line) for line in f if line.strip()]
+    return [turn for turn in turns if turn.get("history")]
+
+def to_messages(history: List[Dict[str, str]]) -> list:
+    return [
+        HumanMessage(content=message["content"]) if message["role"] == "human" else AIMessage(content=message["content"])
+        for message in history
+    ]
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))], 1)
+
+async def run_turn(chain, turn: Dict[str, Any], setup: str, full: bool) -> Dict[str, Any]:
+    """
+    Replay one turn and return its trace summary.
+
+    Args:
+        chain: The retrieval chain of the setup
+        turn: The recorded turn
+        setup: The setup name, used as trace dimension
+        full: Stream the whole answer instead of stopping at the first token
+
+    Returns:
+        Dict: The trace summary
+    """
+    trace = RequestTrace(setup=setup)
+    inputs = {"input": turn["input"], "chat_history": to_messages(turn["history"])}
+    stream = chain.astream(inputs, config={"callbacks": [StageTracer(trace)]})
+    try:
+        async for chunk in stream:
+            if chunk.get("answer"):
+                trace.mark_first_token()
+                if not full:
+                    break
+    finally:
+        await stream.aclose()
+    return trace.summary()
+
+async def main_async(args: argparse.Namespace) -> Dict[str, Any]:
+    turns = load_conversations(args.conversations)
+    llm = factory.init_llm()
+    setups = {
+        "single_model": None,
+        "split_model": factory.init_contextualizer_llm(args.contextualizer_model),
+    }
+    chains = {}
+    for turn in turns:
+        key = (turn.get("language", "en"), turn.get("type_of_chat", "chat"))
+        if key in chains:
+            continue
+        language, type_of_chat = key
+        retriever = factory.build_retriever(language)
+        if type_of_chat == "program":
+            prompts = (contextualize_program_prompt, create_program_prompt(language))
+        else:
+            prompts = (contextualize_q_prompt, create_snippet_prompt(language))
+        chains[key] = {
+            setup: factory.build_rag_chain(retriever, llm, prompts[0], prompts[1], contextualizer_llm)
+            for setup, contextualizer_llm in setups.items()
+        }
+
+    results: Dict[str, Dict[str, List[float]]] = {setup: {"ttft_ms": [], "rephrase_ms": []} for setup in setups}
+    for _ in range(args.repeat):
+        for turn in turns:
+            key = (turn.get("language", "en"), turn.get("type_of_chat", "chat"))
+            for setup in setups:
+                summary = await run_turn(chains[key][setup], turn, setup, args.full)
+                if summary["ttft_ms"] is not None:
+                    results[setup]["ttft_ms"].append(summary["ttft_ms"])
+                if "rephrase" in summary["stages"]:
+                    results[setup]["rephrase_ms"].append(summary["stages"]["rephrase"]["total_ms"])
+
+    report = {"turns": len(turns), "repeat": args.repeat, "contextualizer_model": args.contextualizer_model}
+    for setup, values in results.items():
+        report[setup] = {
+            metric: {"p50": percentile(samples, 50), "p95": percentile(samples, 95), "n": len(samples)}
+            for metric, samples in values.items()
+        }
+    return report
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compare TTFT of single-model and split-model rephrasing")
+    parser.add_argument("--conversations", required=True, help="JSON lines of recorded turns")
+    parser.add_argument("--contextualizer-model", default=factory.CONTEXTUALIZER_MODEL_NAME)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--full", action="store_true", help="Stream whole answers, not only the first token")
+    args = parser.parse_args()
+    if not args.contextualizer_model:
+        parser.error("--contextualizer-model or CONTEXTUALIZER_MODEL_NAME is required")
+    print(json.dumps(asyncio.run(main_async(args)), indent=2))
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,364 @@
+"""
+Project:
+Dialectic Snippet Bot
+
+Purpose:
+Local stand-ins for the AWS services the orchestrator calls, for the load test.
+
+Comments:
+- FakeStreamingChatModel streams like ChatBedrock, with a configurable time to first token and token rate;
+- FakeEmbeddings returns deterministic unit vectors of the Titan v2 size;
+- InMemoryOpenSearch stores documents in the index schema of the indexers (text, metadata, page_content,
+  vector_field), answers kNN searches with the l2 score of OpenSearch and the term/prefix lookups of the
+  intent router;
+- FakeTable implements the DynamoDB calls of the connections and history tables, including the
+  conditional put on Version;
+- RecordingApiGateway records every post_to_connection frame, with an injected latency.
+Every fake counts its calls in CALL_COUNTS.
+"""
+
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, Iterator, AsyncIterator, List, Optional, Tuple
+
+import numpy as np
+from boto3.dynamodb.types import Binary
+from botocore.exceptions import ClientError
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.vectorstores import VectorStore
+
+CALL_COUNTS: Counter = Counter()
+_counts_lock = threading.Lock()
+
+def count_call(name: str) -> None:
+    with _counts_lock:
+        CALL_COUNTS[name] += 1
+
+def reset_call_counts() -> None:
+    with _counts_lock:
+        CALL_COUNTS.clear()
+
+class FakeStreamingChatModel(BaseChatModel):
+    """
+    Chat model streaming a fixed number of tokens after a fixed delay. Contextualize prompts
+    (rephrasing a follow-up question) get the last question back, after the same delay.
+    """
+
+    ttft_ms: float = 400.0
+    tokens_per_second: float = 60.0
+    answer_tokens: int = 200
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming-bedrock"
+
+    def _is_rephrase(self, messages: List[BaseMessage]) -> bool:
+        return any(isinstance(message, SystemMessage) and "standalone question" in message.content for message in messages)
+
+    def _rephrased(self, messages: List[BaseMessage]) -> str:
+        questions = [message.content for message in messages if isinstance(message, HumanMessage)]
+        return questions[-1] if questions else ""
+
+    def _tokens(self) -> Iterator[str]:
+        for i in range(self.answer_tokens):
+            yield f"token{i} "
+
+    def _generate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        count_call("bedrock.converse")
+        time.sleep(self.ttft_ms / 1000)
+        if self._is_rephrase(messages):
+            text = self._rephrased(messages)
+        else:
+            time.sleep(self.answer_tokens / self.tokens_per_second)
+            text = "".join(self._tokens())
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        count_call("bedrock.converse")
+        await asyncio.sleep(self.ttft_ms / 1000)
+        if self._is_rephrase(messages):
+            text = self._rephrased(messages)
+        else:
+            await asyncio.sleep(self.answer_tokens / self.tokens_per_second)
+            text = "".join(self._tokens())
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _astream(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        count_call("bedrock.converse_stream")
+        await asyncio.sleep(self.ttft_ms / 1000)
+        tokens = [self._rephrased(messages)] if self._is_rephrase(messages) else self._tokens()
+        for token in tokens:
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager is not None:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+            await asyncio.sleep(1 / self.tokens_per_second)
+
+class FakeEmbeddings(Embeddings):
+    def __init__(self, size: int = 1024, latency_ms: float = 0.0):
+        """
+
+        Deterministic unit vectors derived from the text, so equal texts get equal vectors
+
+        Args:
+            size: The vector size, 1024 like Titan v2
+            latency_ms: Injected latency per call
+        """
+        self.size = size
+        self.latency_ms = latency_ms
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.size).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        count_call("bedrock.embed")
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        return self._vector(text)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+def _field(source: Dict[str, Any], path: str) -> Any:
+    value: Any = source
+    for part in path.removesuffix(".keyword").split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+def _matches(source: Dict[str, Any], query: Optional[Dict[str, Any]]) -> bool:
+    if not query:
+        return True
+    if "term" in query:
+        (path, value), = query["term"].items()
+        return _field(source, path) == value
+    if "prefix" in query:
+        (path, value), = query["prefix"].items()
+        return str(_field(source, path) or "").startswith(value)
+    if "bool" in query:
+        clauses = query["bool"].get("filter", []) + query["bool"].get("must", [])
+        return all(_matches(source, clause) for clause in clauses)
+    raise ValueError(f"Unsupported query {query}")
+
+class InMemoryOpenSearch(VectorStore):
+    def __init__(self, embedding: Embeddings, latency_ms: float = 0.0):
+        """
+
+        In-memory index with the schema written by the indexers
+
+        Args:
+            embedding: The embedding function of the queries and documents
+            latency_ms: Injected latency per search
+        """
+        self._embedding = embedding
+        self.latency_ms = latency_ms
+        self.sources: List[Dict[str, Any]] = []
+        self._vectors: Optional[np.ndarray] = None
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs) -> List[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = self._embedding.embed_documents(texts)
+        for text, metadata, vector in zip(texts, metadatas, vectors):
+            self.sources.append({"text": text, "metadata": metadata, "page_content": text, "vector_field": vector})
+        self._vectors = np.asarray([source["vector_field"] for source in self.sources], dtype=np.float32)
+        return [str(i) for i in range(len(self.sources) - len(texts), len(self.sources))]
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None, **kwargs) -> "InMemoryOpenSearch":
+        store = cls(embedding)
+        store.add_texts(texts, metadatas)
+        return store
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: Optional[Dict[str, Any]] = None, **kwargs) -> List[Tuple[Document, float]]:
+        count_call("opensearch.knn")
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        query_vector = np.asarray(self._embedding.embed_query(query), dtype=np.float32)
+        candidates = [i for i, source in enumerate(self.sources) if _matches(source, filter)]
+        if not candidates:
+            return []
+        distances = ((self._vectors[candidates] - query_vector) ** 2).sum(axis=1)
+        best = np.argsort(distances)[:k]
+        metadata_field = kwargs.get("metadata_field", "metadata")
+        results = []
+        for i in best:
+            source = self.sources[candidates[i]]
+            metadata = dict(source) if metadata_field == "*" else source["metadata"]
+            results.append((Document(page_content=source["text"], metadata=metadata), 1.0 / (1.0 + float(distances[i]))))
+        return results
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def search(self, index: Optional[str] = None, body: Optional[Dict[str, Any]] = None, **kwargs) -> Dict[str, Any]:
+        # The subset of the OpenSearch client search API used for the aggregate lookups
+        count_call("opensearch.search")
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        body = body or {}
+        hits = [source for source in self.sources if _matches(source, body.get("query"))][:body.get("size", 10)]
+        return {"hits": {"hits": [{"_source": {"page_content": source["page_content"], "metadata": source["metadata"]}} for source in hits]}}
+
+    def count(self, index: Optional[str] = None, **kwargs) -> Dict[str, int]:
+        count_call("opensearch.count")
+        return {"count": len(self.sources)}
+
+    @property
+    def indices(self) -> "FakeIndices":
+        return FakeIndices()
+
+class FakeIndices:
+    def get(self, index: str, **kwargs) -> Dict[str, Any]:
+        # The concrete index behind the alias, used to resolve the index generation
+        count_call("opensearch.indices.get")
+        return {f"{index}-fake": {"settings": {"index": {"uuid": "fake"}}}}
+
+_CONDITION = re.compile(r"attribute_not_exists\((#\w+)\) OR (#\w+) = (:\w+)")
+
+class FakeTable:
+    def __init__(self, name: str, key_name: str, latency_ms: float = 0.0):
+        """
+
+        In-memory DynamoDB table with the calls used by the orchestrator
+
+        Args:
+            name: The table name, used in the call counts
+            key_name: The partition key
+            latency_ms: Injected latency per call
+        """
+        self.name = name
+        self.key_name = key_name
+        self.latency_ms = latency_ms
+        self.items: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _call(self, operation: str) -> None:
+        count_call(f"dynamodb.{self.name}.{operation}")
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def get_item(self, Key: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        self._call("get_item")
+        with self._lock:
+            item = self.items.get(Key[self.key_name])
+        if item is None:
+            return {}
+        # boto3 returns binary attributes as Binary
+        return {"Item": {key: Binary(value) if isinstance(value, bytes) else value for key, value in item.items()}}
+
+    def put_item(self, Item: Dict[str, Any], ConditionExpression: Optional[str] = None,
+                 ExpressionAttributeNames: Optional[Dict[str, str]] = None,
+                 ExpressionAttributeValues: Optional[Dict[str, Any]] = None, **kwargs) -> Dict[str, Any]:
+        self._call("put_item")
+        with self._lock:
+            current = self.items.get(Item[self.key_name])
+            if ConditionExpression is not None:
+                match = _CONDITION.fullmatch(ConditionExpression)
+                if match is None:
+                    raise ValueError(f"Unsupported condition {ConditionExpression}")
+                attribute = ExpressionAttributeNames[match.group(1)]
+                expected = ExpressionAttributeValues[match.group(3)]
+                if current is not None and attribute in current and current[attribute] != expected:
+                    raise ClientError({"Error": {"Code": "ConditionalCheckFailedException", "Message": "Condition failed"}}, "PutItem")
+            self.items[Item[self.key_name]] = dict(Item)
+        return {}
+
+    def delete_item(self, Key: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        self._call("delete_item")
+        with self._lock:
+            self.items.pop(Key[self.key_name], None)
+        return {}
+
+class RecordingApiGateway:
+    class exceptions:
+        class GoneException(Exception):
+            pass
+
+    def __init__(self, latency_ms: float = 0.0):
+        """
+
+        API Gateway Management API stub recording every frame
+
+        Args:
+            latency_ms: Injected latency per post_to_connection
+        """
+        self.latency_ms = latency_ms
+        self.frames: Dict[str, List[Tuple[float, str, int]]] = {}
+        self.gone: set = set()
+        self._lock = threading.Lock()
+
+    def post_to_connection(self, ConnectionId: str, Data: bytes) -> Dict[str, Any]:
+        count_call("apigateway.post_to_connection")
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        if ConnectionId in self.gone:
+            raise self.exceptions.GoneException(ConnectionId)
+        frame_type = re.search(rb'"type": "(\w+)"', Data).group(1).decode()
+        with self._lock:
+            self.frames.setdefault(ConnectionId, []).append((time.perf_counter(), frame_type, len(Data)))
+        return {}
+
+    def frames_since(self, connection_id: str, since: float) -> List[Tuple[float, str, int]]:
+        with self._lock:
+            return [frame for frame in self.frames.get(connection_id, []) if frame[0] >= since]
+
+def build_corpus(store: InMemoryOpenSearch, programs: int = 4, snippets_per_program: int = 10,
+                 content_words: int = 600, languages: Tuple[str, ...] = ("en", "fr")) -> List[str]:
+    """
+    Index synthetic snippets and the aggregate documents of the indexers, in their text formats.
+
+    Args:
+        store: The store to index into
+        programs: The number of programs
+        snippets_per_program: The number of snippets per program
+        content_words: The number of words of the snippet contents (the PDF text)
+        languages: The languages, every snippet is indexed in each
+
+    Returns:
+        List: The snippet titles
+    """
+    titles = []
+    for language in languages:
+        texts, metadatas = [], []
+        courses: Counter = Counter()
+        for p in range(programs):
+            program = f"Program {p + 1}"
+            entries = []
+            for s in range(snippets_per_program):
+                title = f"Snippet {p + 1}.{s + 1}"
+                course = f"Course {s % 3 + 1}"
+                courses[course] += 1
+                content = " ".join(f"{title.split()[-1]}-word{w}" for w in range(content_words))
+                texts.append(
+                    f"Title: {title} \n Topic: Topic {s % 5 + 1} \n Course: {course} \n Program: {program} \n "
+                    f"Snippet URL: https://example.com/{language}/{p + 1}/{s + 1} \n Content: {content}"
+                )
+                metadatas.append({"id": f"{language}_{p + 1}_{s + 1}", "title": title, "course": course, "program": program, "language": language})
+                entries.append(
+                    f"Title: {title} \n Topic: Topic {s % 5 + 1} \n Snippet URL: https://example.com/{language}/{p + 1}/{s + 1} \n "
+                    f"Order: {s + 1} Go Deeper URLs: none \n Number of options for snippet: {s % 4 + 1} \n"
+                )
+                if language == languages[0]:
+                    titles.append(title)
+            texts.append(f"All Snippets for Program: {program} \n " + "".join(entries))
+            metadatas.append({"id": f"all_programs_{program}_{language}", "program": program, "language": language})
+        texts.append("".join(f"Course: {course}\n Number of snippets: {count}\n" for course, count in sorted(courses.items())))
+        metadatas.append({"id": f"all_courses_{language}", "language": language})
+        store.add_texts(texts, metadatas)
+    return titles
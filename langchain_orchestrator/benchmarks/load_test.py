@@ -0,0 +1,259 @@
+"""
+Project:
+Dialectic Snippet Bot
+
+Purpose:
+Load test of lambda_handler end to end, against local fakes of Bedrock, OpenSearch, DynamoDB and API Gateway.
+
+Comments:
+N simulated sessions run concurrently, each connects, sends M messages and disconnects through
+lambda_handler, exactly as API Gateway would invoke it. The sessions share one process, like warm
+containers sharing nothing but the fakes, so the load test measures the orchestrator overhead (routing,
+history, retrieval, packing, streaming) on top of the simulated model latency. See benchmarks/fakes.py
+for the fakes. The report gives p50/p95/p99 time to first token (first stream frame received by the
+stub) and total latency, the frames sent and the DynamoDB, Bedrock and OpenSearch call counts.
+
+As a regression gate, the run exits with 1 when a limit is exceeded:
+--max-p95-ttft-ms/--max-p95-total-ms/--max-errors, or --baseline with a report saved by --save, where
+p95 latencies and calls per message may not grow by more than --tolerance.
+
+Run from langchain_orchestrator/:
+python -m benchmarks.load_test --sessions 20 --turns 3 --save benchmarks/baseline.json
+python -m benchmarks.load_test --sessions 20 --turns 3 --baseline benchmarks/baseline.json
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+# The modules read their configuration at import time
+os.environ.setdefault("MODEL_NAME", "fake.model")
+os.environ.setdefault("TEMPERATURE", "0")
+os.environ.setdefault("OPENSEARCH_URL", "https://localhost:9200")
+os.environ.setdefault("OPENSEARCH_INDEX", "snippets")
+os.environ.setdefault("REGION", "us-east-1")
+os.environ.setdefault("EMBEDDING_MODEL", "fake.embedding")
+os.environ.setdefault("DYNAMO_TABLE_NAME", "history")
+os.environ.setdefault("DYNAMODB_MESSAGE_TTL", "86400")
+os.environ.setdefault("CONNECTIONS_TABLE", "connections")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("ANSWER_CACHE_ENABLED", "false")
+# Aggregate lookups must not go to S3
+os.environ["VECTOR_SNAPSHOT_BUCKET"] = ""
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from benchmarks.fakes import (
+    CALL_COUNTS, FakeEmbeddings, FakeStreamingChatModel, FakeTable, InMemoryOpenSearch, RecordingApiGateway,
+    build_corpus, reset_call_counts
+)
+
+FAKE_PROMPTS = b'''
+SNIPPET_PROMPT = """You are the snippet assistant. Answer in {language} from the context only.
+
+{context}"""
+SNIPPET_PROGRAM_PROMPT = """You build learning programs from snippets. Answer in {language} from the context only.
+
+{context}"""
+'''
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))], 1)
+
+def setup_fakes(args: argparse.Namespace) -> RecordingApiGateway:
+    """
+    Point the orchestrator at the fakes.
+
+    Args:
+        args: The command line arguments
+
+    Returns:
+        RecordingApiGateway: The API Gateway stub recording the frames
+    """
+    import langchain_orchestrator as orchestrator
+    from llm_utils import session_history
+    from llm_utils.embedding_cache import CachedEmbeddings
+    from llm_utils.scored_retriever import ScoredVectorStoreRetriever
+    from llm_utils.tracing import InMemoryExporter, set_exporters
+
+    factory = orchestrator.get_chain_factory()
+
+    apigw = RecordingApiGateway(latency_ms=args.apigw_latency_ms)
+    orchestrator.get_api_gateway_management_client = lambda event: apigw
+    orchestrator._connections_table = FakeTable("connections", "ConnectionId", latency_ms=args.dynamodb_latency_ms)
+    session_history._table = FakeTable("history", session_history.PRIMARY_KEY_NAME, latency_ms=args.dynamodb_latency_ms)
+
+    embeddings = CachedEmbeddings(FakeEmbeddings(latency_ms=args.embedding_latency_ms), model_id="fake", store=None)
+    factory._embedding_function = embeddings
+    store = InMemoryOpenSearch(embeddings, latency_ms=args.opensearch_latency_ms)
+    args.titles = build_corpus(store, programs=args.programs, snippets_per_program=args.snippets)
+
+    llm = FakeStreamingChatModel(ttft_ms=args.ttft_ms, tokens_per_second=args.tokens_per_second, answer_tokens=args.answer_tokens)
+    contextualizer_llm = None
+    if args.contextualizer_ttft_ms is not None:
+        contextualizer_llm = FakeStreamingChatModel(ttft_ms=args.contextualizer_ttft_ms, tokens_per_second=args.tokens_per_second)
+    factory.init_llm = lambda: llm
+    factory.init_contextualizer_llm = lambda model_name=None: contextualizer_llm
+    factory.build_retriever = lambda language: ScoredVectorStoreRetriever(
+        vectorstore=store,
+        search_kwargs={"k": 15, "filter": {"term": {"metadata.language": language}}},
+        include_vectors=factory.RERANK_ENABLED and factory.RERANK_USE_VECTORS
+    )
+    factory.get_opensearch_client = lambda: store
+    factory._intent_router = None
+
+    factory.PROMPT_STORE._swap(FAKE_PROMPTS, "load-test", notify=False)
+    factory.PROMPT_STORE.refresh_seconds = float("inf")
+    set_exporters([InMemoryExporter()])
+    factory.invalidate_chain_cache()
+    reset_call_counts()
+    return apigw
+
+def pick_message(rng: random.Random, args: argparse.Namespace, turn: int) -> str:
+    if rng.random() < args.listing_ratio:
+        return f"List all snippets in Program {rng.randint(1, args.programs)}"
+    if turn > 0 and rng.random() < 0.5:
+        return "What are the options in it?"
+    return f"What does {rng.choice(args.titles)} cover?"
+
+def event(route_key: str, connection_id: str, body: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    request_context = {"routeKey": route_key, "connectionId": connection_id, "domainName": "localhost", "stage": "bench"}
+    return {"requestContext": request_context, "body": json.dumps(body) if body is not None else None}
+
+def run_session(index: int, args: argparse.Namespace, apigw: RecordingApiGateway) -> List[Dict[str, Any]]:
+    """
+    Connect, send the messages of one session and disconnect.
+
+    Args:
+        index: The session number, seeds its messages
+        args: The command line arguments
+        apigw: The API Gateway stub
+
+    Returns:
+        List: One result per message
+    """
+    from langchain_orchestrator import lambda_handler
+
+    rng = random.Random(args.seed + index)
+    connection_id = f"load-test-{index}"
+    language, type_of_chat = rng.choice(args.languages), rng.choice(args.types)
+    lambda_handler(event("$connect", connection_id), None)
+    results = []
+    for turn in range(args.turns):
+        body = {"message": pick_message(rng, args, turn), "language": language, "type": type_of_chat}
+        start = time.perf_counter()
+        response = lambda_handler(event("sendMessage", connection_id, body), None)
+        end = time.perf_counter()
+        frames = apigw.frames_since(connection_id, start)
+        first_stream = next((at for at, frame_type, _ in frames if frame_type == "stream"), None)
+        results.append({
+            "status": response["statusCode"],
+            "error": response["statusCode"] != 200 or any(frame_type == "error" for _, frame_type, _ in frames),
+            "ttft_ms": (first_stream - start) * 1000 if first_stream is not None else None,
+            "total_ms": (end - start) * 1000,
+            "frames": len(frames),
+            "bytes": sum(size for _, _, size in frames),
+        })
+    lambda_handler(event("$disconnect", connection_id), None)
+    return results
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    apigw = setup_fakes(args)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        sessions = list(executor.map(lambda index: run_session(index, args, apigw), range(args.sessions)))
+    elapsed = time.perf_counter() - start
+    results = [result for session in sessions for result in session]
+    messages = len(results)
+    ttft = [result["ttft_ms"] for result in results if result["ttft_ms"] is not None]
+    total = [result["total_ms"] for result in results]
+    calls = dict(sorted(CALL_COUNTS.items()))
+    return {
+        "sessions": args.sessions,
+        "messages": messages,
+        "errors": sum(result["error"] for result in results),
+        "messages_per_second": round(messages / elapsed, 2),
+        "ttft_ms": {f"p{q}": percentile(ttft, q) for q in (50, 95, 99)},
+        "total_ms": {f"p{q}": percentile(total, q) for q in (50, 95, 99)},
+        "frames": sum(result["frames"] for result in results),
+        "frames_per_message": round(sum(result["frames"] for result in results) / max(messages, 1), 2),
+        "bytes": sum(result["bytes"] for result in results),
+        "calls": calls,
+        "calls_per_message": {name: round(count / max(messages, 1), 2) for name, count in calls.items()},
+    }
+
+def check(report: Dict[str, Any], args: argparse.Namespace) -> List[str]:
+    """
+    Compare the report with the limits and the baseline.
+
+    Args:
+        report: The load test report
+        args: The command line arguments
+
+    Returns:
+        List: The failed checks, empty if the run passes
+    """
+    failures = []
+    if report["errors"] > args.max_errors:
+        failures.append(f"{report['errors']} errors, at most {args.max_errors} allowed")
+    for metric, limit in (("ttft_ms", args.max_p95_ttft_ms), ("total_ms", args.max_p95_total_ms)):
+        value = report[metric]["p95"]
+        if limit is not None and (value is None or value > limit):
+            failures.append(f"p95 {metric} {value} above {limit}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        for metric in ("ttft_ms", "total_ms"):
+            before, after = baseline[metric]["p95"], report[metric]["p95"]
+            if before is not None and after is not None and after > before * (1 + args.tolerance):
+                failures.append(f"p95 {metric} {after} regressed from {before}")
+        for name, before in baseline["calls_per_message"].items():
+            after = report["calls_per_message"].get(name, 0)
+            if after > before * (1 + args.tolerance):
+                failures.append(f"{name} {after} calls per message, {before} in the baseline")
+    return failures
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Load test lambda_handler against local fakes")
+    parser.add_argument("--sessions", type=int, default=10, help="Concurrent sessions")
+    parser.add_argument("--turns", type=int, default=3, help="Messages per session")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--languages", nargs="+", default=["en", "fr"])
+    parser.add_argument("--types", nargs="+", default=["chat", "program"])
+    parser.add_argument("--listing-ratio", type=float, default=0.1, help="Share of listing questions, answered by the router")
+    parser.add_argument("--programs", type=int, default=4)
+    parser.add_argument("--snippets", type=int, default=10, help="Snippets per program")
+    parser.add_argument("--ttft-ms", type=float, default=400.0, help="Simulated Bedrock time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=60.0)
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--contextualizer-ttft-ms", type=float, help="Simulate a separate contextualizer model")
+    parser.add_argument("--embedding-latency-ms", type=float, default=30.0)
+    parser.add_argument("--opensearch-latency-ms", type=float, default=40.0)
+    parser.add_argument("--dynamodb-latency-ms", type=float, default=8.0)
+    parser.add_argument("--apigw-latency-ms", type=float, default=15.0)
+    parser.add_argument("--max-p95-ttft-ms", type=float)
+    parser.add_argument("--max-p95-total-ms", type=float)
+    parser.add_argument("--max-errors", type=int, default=0)
+    parser.add_argument("--baseline", help="Report of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative growth over the baseline")
+    parser.add_argument("--save", help="Write the report, to be used as baseline")
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    failures = check(report, args)
+    for failure in failures:
+        print(f"REGRESSION: {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
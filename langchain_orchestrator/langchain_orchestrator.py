@@ -3,57 +3,58 @@ import os
 import asyncio
 from typing import Dict, Any
 import time
-import logging
-from langchain_aws import ChatBedrock, BedrockEmbeddings
-from langchain_community.vectorstores import OpenSearchVectorSearch
-from langchain.retrievers.document_compressors import EmbeddingsFilter
-from llm_utils.session_history import get_session_history
-from llm_utils.history_aware import contextualize_q_prompt, contextualize_program_prompt
-from llm_utils.qa_chat import create_program_prompt, create_snippet_prompt
-from llm_utils.response import get_ai_response
-from langchain.retrievers import ContextualCompressionRetriever
-from langchain.chains import create_retrieval_chain, create_history_aware_retriever
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain.prompts import ChatPromptTemplate
-import boto3
-from requests_aws4auth import AWS4Auth
-from opensearchpy import RequestsHttpConnection, AWSV4SignerAuth
+from llm_utils.startup_profile import profile_import, profile_resource, emit_startup_profile
+with profile_import("boto3"):
+    import boto3
+from llm_utils.stream_sender import CoalescingSender, PipelinedSender
+from llm_utils.log_sink import configure_logging, flush_logs, redact, should_log_content, summarize_event
 from dotenv import load_dotenv
-# Set up logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+# Set up logging, records are written by a background flusher so logging does no I/O on the streaming path
+logger = configure_logging()
 
 load_dotenv()
-MODEL_NAME = os.environ.get("MODEL_NAME")
-TEMPERATURE = float(os.environ.get("TEMPERATURE"))
-OPENSEARCH_URL = os.environ.get("OPENSEARCH_URL")
-OPENSEARCH_INDEX = os.environ.get("OPENSEARCH_INDEX")
-EMBEDDING_REGION = os.environ.get("REGION")
-EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL")
-EMBEDDING_FUNCTION = BedrockEmbeddings(model_id=EMBEDDING_MODEL, region_name=EMBEDDING_REGION)
 CONNECTIONS_TABLE = os.environ.get("CONNECTIONS_TABLE")
-SERVICE = 'aoss'
-# Debug: Print environment configuration
-print(f"DEBUG: Initialized with MODEL_NAME={MODEL_NAME}, TEMPERATURE={TEMPERATURE}")
-print(f"DEBUG: Using OpenSearch at {OPENSEARCH_URL}, index {OPENSEARCH_INDEX}")
 
-CREDENTIALS = boto3.Session().get_credentials()
-auth = AWS4Auth(
-    CREDENTIALS.access_key,
-    CREDENTIALS.secret_key,
-    EMBEDDING_REGION,
-    'aoss',
-    session_token=CREDENTIALS.token
-)
+# Everything is initialized on first use: $connect and $disconnect only need the connections table,
+# the langchain, Bedrock and OpenSearch modules are only imported for sendMessage.
+_connections_table = None
+_chain_factory = None
 
-auth2 = AWSV4SignerAuth(
-    credentials=CREDENTIALS,
-    region=EMBEDDING_REGION,
-    service=SERVICE
-)
-dynamodb = boto3.resource("dynamodb")
-connections_table = dynamodb.Table(CONNECTIONS_TABLE)
+def get_connections_table() -> Any:
+    """
+    Get the DynamoDB table of the WebSocket connections, created on first use.
+
+    Returns:
+        The connections table resource
+    """
+    global _connections_table
+    if _connections_table is None:
+        with profile_resource("connections_table"):
+            _connections_table = boto3.resource("dynamodb").Table(CONNECTIONS_TABLE)
+    return _connections_table
+
+def get_chain_factory() -> Any:
+    """
+    Import the chain building module on first use.
+
+    Returns:
+        The llm_utils.chain_factory module
+    """
+    global _chain_factory
+    if _chain_factory is None:
+        with profile_import("llm_utils.chain_factory"):
+            from llm_utils import chain_factory
+        _chain_factory = chain_factory
+    return _chain_factory
+
+def __getattr__(name: str) -> Any:
+    # The chain building names (create_chain, invalidate_chain_cache, ...) moved to llm_utils.chain_factory
+    if name.startswith("__"):
+        raise AttributeError(name)
+    factory = get_chain_factory()
+    if hasattr(factory, name):
+        return getattr(factory, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def get_api_gateway_management_client(event: Dict[str, Any]) -> Any:
     """
@@ -71,7 +72,7 @@ def get_api_gateway_management_client(event: Dict[str, Any]) -> Any:
     endpoint_url = f"https://{domain_name}/{stage}"
     return boto3.client("apigatewaymanagementapi", endpoint_url=endpoint_url)
 
-async def send_to_connection(client: Any, connection_id: str, data: str, type: str) -> None:
+async def send_to_connection(client: Any, connection_id: str, data: str, type: str) -> bool:
     """
     Send a message to a connected WebSocket client.
 
@@ -79,9 +80,12 @@ async def send_to_connection(client: Any, connection_id: str, data: str, type: s
         client: The API Gateway Management client
         connection_id: The connection ID of the client
         data: The message to send
+
+    Returns:
+        bool: False if the client is gone, True otherwise
     """
     try:
-        logger.info(f"Sending message to connection {connection_id}")
+        logger.debug(f"Sending message to connection {connection_id}")
         await asyncio.to_thread(
             client.post_to_connection,
             ConnectionId=connection_id,
@@ -90,121 +94,13 @@ async def send_to_connection(client: Any, connection_id: str, data: str, type: s
     except client.exceptions.GoneException:
         logger.warning(f"Connection {connection_id} is gone, removing from connections table")
         await asyncio.to_thread(
-            connections_table.delete_item,
+            get_connections_table().delete_item,
             Key={"ConnectionId": connection_id}
         )
+        return False
     except Exception as e:
         logger.error(f"Error sending message to connection {connection_id}: {str(e)}")
-
-def init_llm() -> ChatBedrock:  
-    print(f"DEBUG: Initializing Bedrock LLM with model {MODEL_NAME}")
-    return ChatBedrock(model=MODEL_NAME, temperature=TEMPERATURE, streaming=True, region=EMBEDDING_REGION, max_tokens=4096)
-
-def bot_creation(
-        retriever: ContextualCompressionRetriever,
-        llm: ChatBedrock,
-        contextualize_q_prompt: ChatPromptTemplate,
-        qa_prompt: ChatPromptTemplate
-        ) -> RunnableWithMessageHistory:
-    print("DEBUG: Creating bot chain with history-aware retriever")
-    history_aware_retriever = create_history_aware_retriever(llm, retriever, contextualize_q_prompt)
-    question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
-    rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
-    return RunnableWithMessageHistory(
-        rag_chain,
-        get_session_history,
-        input_messages_key="input",
-        history_messages_key="chat_history",
-        output_messages_key="answer"
-    )
-
-def create_chain(session_id: str, language: str, type_of_chat: str):
-    """
-    Create the LangChain chain based on the session ID and language.
-    
-    Args:
-        session_id: The session ID for the conversation
-        language: Optional language for code generation
-    
-    Returns:
-        The LangChain chain with message history
-    """
-    start_time = time.time()
-    print(f"DEBUG: Creating chain for session_id={session_id}, language={language}, type={type_of_chat}")
-    
-    # Set up embeddings
-    print("DEBUG: Setting up BedrockEmbeddings")
-    # Set up vector store
-    vectorstore = OpenSearchVectorSearch(
-            opensearch_url=OPENSEARCH_URL,
-            http_auth=auth2,
-            connection_class = RequestsHttpConnection,
-            index_name=OPENSEARCH_INDEX,
-            embedding_function=EMBEDDING_FUNCTION,
-            is_aoss=True,
-            use_ssl=True,
-            verify_certs=True,
-            vector_field="vector_field",
-            text_field="content",
-            space_type="l2",
-            ef_search=512,
-            engine="nmslib"
-    )
-    # Create base retriever with optional language filter
-    search_kwargs = {
-        "k": 15,
-        "filter": {
-            "term": {
-                "metadata.language": language
-            }
-        },
-    }
-
-    
-        
-    print(f"DEBUG: Creating base retriever with search_kwargs={search_kwargs}")
-    base_retriever = vectorstore.as_retriever(
-        search_type="similarity",
-        search_kwargs=search_kwargs
-    )
-    # Create embeddings filter for contextual compression
-    print("DEBUG: Setting up embeddings filter with threshold 0.2")
-    embeddings_filter = EmbeddingsFilter(
-        embeddings=EMBEDDING_FUNCTION, 
-        similarity_threshold=0.05
-    )
-    
-    # Create contextual compression retriever
-    print("DEBUG: Creating contextual compression retriever")
-    retriever = ContextualCompressionRetriever(
-        base_compressor=embeddings_filter,
-        base_retriever=base_retriever
-    )
-    
-    # Initialize LLM
-    llm = init_llm()
-    
-    # Create appropriate chain based on language parameter
-    if type_of_chat == "program":
-        print(f"DEBUG: Creating program generation chain for language: {language}")
-        chain = bot_creation(
-            retriever=base_retriever,
-            llm=llm,
-            contextualize_q_prompt=contextualize_program_prompt,
-            qa_prompt=create_program_prompt(language)
-        )
-    else:
-        print(f"DEBUG: Creating standard QA chain for language {language}")
-        chain = bot_creation(
-            retriever=base_retriever,
-            llm=llm,
-            contextualize_q_prompt=contextualize_q_prompt,
-            qa_prompt=create_snippet_prompt(language)
-        )
-    
-    end_time = time.time()
-    print(f"DEBUG: Chain creation completed in {end_time - start_time:.2f} seconds")
-    return chain
+    return True
 
 async def process_message(message: str,
                           connection_id: str,
@@ -225,39 +121,115 @@ async def process_message(message: str,
         str: The AI response
     """
     start_time = time.time()
+    with profile_import("llm_utils.response"):
+        from llm_utils.response import get_ai_response
+        from llm_utils.session_history import close_session_history
+        from llm_utils.tracing import RequestTrace, StageTracer, finish_trace
+    factory = get_chain_factory()
+    # Contents are only logged for a sample of the requests
+    log_content = should_log_content()
+    logger.info(f"Processing message: {redact(message, log_content)}")
+    trace = RequestTrace(type_of_chat=factory.chain_cache_key(language, type_of_chat)[1], language=language or "none")
     
-    # Get the appropriate chain based on whether it's a code generation request
-    chain = create_chain(connection_id, language, type_of_chat)
+    # Listing questions are answered from the aggregate documents, everything else by the retrieval chain
+    routed = None
+    router = factory.get_intent_router()
+    if router is not None:
+        try:
+            async with trace.span("route"):
+                routed = await asyncio.to_thread(router.route, message, language, type_of_chat)
+        except Exception as e:
+            logger.error(f"Intent routing failed, using the retrieval chain: {str(e)}")
+    answer_cache = factory.get_answer_cache() if routed is None else None
+    # The prompt version and the index generation are resolved before the chain is fetched, so the
+    # cache scope names the prompts the chain was built from even if they are swapped meanwhile.
+    # The generation is resolved off the event loop, it may call OpenSearch when the refresh interval has elapsed
+    index_generation = await asyncio.to_thread(factory.get_index_generation) if answer_cache is not None else None
+    if routed is not None:
+        trace.count(f"routed_{routed.intent}")
+        chain = factory.create_aggregate_chain(language) if routed.answer is None else None
+        prompt_version = None
+    else:
+        # Off the event loop, the first load of the prompts waits for S3
+        prompts, prompt_version = await asyncio.to_thread(factory.get_prompt_snapshot)
+        # Get the appropriate chain based on whether it's a code generation request
+        chain = factory.create_chain(connection_id, language, type_of_chat, prompts=prompts, prompt_version=prompt_version)
+    cache_scope = (language, factory.chain_cache_key(language, type_of_chat)[1], index_generation, prompt_version)
     
+    # Chunks are coalesced into fewer frames, each frame is one post_to_connection round trip.
+    # The sender task drains a bounded queue so the model stream never waits on a send.
+    async def send(data: str, type: str) -> bool:
+        async with trace.span("send"):
+            return await send_to_connection(apigw_client, connection_id, data, type)
+
+    sender = PipelinedSender(CoalescingSender(send)).start()
+
     # Process the message and get the response
     try:
         # Debug counters
         chunk_counter = 0
-        total_bytes_sent = 0
+        total_bytes = 0
         full_response = ""
         # Stream each chunk to the client
-        async for chunk in get_ai_response(message, chain, connection_id):
+        # The sender sets the cancelled event once the client is gone, which stops the model stream
+        async for chunk in get_ai_response(
+            message,
+            chain,
+            connection_id,
+            cancel_event=sender.cancelled,
+            answer_cache=answer_cache,
+            cache_scope=cache_scope,
+            callbacks=[StageTracer(trace)],
+            answer=routed.answer if routed is not None else None,
+            context=routed.documents if routed is not None and routed.answer is None else None
+        ):
+            # Per chunk only counters, the totals are logged once the stream ends
             chunk_counter += 1
-            chunk_size = len(chunk.encode('utf-8'))  # Get byte size
-            total_bytes_sent += chunk_size
+            trace.mark_first_token()
+            total_bytes += len(chunk.encode('utf-8'))
             full_response += chunk
-            
-            # Log chunk info for debugging
-            logger.info(f"Sending chunk #{chunk_counter}, size: {chunk_size} bytes, total sent: {total_bytes_sent} bytes")
         
-            # Send the individual chunk to the client
-            await send_to_connection(apigw_client, connection_id, chunk, "stream")
+            # Queue the chunk, the sender task decides when to emit a frame
+            await sender.put(chunk)
         
-        logger.info(f"Last 200 chars of response: {full_response[-200:]}")
-        await send_to_connection(apigw_client, connection_id, "", "done")
+        if sender.cancelled.is_set():
+            # Each streamed chunk is roughly one token, the rest of the max_tokens budget was not generated
+            logger.warning(
+                f"Connection {connection_id} gone after {chunk_counter} chunks, generation stopped, "
+                f"up to {max(factory.MAX_TOKENS - chunk_counter, 0)} tokens saved"
+            )
+        else:
+            logger.info(f"Last 200 chars of response: {redact(full_response[-200:], log_content)}")
+        await sender.close("done")
         
         end_time = time.time()
         logger.info(f"Message processing completed in {end_time - start_time:.2f} seconds")
-        logger.info(f"Sent {chunk_counter} chunks, total {total_bytes_sent} bytes")
+        logger.info(f"Received {chunk_counter} chunks, total {total_bytes} bytes")
+        logger.info(f"Stream metrics: {json.dumps(sender.metrics())}")
+        for name, value in sender.metrics().items():
+            trace.count(name, value)
+        logger.info(f"Embedding cache stats: {json.dumps(factory.get_embedding_function().stats())}")
+        if answer_cache is not None:
+            logger.info(f"Answer cache stats: {json.dumps(answer_cache.stats())}")
+        logger.info(f"Speculative retrieval stats: {json.dumps(factory.get_speculation_stats())}")
+        if router is not None:
+            logger.info(f"Intent router stats: {json.dumps(router.stats())}")
         
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}")
-        await send_to_connection(apigw_client, connection_id, f"Error processing message: {str(e)}", "error")
+        try:
+            await sender.close("error", f"Error processing message: {str(e)}")
+        except Exception as send_error:
+            logger.error(f"Error sending error frame to connection {connection_id}: {str(send_error)}")
+    finally:
+        # Write-behind of the new turns, the done frame has already been sent
+        try:
+            async with trace.span("history_write"):
+                await close_session_history(connection_id)
+        except Exception as e:
+            logger.error(f"Error saving session history for {connection_id}: {str(e)}")
+        # One metrics summary per request
+        finish_trace(trace)
 
 
 def handle_connect(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
@@ -274,7 +246,7 @@ def handle_connect(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     connection_id = event["requestContext"]["connectionId"]
     logger.info(f"New WebSocket connection: {connection_id}")
     try:
-        connections_table.put_item(
+        get_connections_table().put_item(
             Item={
                 "ConnectionId": connection_id,
                 "ConnectedAt": int(time.time())
@@ -299,7 +271,7 @@ def handle_disconnect(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     connection_id = event["requestContext"]["connectionId"]
     logger.info(f"Disconnecting WebSocket connection: {connection_id}")
     try:
-        connections_table.delete_item(
+        get_connections_table().delete_item(
             Key={"ConnectionId": connection_id}
         )
         return {"statusCode": 200, "body": "Disconnected"}
@@ -357,15 +329,21 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         Dict: The response to be returned to API Gateway
     """
 
-    logger.info(f"Websocket event: {json.dumps(event)}")
+    logger.info(f"Websocket event: {json.dumps(summarize_event(event))}")
     route_key = event.get("requestContext", {}).get("routeKey")
 
     if route_key == "$connect":
-        return handle_connect(event, context)
+        response = handle_connect(event, context)
     elif route_key == "$disconnect":
-        return handle_disconnect(event, context)
+        response = handle_disconnect(event, context)
     elif route_key == "sendMessage":
-        return handle_message(event, context)
+        response = handle_message(event, context)
     else:
         logger.warning(f"Unknown route: {route_key}")
-        return {"statusCode": 400, "body": f"Unknown route: {route_key}"}
+        response = {"statusCode": 400, "body": f"Unknown route: {route_key}"}
+
+    # Only emitted on the first invocation of the container, i.e. on cold starts
+    emit_startup_profile(route_key)
+    # Lambda freezes the container once the handler returns, write the queued records first
+    flush_logs()
+    return response
@@ -0,0 +1,170 @@
+"""
+Project:
+Dialectic Snippet Bot
+
+Purpose:
+Cache the answers to standalone questions so popular first-turn questions skip retrieval and generation.
+
+Comments:
+Answers are partitioned by (language, type_of_chat, index generation, prompt version), so a reindex or a
+prompt change never serves a stale answer. Inside a partition a question matches on the hash of its
+normalized text. Matching near-duplicate questions by embedding similarity is opt-in with
+ANSWER_CACHE_SIMILARITY: questions that differ only in a program or course name embed very close to each
+other, and would be served each other's answer.
+The cache only applies to sessions without chat history, as follow-up answers depend on the history.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from .embedding_cache import normalize_text
+
+logger = logging.getLogger()
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "256"))
+ANSWER_CACHE_TTL = int(os.environ.get("ANSWER_CACHE_TTL", "3600"))
+# Unset for exact matches only
+ANSWER_CACHE_SIMILARITY = float(os.environ["ANSWER_CACHE_SIMILARITY"]) if os.environ.get("ANSWER_CACHE_SIMILARITY") else None
+
+def question_key(question: str) -> str:
+    """
+    Hash the normalized question, the key of an exact match.
+
+    Args:
+        question: The user question
+
+    Returns:
+        str: The hex digest
+    """
+    return hashlib.sha256(normalize_text(question).encode("utf-8")).hexdigest()
+
+class AnswerCache:
+    def __init__(
+            self,
+            embeddings: Optional[Embeddings] = None,
+            max_size: int = ANSWER_CACHE_SIZE,
+            ttl: int = ANSWER_CACHE_TTL,
+            similarity_threshold: Optional[float] = ANSWER_CACHE_SIMILARITY
+            ):
+        """
+
+        Initializing the in-process answer cache
+
+        Args:
+            embeddings: Embeddings used for the near-duplicate match
+            max_size: Number of answers kept, least recently used answers are evicted first
+            ttl: Seconds an answer stays valid
+            similarity_threshold: Minimum cosine similarity for a near-duplicate question to match, exact
+                matches only if None
+        """
+        # Questions are only embedded when near-duplicates are matched
+        self.embeddings = embeddings if similarity_threshold is not None else None
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        # (scope, question key) -> (answer, unit question vector or None, stored at)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "stores": 0}
+
+    def _embed(self, question: str) -> Optional[np.ndarray]:
+        if self.embeddings is None:
+            return None
+        try:
+            vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"Answer cache could not embed the question: {str(e)}")
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _expire(self, now: float) -> None:
+        expired = [key for key, (_, _, stored_at) in self._entries.items() if now - stored_at > self.ttl]
+        for key in expired:
+            del self._entries[key]
+
+    def lookup(self, scope: Tuple, question: str) -> Optional[str]:
+        """
+        Look up the answer to a standalone question.
+
+        Args:
+            scope: The (language, type_of_chat, index generation, prompt version) partition
+            question: The user question
+
+        Returns:
+            str: The cached answer, or None on a miss
+        """
+        key = (scope, question_key(question))
+        with self._lock:
+            self._expire(time.time())
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["exact_hits"] += 1
+                return entry[0]
+            candidates = [
+                (entry_key, answer, vector)
+                for entry_key, (answer, vector, _) in self._entries.items()
+                if entry_key[0] == scope and vector is not None
+            ]
+        if candidates:
+            vector = self._embed(question)
+            if vector is not None:
+                similarities = np.stack([candidate[2] for candidate in candidates]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    with self._lock:
+                        if candidates[best][0] in self._entries:
+                            self._entries.move_to_end(candidates[best][0])
+                        self._stats["similar_hits"] += 1
+                    return candidates[best][1]
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def store(self, scope: Tuple, question: str, answer: str) -> None:
+        """
+        Store the answer to a standalone question.
+
+        Args:
+            scope: The (language, type_of_chat, index generation, prompt version) partition
+            question: The user question
+            answer: The full answer
+        """
+        key = (scope, question_key(question))
+        vector = self._embed(question)
+        with self._lock:
+            self._entries[key] = (answer, vector, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._stats["stores"] += 1
+
+    def invalidate(self) -> None:
+        """
+        Drop every cached answer.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Report the cache counters and the hit rate.
+
+        Returns:
+            Dict: Exact and near-duplicate hits, misses, stores, size and hit rate
+        """
+        with self._lock:
+            stats = {**self._stats, "size": len(self._entries)}
+        lookups = stats["exact_hits"] + stats["similar_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["exact_hits"] + stats["similar_hits"]) / lookups if lookups else 0.0
+        return stats
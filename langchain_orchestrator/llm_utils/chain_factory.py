@@ -0,0 +1,542 @@
+"""
+Project:
+Dialectic Snippet Bot
+
+Purpose:
+Build the retrieval-augmented chains and the resources they use.
+
+Comments:
+This module holds everything that needs langchain, Bedrock and OpenSearch. The orchestrator only imports
+it for sendMessage, so the $connect and $disconnect routes never pay for these imports. The embedding
+function, the credentials and the answer cache are also created on first use.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+from .startup_profile import profile_import, profile_resource
+
+with profile_import("boto3"):
+    import boto3
+with profile_import("langchain_aws"):
+    from langchain_aws import ChatBedrock, BedrockEmbeddings
+with profile_import("langchain_community"):
+    from langchain_community.vectorstores import OpenSearchVectorSearch
+with profile_import("langchain"):
+    from langchain.retrievers import ContextualCompressionRetriever
+    from langchain.chains import create_retrieval_chain, create_history_aware_retriever
+    from langchain.chains.combine_documents import create_stuff_documents_chain
+    from langchain_core.runnables.history import RunnableWithMessageHistory
+    from langchain_core.runnables import Runnable, RunnablePassthrough
+    from langchain_core.retrievers import BaseRetriever
+    from langchain.prompts import ChatPromptTemplate
+with profile_import("opensearchpy"):
+    from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
+with profile_import("llm_utils"):
+    from .session_history import get_session_history, make_llm_summarizer, set_history_summarizer
+    from .history_aware import contextualize_q_prompt, contextualize_program_prompt
+    from .qa_chat import create_program_prompt, create_snippet_prompt, get_prompt_snapshot
+    from .load_prompts import PROMPT_STORE
+    from .embedding_cache import CachedEmbeddings, create_embedding_store
+    from .answer_cache import AnswerCache, ANSWER_CACHE_ENABLED
+    from .local_index import LocalIndexRetriever, get_snapshot_generation, VECTOR_SNAPSHOT_BUCKET
+    from .context_packer import ContextPacker, create_context_packer
+    from .scored_retriever import ScoredVectorStoreRetriever
+    from .vector_rerank import VectorSimilarityFilter, RERANK_ENABLED, RERANK_SIMILARITY_THRESHOLD, RERANK_USE_VECTORS
+    from .intent_router import AggregateStore, IntentRouter, ROUTER_ENABLED
+    from .speculative_retrieval import (
+        create_speculative_history_aware_retriever, get_speculation_stats, SPECULATIVE_RETRIEVAL_ENABLED
+    )
+
+logger = logging.getLogger()
+
+MODEL_NAME = os.environ.get("MODEL_NAME")
+TEMPERATURE = float(os.environ.get("TEMPERATURE"))
+MAX_TOKENS = int(os.environ.get("MAX_TOKENS", "4096"))
+OPENSEARCH_URL = os.environ.get("OPENSEARCH_URL")
+OPENSEARCH_INDEX = os.environ.get("OPENSEARCH_INDEX")
+# Optional manual part of the index generation, e.g. bumped to drop every cached answer
+INDEX_GENERATION = os.environ.get("INDEX_GENERATION", "")
+INDEX_GENERATION_REFRESH_SECONDS = int(os.environ.get("INDEX_GENERATION_REFRESH_SECONDS", "60"))
+EMBEDDING_REGION = os.environ.get("REGION")
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL")
+# Optional small, fast model only used to rephrase follow-up questions, MODEL_NAME does everything if unset
+CONTEXTUALIZER_MODEL_NAME = os.environ.get("CONTEXTUALIZER_MODEL_NAME")
+CONTEXTUALIZER_MAX_TOKENS = int(os.environ.get("CONTEXTUALIZER_MAX_TOKENS", "256"))
+HISTORY_SUMMARY_ENABLED = os.environ.get("HISTORY_SUMMARY_ENABLED", "false").lower() == "true"
+SERVICE = 'aoss'
+# Debug: Print environment configuration
+print(f"DEBUG: Initialized with MODEL_NAME={MODEL_NAME}, TEMPERATURE={TEMPERATURE}")
+print(f"DEBUG: Using OpenSearch at {OPENSEARCH_URL}, index {OPENSEARCH_INDEX}")
+
+# Resources created on first use
+_embedding_function: Optional[CachedEmbeddings] = None
+_answer_cache: Optional[AnswerCache] = None
+_http_auth: Optional[AWSV4SignerAuth] = None
+_opensearch_client: Optional[OpenSearch] = None
+_intent_router: Optional[IntentRouter] = None
+_resource_lock = threading.Lock()
+_index_generation: Optional[str] = None
+_index_generation_checked = 0.0
+_index_generation_lock = threading.Lock()
+
+# Assembled chains are reused across warm invocations, keyed by (language, type_of_chat, prompt version).
+# Nothing session specific lives in a chain: the session only flows through the
+# "session_id" entry of the runnable config, so one chain can serve every connection.
+_CHAIN_CACHE: Dict[tuple, RunnableWithMessageHistory] = {}
+_CHAIN_CACHE_LOCK = threading.Lock()
+CHAIN_CACHE_STATS = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def get_embedding_function() -> CachedEmbeddings:
+    """
+    Get the query embedding function, repeated questions are served from the embedding cache.
+
+    Returns:
+        CachedEmbeddings: The cached Bedrock embeddings
+    """
+    global _embedding_function
+    with _resource_lock:
+        if _embedding_function is None:
+            with profile_resource("bedrock_embeddings"):
+                _embedding_function = CachedEmbeddings(
+                    BedrockEmbeddings(model_id=EMBEDDING_MODEL, region_name=EMBEDDING_REGION),
+                    model_id=EMBEDDING_MODEL,
+                    store=create_embedding_store()
+                )
+        return _embedding_function
+
+def get_answer_cache() -> Optional[AnswerCache]:
+    """
+    Get the answer cache for standalone questions.
+
+    Returns:
+        AnswerCache: The answer cache, None when disabled
+    """
+    global _answer_cache
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    embeddings = get_embedding_function()
+    with _resource_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache(embeddings=embeddings)
+        return _answer_cache
+
+def get_http_auth() -> AWSV4SignerAuth:
+    """
+    Get the SigV4 auth for OpenSearch Serverless, resolving the credentials on first use.
+
+    Returns:
+        AWSV4SignerAuth: The request signer
+    """
+    global _http_auth
+    with _resource_lock:
+        if _http_auth is None:
+            with profile_resource("aoss_credentials"):
+                _http_auth = AWSV4SignerAuth(
+                    credentials=boto3.Session().get_credentials(),
+                    region=EMBEDDING_REGION,
+                    service=SERVICE
+                )
+        return _http_auth
+
+def get_opensearch_client() -> OpenSearch:
+    """
+    Get a plain OpenSearch client, for lookups that are not vector searches.
+
+    Returns:
+        OpenSearch: The client
+    """
+    global _opensearch_client
+    http_auth = get_http_auth()
+    with _resource_lock:
+        if _opensearch_client is None:
+            _opensearch_client = OpenSearch(
+                hosts=[OPENSEARCH_URL],
+                http_auth=http_auth,
+                use_ssl=True,
+                verify_certs=True,
+                connection_class=RequestsHttpConnection
+            )
+        return _opensearch_client
+
+def get_intent_router() -> Optional[IntentRouter]:
+    """
+    Get the router sending listing questions to the aggregate documents.
+
+    Returns:
+        IntentRouter: The router, None when disabled
+    """
+    global _intent_router
+    if not ROUTER_ENABLED:
+        return None
+    if _intent_router is None:
+        store = AggregateStore(client=get_opensearch_client(), index_name=OPENSEARCH_INDEX)
+        embeddings = get_embedding_function()
+        with _resource_lock:
+            if _intent_router is None:
+                _intent_router = IntentRouter(store, embeddings=embeddings)
+    return _intent_router
+
+def resolve_index_generation() -> Optional[str]:
+    """
+    Resolve the generation of the indexed documents: the concrete index behind OPENSEARCH_INDEX (a blue/green
+    swap or an in-place rebuild changes it) with its document count, and the manifest ETag of the loaded
+    vector snapshot, which changes with every full or incremental update.
+
+    Returns:
+        str: A short hash of the generation, None if OpenSearch could not be reached
+    """
+    parts = [INDEX_GENERATION]
+    try:
+        client = get_opensearch_client()
+        indices = client.indices.get(index=OPENSEARCH_INDEX)
+        for name in sorted(indices):
+            settings = indices[name].get("settings", {}).get("index", {})
+            parts.append(f"{name}:{settings.get('uuid') or settings.get('creation_date', '')}")
+        parts.append(str(client.count(index=OPENSEARCH_INDEX)["count"]))
+    except Exception as e:
+        logger.warning(f"Could not resolve the index generation of {OPENSEARCH_INDEX}: {str(e)}")
+        return None
+    parts.append(get_snapshot_generation() or "")
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:16]
+
+def get_index_generation() -> str:
+    """
+    Get the index generation that partitions the answer cache, re-resolved every INDEX_GENERATION_REFRESH_SECONDS.
+    This may call OpenSearch, call it off the event loop.
+
+    Returns:
+        str: The generation, the last resolved one while OpenSearch cannot be reached
+    """
+    global _index_generation, _index_generation_checked
+    with _index_generation_lock:
+        now = time.monotonic()
+        if _index_generation is not None and now - _index_generation_checked < INDEX_GENERATION_REFRESH_SECONDS:
+            return _index_generation
+        # Concurrent requests keep the current generation while this one resolves it
+        _index_generation_checked = now
+    generation = resolve_index_generation()
+    with _index_generation_lock:
+        if generation is not None and generation != _index_generation:
+            if _index_generation is not None:
+                logger.info(f"Index generation changed from {_index_generation} to {generation}, cached answers are not reused")
+            _index_generation = generation
+        return _index_generation or f"{OPENSEARCH_INDEX}:{INDEX_GENERATION}"
+
+def init_llm() -> ChatBedrock:  
+    print(f"DEBUG: Initializing Bedrock LLM with model {MODEL_NAME}")
+    return ChatBedrock(model=MODEL_NAME, temperature=TEMPERATURE, streaming=True, region=EMBEDDING_REGION, max_tokens=MAX_TOKENS)
+
+def init_contextualizer_llm(model_name: Optional[str] = CONTEXTUALIZER_MODEL_NAME) -> Optional[ChatBedrock]:
+    """
+    Initialize the model rephrasing follow-up questions. It only writes a one-line standalone
+    question, so it is not streamed and its output is capped at CONTEXTUALIZER_MAX_TOKENS.
+
+    Args:
+        model_name: The Bedrock model ID
+
+    Returns:
+        ChatBedrock: The contextualizer model, None to rephrase with the main model
+    """
+    if not model_name:
+        return None
+    print(f"DEBUG: Initializing Bedrock contextualizer with model {model_name}")
+    return ChatBedrock(
+        model=model_name,
+        temperature=0,
+        streaming=False,
+        region=EMBEDDING_REGION,
+        max_tokens=CONTEXTUALIZER_MAX_TOKENS
+    )
+
+if HISTORY_SUMMARY_ENABLED:
+    # Turns that fall out of the history window are folded into a rolling summary
+    set_history_summarizer(make_llm_summarizer(
+        ChatBedrock(model=MODEL_NAME, temperature=0, streaming=False, region=EMBEDDING_REGION, max_tokens=256)
+    ))
+
+def build_rag_chain(
+        retriever: BaseRetriever,
+        llm: ChatBedrock,
+        contextualize_q_prompt: ChatPromptTemplate,
+        qa_prompt: ChatPromptTemplate,
+        contextualizer_llm: Optional[ChatBedrock] = None,
+        packer: Optional[ContextPacker] = None
+        ) -> Runnable:
+    """
+    Build the retrieval chain, without the message history.
+
+    Args:
+        retriever: The document retriever
+        llm: The model answering the question
+        contextualize_q_prompt: The prompt rephrasing follow-up questions
+        qa_prompt: The prompt answering the question
+        contextualizer_llm: The model rephrasing follow-up questions, llm if None
+        packer: Packs the retrieved documents into a token budget, all documents are used if None
+
+    Returns:
+        Runnable: Returns the answer and context for {"input", "chat_history"}
+    """
+    print("DEBUG: Creating bot chain with history-aware retriever")
+    contextualizer_llm = contextualizer_llm or llm
+    if SPECULATIVE_RETRIEVAL_ENABLED:
+        # Search the raw input while the question is rephrased, see speculative_retrieval.py
+        history_aware_retriever = create_speculative_history_aware_retriever(
+            contextualizer_llm, retriever, contextualize_q_prompt, get_embedding_function()
+        )
+    else:
+        history_aware_retriever = create_history_aware_retriever(contextualizer_llm, retriever, contextualize_q_prompt)
+    if packer is not None:
+        history_aware_retriever = history_aware_retriever | packer.as_runnable()
+    question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
+    return create_retrieval_chain(history_aware_retriever, question_answer_chain)
+
+def bot_creation(
+        retriever: BaseRetriever,
+        llm: ChatBedrock,
+        contextualize_q_prompt: ChatPromptTemplate,
+        qa_prompt: ChatPromptTemplate,
+        contextualizer_llm: Optional[ChatBedrock] = None,
+        packer: Optional[ContextPacker] = None
+        ) -> RunnableWithMessageHistory:
+    rag_chain = build_rag_chain(retriever, llm, contextualize_q_prompt, qa_prompt, contextualizer_llm, packer)
+    return RunnableWithMessageHistory(
+        rag_chain,
+        get_session_history,
+        input_messages_key="input",
+        history_messages_key="chat_history",
+        output_messages_key="answer"
+    )
+
+def chain_cache_key(language: Optional[str], type_of_chat: Optional[str]) -> Tuple[Optional[str], str]:
+    """
+    Normalize the chain cache key. Anything that is not a program request is served by the QA chain.
+
+    Args:
+        language: The language of the conversation
+        type_of_chat: The type of chat (program or chat)
+
+    Returns:
+        Tuple: The (language, type_of_chat) key
+    """
+    return language, "program" if type_of_chat == "program" else "chat"
+
+def invalidate_chain_cache(language: Optional[str] = None, type_of_chat: Optional[str] = None) -> int:
+    """
+    Drop cached chains so the next message rebuilds them, e.g. after the prompts were reloaded.
+
+    Args:
+        language: Only drop chains for this language, all languages if None
+        type_of_chat: Only drop chains for this type of chat, all types if None
+
+    Returns:
+        int: The number of chains removed from the cache
+    """
+    with _CHAIN_CACHE_LOCK:
+        keys = [
+            key for key in _CHAIN_CACHE
+            if (language is None or key[0] == language)
+            and (type_of_chat is None or key[1] == chain_cache_key(language, type_of_chat)[1])
+        ]
+        for key in keys:
+            del _CHAIN_CACHE[key]
+        CHAIN_CACHE_STATS["invalidations"] += len(keys)
+    logger.info(f"Invalidated {len(keys)} cached chains")
+    return len(keys)
+
+def get_chain_cache_stats() -> Dict[str, int]:
+    """
+    Report the chain cache counters.
+
+    Returns:
+        Dict: hits, misses, invalidations and the current number of cached chains
+    """
+    with _CHAIN_CACHE_LOCK:
+        return {**CHAIN_CACHE_STATS, "size": len(_CHAIN_CACHE)}
+
+def build_retriever(language: str) -> BaseRetriever:
+    """
+    Build the document retriever for a language.
+
+    Args:
+        language: The language of the documents
+
+    Returns:
+        BaseRetriever: The local snapshot retriever with OpenSearch fallback, or the OpenSearch retriever
+    """
+    # Set up embeddings
+    print("DEBUG: Setting up BedrockEmbeddings")
+    # Set up vector store
+    vectorstore = OpenSearchVectorSearch(
+            opensearch_url=OPENSEARCH_URL,
+            http_auth=get_http_auth(),
+            connection_class = RequestsHttpConnection,
+            index_name=OPENSEARCH_INDEX,
+            embedding_function=get_embedding_function(),
+            is_aoss=True,
+            use_ssl=True,
+            verify_certs=True,
+            vector_field="vector_field",
+            text_field="content",
+            space_type="l2",
+            ef_search=512,
+            engine="nmslib"
+    )
+    # Create base retriever with optional language filter
+    search_kwargs = {
+        "k": 15,
+        "filter": {
+            "term": {
+                "metadata.language": language
+            }
+        },
+    }
+
+    
+        
+    print(f"DEBUG: Creating base retriever with search_kwargs={search_kwargs}")
+    # Same similarity search as vectorstore.as_retriever, keeping the scores for the context packer
+    base_retriever = ScoredVectorStoreRetriever(
+        vectorstore=vectorstore,
+        search_kwargs=search_kwargs,
+        include_vectors=RERANK_ENABLED and RERANK_USE_VECTORS
+    )
+    if VECTOR_SNAPSHOT_BUCKET:
+        # Search the in-process replica of the index, OpenSearch is the fallback while no snapshot is loaded
+        print(f"DEBUG: Using the local vector snapshot from s3://{VECTOR_SNAPSHOT_BUCKET}")
+        base_retriever = LocalIndexRetriever(
+            embeddings=get_embedding_function(),
+            fallback=base_retriever,
+            k=search_kwargs["k"],
+            language=language
+        )
+    return base_retriever
+
+def build_chain(language: str, type_of_chat: str, prompts: Any = None) -> RunnableWithMessageHistory:
+    """
+    Build the LangChain chain for a language and type of chat.
+    
+    Args:
+        language: Optional language for code generation
+        type_of_chat: The type of chat (program or chat)
+        prompts: The prompts module to build from, the current one from the prompt store if None
+    
+    Returns:
+        The LangChain chain with message history
+    """
+    start_time = time.time()
+    print(f"DEBUG: Building chain for language={language}, type={type_of_chat}")
+    base_retriever = build_retriever(language)
+
+    retriever = base_retriever
+    if RERANK_ENABLED:
+        # Re-rank and threshold from the stored vectors or the kNN scores, no document is embedded again
+        print(f"DEBUG: Setting up vector similarity filter with threshold {RERANK_SIMILARITY_THRESHOLD}")
+        retriever = ContextualCompressionRetriever(
+            base_compressor=VectorSimilarityFilter(embeddings=get_embedding_function()),
+            base_retriever=base_retriever
+        )
+    
+    # Initialize LLM
+    llm = init_llm()
+    contextualizer_llm = init_contextualizer_llm()
+    packer = create_context_packer(type_of_chat)
+    
+    # Create appropriate chain based on language parameter
+    if type_of_chat == "program":
+        print(f"DEBUG: Creating program generation chain for language: {language}")
+        chain = bot_creation(
+            retriever=retriever,
+            llm=llm,
+            contextualize_q_prompt=contextualize_program_prompt,
+            qa_prompt=create_program_prompt(language, prompts.SNIPPET_PROGRAM_PROMPT if prompts is not None else None),
+            contextualizer_llm=contextualizer_llm,
+            packer=packer
+        )
+    else:
+        print(f"DEBUG: Creating standard QA chain for language {language}")
+        chain = bot_creation(
+            retriever=retriever,
+            llm=llm,
+            contextualize_q_prompt=contextualize_q_prompt,
+            qa_prompt=create_snippet_prompt(language, prompts.SNIPPET_PROMPT if prompts is not None else None),
+            contextualizer_llm=contextualizer_llm,
+            packer=packer
+        )
+    
+    end_time = time.time()
+    print(f"DEBUG: Chain build completed in {end_time - start_time:.2f} seconds")
+    return chain
+
+def create_chain(
+        session_id: str,
+        language: str,
+        type_of_chat: str,
+        prompts: Any = None,
+        prompt_version: Optional[str] = None
+        ) -> RunnableWithMessageHistory:
+    """
+    Get the LangChain chain for the language and type of chat, building it on a cache miss.
+    The session ID is not part of the chain; pass it through the "session_id" config when invoking.
+    
+    Args:
+        session_id: The session ID for the conversation
+        language: Optional language for code generation
+        type_of_chat: The type of chat (program or chat)
+        prompts: The prompts module, resolved with prompt_version by get_prompt_snapshot()
+        prompt_version: The version of prompts, part of the chain cache key
+    
+    Returns:
+        The LangChain chain with message history
+    """
+    if prompts is None:
+        prompts, prompt_version = get_prompt_snapshot()
+    key = chain_cache_key(language, type_of_chat) + (prompt_version,)
+    with _CHAIN_CACHE_LOCK:
+        chain = _CHAIN_CACHE.get(key)
+        if chain is not None:
+            CHAIN_CACHE_STATS["hits"] += 1
+    if chain is not None:
+        logger.info(f"Chain cache hit for {key}, session_id={session_id}")
+        return chain
+
+    chain = build_chain(language, key[1], prompts)
+    with _CHAIN_CACHE_LOCK:
+        CHAIN_CACHE_STATS["misses"] += 1
+        # Another thread may have built the same chain meanwhile, keep the first one
+        chain = _CHAIN_CACHE.setdefault(key, chain)
+    logger.info(f"Chain cache miss for {key}, session_id={session_id}, stats={get_chain_cache_stats()}")
+    return chain
+
+def create_aggregate_chain(language: str) -> RunnableWithMessageHistory:
+    """
+    Get the QA chain answering from given documents instead of retrieval, used for routed questions.
+    The documents are passed in the "context" input.
+
+    Args:
+        language: The language of the conversation
+
+    Returns:
+        The LangChain chain with message history
+    """
+    key = (language, "aggregate")
+    with _CHAIN_CACHE_LOCK:
+        chain = _CHAIN_CACHE.get(key)
+    if chain is not None:
+        return chain
+    question_answer_chain = create_stuff_documents_chain(init_llm(), create_snippet_prompt(language))
+    chain = RunnableWithMessageHistory(
+        RunnablePassthrough.assign(answer=question_answer_chain),
+        get_session_history,
+        input_messages_key="input",
+        history_messages_key="chat_history",
+        output_messages_key="answer"
+    )
+    with _CHAIN_CACHE_LOCK:
+        return _CHAIN_CACHE.setdefault(key, chain)
+
+# Chains hold the prompts they were built with, rebuild them when the prompt store swaps the prompts
+PROMPT_STORE.add_listener(lambda module: invalidate_chain_cache())
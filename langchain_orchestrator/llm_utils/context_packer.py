@@ -0,0 +1,182 @@
+"""
+Project:
+Dialectic Snippet Bot
+
+Purpose:
+Pack the retrieved documents into a token budget before they are stuffed into the QA prompt.
+
+Comments:
+Every snippet document repeats its headers and the whole PDF content, so the k=15 retrieved documents
+dominate the prompt tokens, and with them time to first token and cost. The packer runs between the
+retriever and create_stuff_documents_chain and, in rank order:
+1. keeps the documents scoring at least CONTEXT_SCORE_RATIO of the best score (adaptive k, never fewer
+   than CONTEXT_MIN_DOCUMENTS), when the retriever reports scores in metadata["score"];
+2. drops documents of a snippet already kept (same metadata.id) and near-duplicate contents;
+3. adds documents until the token budget of the type of chat is reached, trimming the last one.
+Tokens are estimated at CONTEXT_CHARS_PER_TOKEN characters per token. The outcome is dispatched as a
+"context_packing" custom event, counted per request by the StageTracer.
+"""
+
+import logging
+import os
+import re
+from typing import List, Optional, Set
+
+from langchain_core.callbacks.manager import adispatch_custom_event, dispatch_custom_event
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+
+logger = logging.getLogger()
+
+CONTEXT_PACKING_ENABLED = os.environ.get("CONTEXT_PACKING_ENABLED", "true").lower() == "true"
+CONTEXT_TOKEN_BUDGET_CHAT = int(os.environ.get("CONTEXT_TOKEN_BUDGET_CHAT", "4000"))
+CONTEXT_TOKEN_BUDGET_PROGRAM = int(os.environ.get("CONTEXT_TOKEN_BUDGET_PROGRAM", "8000"))
+CONTEXT_SCORE_RATIO = float(os.environ.get("CONTEXT_SCORE_RATIO", "0.8"))
+CONTEXT_MIN_DOCUMENTS = int(os.environ.get("CONTEXT_MIN_DOCUMENTS", "3"))
+CONTEXT_DUPLICATE_SIMILARITY = float(os.environ.get("CONTEXT_DUPLICATE_SIMILARITY", "0.9"))
+CONTEXT_CHARS_PER_TOKEN = float(os.environ.get("CONTEXT_CHARS_PER_TOKEN", "4"))
+# A trimmed document shorter than this is dropped rather than kept as a stub
+CONTEXT_MIN_TRIM_TOKENS = int(os.environ.get("CONTEXT_MIN_TRIM_TOKENS", "200"))
+
+PACKING_EVENT = "context_packing"
+
+_WORD = re.compile(r"\w+")
+
+def estimate_tokens(text: str) -> int:
+    return int(len(text) / CONTEXT_CHARS_PER_TOKEN) + 1
+
+def _shingles(text: str, size: int = 5) -> Set[tuple]:
+    words = _WORD.findall(text.casefold())
+    return {tuple(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+def _trim(document: Document, max_tokens: int) -> Document:
+    limit = int(max_tokens * CONTEXT_CHARS_PER_TOKEN)
+    text = document.page_content[:limit]
+    # Cut at the last line break so the trimmed content does not end mid-sentence
+    cut = text.rfind("\n")
+    if cut > limit // 2:
+        text = text[:cut]
+    return Document(page_content=text + "\n[...]", metadata={**document.metadata, "trimmed": True})
+
+class ContextPacker:
+    def __init__(
+            self,
+            token_budget: int,
+            score_ratio: float = CONTEXT_SCORE_RATIO,
+            min_documents: int = CONTEXT_MIN_DOCUMENTS,
+            duplicate_similarity: float = CONTEXT_DUPLICATE_SIMILARITY
+            ):
+        """
+
+        Adaptive k, deduplication and token budget over the retrieved documents
+
+        Args:
+            token_budget: Maximum estimated tokens of the packed documents
+            score_ratio: Minimum score relative to the best document
+            min_documents: Documents always considered, whatever their score
+            duplicate_similarity: Word shingle Jaccard similarity above which two contents are duplicates
+        """
+        self.token_budget = token_budget
+        self.score_ratio = score_ratio
+        self.min_documents = min_documents
+        self.duplicate_similarity = duplicate_similarity
+
+    def pack(self, documents: List[Document]) -> tuple:
+        """
+        Pack the documents, best ranked first.
+
+        Args:
+            documents: The retrieved documents, best first
+
+        Returns:
+            tuple: The packed documents and a report of the documents and tokens before and after
+        """
+        tokens_in = sum(estimate_tokens(document.page_content) for document in documents)
+        candidates = documents
+        scores = [document.metadata.get("score") for document in documents]
+        if documents and all(score is not None for score in scores):
+            cutoff = max(scores) * self.score_ratio
+            candidates = [
+                document for i, document in enumerate(documents)
+                if i < self.min_documents or scores[i] >= cutoff
+            ]
+        after_scores = len(candidates)
+
+        packed: List[Document] = []
+        seen_ids = set()
+        seen_shingles: List[Set[tuple]] = []
+        used = 0
+        duplicates = 0
+        trimmed = 0
+        for document in candidates:
+            document_id = document.metadata.get("id")
+            if document_id is not None and document_id in seen_ids:
+                duplicates += 1
+                continue
+            shingles = _shingles(document.page_content)
+            if any(len(shingles & other) / (len(shingles | other) or 1) >= self.duplicate_similarity for other in seen_shingles):
+                duplicates += 1
+                continue
+            tokens = estimate_tokens(document.page_content)
+            remaining = self.token_budget - used
+            if tokens > remaining:
+                # The lowest ranked document that still fits is trimmed, the rest is dropped
+                if remaining >= CONTEXT_MIN_TRIM_TOKENS:
+                    document = _trim(document, remaining - estimate_tokens("\n[...]"))
+                    packed.append(document)
+                    used += estimate_tokens(document.page_content)
+                    trimmed += 1
+                break
+            packed.append(document)
+            used += tokens
+            seen_shingles.append(shingles)
+            if document_id is not None:
+                seen_ids.add(document_id)
+
+        report = {
+            "documents_in": len(documents),
+            "documents_after_scores": after_scores,
+            "documents_out": len(packed),
+            "duplicates": duplicates,
+            "trimmed": trimmed,
+            "tokens_in": tokens_in,
+            "tokens_out": used,
+            "tokens_saved": tokens_in - used,
+        }
+        return packed, report
+
+    def as_runnable(self) -> RunnableLambda:
+        """
+        Wrap the packer as a runnable that dispatches its report as a "context_packing" event.
+
+        Returns:
+            RunnableLambda: Maps the retrieved documents to the packed documents
+        """
+        def pack(documents: List[Document], config: RunnableConfig) -> List[Document]:
+            packed, report = self.pack(documents)
+            logger.info(f"Context packing: {report}")
+            dispatch_custom_event(PACKING_EVENT, report, config=config)
+            return packed
+
+        async def apack(documents: List[Document], config: RunnableConfig) -> List[Document]:
+            packed, report = self.pack(documents)
+            logger.info(f"Context packing: {report}")
+            await adispatch_custom_event(PACKING_EVENT, report, config=config)
+            return packed
+
+        return RunnableLambda(pack, afunc=apack, name="context_packer")
+
+def create_context_packer(type_of_chat: str) -> Optional[ContextPacker]:
+    """
+    Create the packer with the token budget of the type of chat.
+
+    Args:
+        type_of_chat: The type of chat (program or chat)
+
+    Returns:
+        ContextPacker: The packer, None when packing is disabled
+    """
+    if not CONTEXT_PACKING_ENABLED:
+        return None
+    budget = CONTEXT_TOKEN_BUDGET_PROGRAM if type_of_chat == "program" else CONTEXT_TOKEN_BUDGET_CHAT
+    return ContextPacker(token_budget=budget)
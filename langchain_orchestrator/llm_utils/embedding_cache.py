@@ -0,0 +1,206 @@
+"""
+Project:
+Dialectic Snippet Bot
+
+Purpose:
+Cache the query embeddings in front of the Bedrock embedding model.
+
+Comments:
+Learners ask the same standalone questions over and over, and every question is embedded before the
+vector search. The cache is keyed by (model id, normalized text) and has two tiers: an in-process LRU
+bounded in size, backed by an optional persistent store that survives container recycling, either a
+DynamoDB table (EMBEDDING_CACHE_TABLE) or a SQLite file under /tmp (EMBEDDING_CACHE_PATH).
+"""
+
+import array
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import boto3
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger()
+
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "2048"))
+EMBEDDING_CACHE_TABLE = os.environ.get("EMBEDDING_CACHE_TABLE")
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH")
+EMBEDDING_CACHE_TTL = int(os.environ.get("EMBEDDING_CACHE_TTL", str(30 * 24 * 3600)))
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize a query before it is used as a cache key: collapse whitespace and ignore case.
+
+    Args:
+        text: The query text
+
+    Returns:
+        str: The normalized text
+    """
+    return " ".join(text.split()).casefold()
+
+def _hash_key(model_id: str, text: str) -> str:
+    return hashlib.sha256(f"{model_id}\n{text}".encode("utf-8")).hexdigest()
+
+def _pack(vector: List[float]) -> bytes:
+    return array.array("f", vector).tobytes()
+
+def _unpack(data: bytes) -> List[float]:
+    vector = array.array("f")
+    vector.frombytes(bytes(data))
+    return vector.tolist()
+
+class SQLiteEmbeddingStore:
+    def __init__(self, path: str):
+        """
+
+        Persistent tier backed by a SQLite file, e.g. under /tmp so it survives warm invocations
+
+        Args:
+            path: The path of the SQLite file
+        """
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        self._connection.commit()
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            row = self._connection.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        return _unpack(row[0]) if row else None
+
+    def put(self, key: str, vector: List[float]) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", (key, _pack(vector))
+            )
+            self._connection.commit()
+
+class DynamoDBEmbeddingStore:
+    def __init__(self, table_name: str, ttl: int = EMBEDDING_CACHE_TTL):
+        """
+
+        Persistent tier backed by a DynamoDB table with a "CacheKey" partition key, shared by all containers
+
+        Args:
+            table_name: The name of the DynamoDB table
+            ttl: Seconds before an entry expires, through the "expireAt" TTL attribute
+        """
+        self._table = boto3.resource("dynamodb").Table(table_name)
+        self._ttl = ttl
+
+    def get(self, key: str) -> Optional[List[float]]:
+        item = self._table.get_item(Key={"CacheKey": key}).get("Item")
+        return _unpack(item["Vector"].value) if item else None
+
+    def put(self, key: str, vector: List[float]) -> None:
+        self._table.put_item(
+            Item={
+                "CacheKey": key,
+                "Vector": _pack(vector),
+                "expireAt": int(time.time()) + self._ttl
+            }
+        )
+
+def create_embedding_store():
+    """
+    Create the persistent tier configured through the environment, if any.
+
+    Returns:
+        The store, or None when neither EMBEDDING_CACHE_TABLE nor EMBEDDING_CACHE_PATH is set
+    """
+    if EMBEDDING_CACHE_TABLE:
+        return DynamoDBEmbeddingStore(EMBEDDING_CACHE_TABLE)
+    if EMBEDDING_CACHE_PATH:
+        return SQLiteEmbeddingStore(EMBEDDING_CACHE_PATH)
+    return None
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings, model_id: str, max_size: int = EMBEDDING_CACHE_SIZE, store=None):
+        """
+
+        Wrapping an embedding model with the two cache tiers
+
+        Args:
+            embeddings: The underlying embedding model
+            model_id: The embedding model ID, part of every cache key
+            max_size: Number of vectors kept in the in-process LRU
+            store: Optional persistent tier with get(key) and put(key, vector)
+        """
+        self.embeddings = embeddings
+        self.model_id = model_id
+        self.max_size = max_size
+        self.store = store
+        self._lru: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "store_hits": 0, "misses": 0, "store_errors": 0}
+
+    def _lookup(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            vector = self._lru.get(key)
+            if vector is not None:
+                self._lru.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return vector
+        if self.store is None:
+            return None
+        try:
+            vector = self.store.get(key)
+        except Exception as e:
+            # The persistent tier is an optimization, never fail the question because of it
+            logger.warning(f"Embedding cache store lookup failed: {str(e)}")
+            self._stats["store_errors"] += 1
+            return None
+        if vector is not None:
+            self._stats["store_hits"] += 1
+            self._remember(key, vector)
+        return vector
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        with self._lock:
+            self._lru[key] = vector
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+
+    def _store(self, key: str, vector: List[float]) -> None:
+        self._remember(key, vector)
+        if self.store is None:
+            return
+        try:
+            self.store.put(key, vector)
+        except Exception as e:
+            logger.warning(f"Embedding cache store write failed: {str(e)}")
+            self._stats["store_errors"] += 1
+
+    def embed_query(self, text: str) -> List[float]:
+        key = _hash_key(self.model_id, normalize_text(text))
+        vector = self._lookup(key)
+        if vector is None:
+            self._stats["misses"] += 1
+            vector = self.embeddings.embed_query(text)
+            self._store(key, vector)
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Report the cache counters and the hit rate over both tiers.
+
+        Returns:
+            Dict: Hits per tier, misses, store errors, LRU size and hit rate
+        """
+        with self._lock:
+            stats = {**self._stats, "size": len(self._lru)}
+        lookups = stats["memory_hits"] + stats["store_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["store_hits"]) / lookups if lookups else 0.0
+        return stats
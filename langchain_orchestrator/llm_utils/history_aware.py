@@ -15,6 +15,9 @@ Andrew Mark Dale - Research Assistant, AI Hub, Durham College
 from langchain_core.prompts import MessagesPlaceholder
 from langchain.prompts import ChatPromptTemplate
 
+# Messages of the chat history the prompts read, the stored window and the summary are sized from it
+PROMPT_HISTORY_MESSAGES = 5
+
 # This prompt recontextualizes the user's question based on the context of the chat history
 # Consider asking a question about a specific snippet and then asking a follow-up question about the same snippet.
 contextualize_q_system_prompt: str = """
@@ -29,7 +32,7 @@ Do NOT answer the question, just reformulate it if needed and otherwise return i
 contextualize_q_prompt: ChatPromptTemplate = ChatPromptTemplate.from_messages(
     [
         ("system", contextualize_q_system_prompt),
-        MessagesPlaceholder("chat_history", n_messages=5),
+        MessagesPlaceholder("chat_history", n_messages=PROMPT_HISTORY_MESSAGES),
         ("human", "{input}"),
     ]
 )
@@ -37,7 +40,7 @@ contextualize_q_prompt: ChatPromptTemplate = ChatPromptTemplate.from_messages(
 contextualize_program_prompt: ChatPromptTemplate = ChatPromptTemplate.from_messages(
     [
         ("system", contextualize_q_system_prompt),
-        MessagesPlaceholder("chat_history", n_messages=5),
+        MessagesPlaceholder("chat_history", n_messages=PROMPT_HISTORY_MESSAGES),
         ("human", "{input}"),
     ]
 )
\ No newline at end of file
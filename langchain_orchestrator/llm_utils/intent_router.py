@@ -0,0 +1,434 @@
+"""
+Project:
+Dialectic Snippet Bot
+
+Purpose:
+Route listing questions to the aggregate documents written by the indexer, instead of vector search.
+
+Comments:
+The indexer writes one deterministic document per program (all_programs_<program>_<lang>) and one with
+the number of snippets per course (all_courses_<lang>). Questions such as "list all snippets in program X"
+or "how many snippets per course" are recognized by keyword rules first, then by a small embedding
+classifier: the nearest example question, above ROUTER_SIMILARITY. The query embedding goes through the
+embedding cache, so it is reused by retrieval when the question is not routed. Either way a match is only
+routed when nothing but listing words and the program name is left in the question: "which snippets in the
+economics program explain inflation?" asks about a topic and goes to retrieval.
+
+On a match the aggregate document is fetched by metadata.id, from the local vector snapshot when one is
+loaded, otherwise from OpenSearch. With ROUTER_MODE=template the document is rendered as a table without
+any LLM call; with ROUTER_MODE=context it is the only context given to the QA prompt.
+"""
+
+import difflib
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from .embedding_cache import normalize_text
+from .local_index import get_local_index
+
+logger = logging.getLogger()
+
+ROUTER_ENABLED = os.environ.get("ROUTER_ENABLED", "true").lower() == "true"
+ROUTER_MODE = os.environ.get("ROUTER_MODE", "template")
+ROUTER_SIMILARITY = float(os.environ.get("ROUTER_SIMILARITY", "0.8"))
+ROUTER_CACHE_SECONDS = int(os.environ.get("ROUTER_CACHE_SECONDS", "300"))
+
+PROGRAM_LISTING = "program_listing"
+COURSE_COUNTS = "course_counts"
+
+SNIPPET_WORDS = r"(snippets?|capsules?)"
+
+# Checked in order, a program listing additionally needs a known program name in the question
+KEYWORD_RULES = {
+    "en": [
+        (PROGRAM_LISTING, re.compile(rf"\b(list|show|all|every|which|what)\b.*\b{SNIPPET_WORDS}\b.*\b(in|of|for)\b")),
+        (COURSE_COUNTS, re.compile(
+            rf"\bhow many {SNIPPET_WORDS}\b|\b{SNIPPET_WORDS} (per|by|in each|for each) (course|program)\b"
+            r"|\b(list|show)( me)?( all)?( of)?( the)? (courses|programs)\b|\ball (the )?(courses|programs)\b"
+        )),
+    ],
+    "fr": [
+        (PROGRAM_LISTING, re.compile(rf"\b(liste|lister|montre|tous|toutes|quels|quelles)\b.*\b{SNIPPET_WORDS}\b.*\b(du|de|dans|pour)\b")),
+        (COURSE_COUNTS, re.compile(
+            rf"\bcombien de {SNIPPET_WORDS}\b|\b{SNIPPET_WORDS} par (cours|programme)\b"
+            r"|\b(liste|lister|montre)(-moi)?( tous)?( les)? (cours|programmes)\b|\btous les (cours|programmes)\b"
+        )),
+    ],
+}
+
+# Words a listing request may be made of, besides the program name. Any other word is topical content,
+# the question is then answered by the retrieval chain even if a rule or the classifier matched.
+LISTING_WORDS = {
+    "en": set(
+        "list show display give tell get see want need find me i you we us can could would please all every each "
+        "the a an this that these those our your my of in for from on within inside to under at with about "
+        "which what are is were there do does did have has many much how number total count counts per by "
+        "snippet snippets capsule capsules program programs course courses available offered included contained "
+        "part belong belongs listed entire whole full complete and their its s".split()
+    ),
+    "fr": set(
+        "liste listes lister listez affiche afficher affichez montre montrer montrez donne donner donnez voir "
+        "veux voudrais peux pouvez tu vous je moi me m nous svp plait il y a tous toutes tout le la les l un une "
+        "des de du d dans pour sur en au aux à avec ce cet cette ces c est sont quels quelles quel quelle qui que "
+        "qu combien nombre total chaque par font fait partie snippet snippets capsule capsules programme "
+        "programmes cours disponibles disponible offerts inclus et leur leurs".split()
+    ),
+}
+
+# Example questions of the embedding classifier
+EXAMPLES = {
+    "en": {
+        PROGRAM_LISTING: [
+            "List all the snippets in this program",
+            "What snippets are part of the program?",
+            "Show me every snippet of the course",
+        ],
+        COURSE_COUNTS: [
+            "How many snippets does each course have?",
+            "Which courses are available?",
+            "Give me the number of snippets per program",
+        ],
+    },
+    "fr": {
+        PROGRAM_LISTING: [
+            "Liste tous les snippets de ce programme",
+            "Quels snippets font partie du programme?",
+            "Montre-moi tous les snippets du cours",
+        ],
+        COURSE_COUNTS: [
+            "Combien de snippets compte chaque cours?",
+            "Quels cours sont disponibles?",
+            "Donne-moi le nombre de snippets par programme",
+        ],
+    },
+}
+
+TEMPLATES = {
+    "en": {
+        PROGRAM_LISTING: ("**All snippets for program: {program}**", ["#", "Title", "Topic", "Options", "Snippet"]),
+        COURSE_COUNTS: ("**Snippets per course**", ["Course", "Number of snippets"]),
+        "total": "Total: {count} snippets",
+    },
+    "fr": {
+        PROGRAM_LISTING: ("**Tous les snippets du programme : {program}**", ["#", "Titre", "Sujet", "Options", "Snippet"]),
+        COURSE_COUNTS: ("**Snippets par cours**", ["Cours", "Nombre de snippets"]),
+        "total": "Total : {count} snippets",
+    },
+}
+
+_PROGRAM_ENTRY = re.compile(
+    r"Title: (?P<title>.*?) \n Topic: (?P<topic>.*?) \n Snippet URL: (?P<url>.*?) \n Order: (?P<order>\d+) "
+    r"Go Deeper URLs: .*? \n Number of options for snippet: (?P<options>.*?) \n",
+    re.DOTALL
+)
+_COURSE_ENTRY = re.compile(r"Course: (?P<course>.*?)\n Number of snippets: (?P<count>\d+)")
+
+class RoutedIntent(NamedTuple):
+    intent: str
+    document_id: str
+    program: Optional[str]
+    documents: List[Document]
+    # The rendered table, None when the documents go to the QA prompt
+    answer: Optional[str]
+
+def _cell(value: str) -> str:
+    return " ".join(str(value).split()).replace("|", "\\|")
+
+def _table(header: List[str], rows: List[List[str]]) -> str:
+    lines = ["| " + " | ".join(header) + " |", "|" + "---|" * len(header)]
+    lines.extend("| " + " | ".join(_cell(value) for value in row) + " |" for row in rows)
+    return "\n".join(lines)
+
+def render_aggregate(intent: str, document: Document, language: str) -> Optional[str]:
+    """
+    Render an aggregate document as a markdown table.
+
+    Args:
+        intent: PROGRAM_LISTING or COURSE_COUNTS
+        document: The aggregate document
+        language: The language of the answer
+
+    Returns:
+        str: The table, None if the document could not be parsed
+    """
+    templates = TEMPLATES.get(language, TEMPLATES["en"])
+    title, header = templates[intent]
+    if intent == PROGRAM_LISTING:
+        entries = sorted(_PROGRAM_ENTRY.finditer(document.page_content), key=lambda m: int(m["order"]))
+        rows = [[m["order"], m["title"], m["topic"], m["options"], f"[{m['title'].strip()}]({m['url'].strip()})"] for m in entries]
+        title = title.format(program=document.metadata.get("program", ""))
+    else:
+        rows = [[m["course"], m["count"]] for m in _COURSE_ENTRY.finditer(document.page_content)]
+    if not rows:
+        return None
+    total = len(rows) if intent == PROGRAM_LISTING else sum(int(row[1]) for row in rows)
+    return f"{title}\n\n{_table(header, rows)}\n\n{templates['total'].format(count=total)}"
+
+class AggregateStore:
+    def __init__(self, client: Any = None, index_name: Optional[str] = None, ttl: int = ROUTER_CACHE_SECONDS):
+        """
+
+        Fetch the aggregate documents by metadata.id, from the local vector snapshot when one is loaded,
+        otherwise from OpenSearch. Documents and program names are cached for ttl seconds, they only
+        change with a reindex.
+
+        Args:
+            client: The OpenSearch client
+            index_name: The OpenSearch index
+            ttl: Seconds a fetched document or program list is reused
+        """
+        self.client = client
+        self.index_name = index_name
+        self.ttl = ttl
+        self._cache: Dict[tuple, tuple] = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, key: tuple, load):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                return entry[0]
+        value = load()
+        with self._lock:
+            self._cache[key] = (value, now)
+        return value
+
+    def _search(self, query: Dict[str, Any], size: int) -> List[Dict[str, Any]]:
+        if self.client is None:
+            return []
+        response = self.client.search(
+            index=self.index_name,
+            body={"query": query, "size": size, "_source": ["page_content", "metadata"]}
+        )
+        return [hit["_source"] for hit in response["hits"]["hits"]]
+
+    def get(self, document_id: str, language: str) -> Optional[Document]:
+        """
+        Get an aggregate document by its metadata.id.
+
+        Args:
+            document_id: The metadata.id, e.g. all_courses_en
+            language: The language of the document
+
+        Returns:
+            Document: The document, None if it does not exist
+        """
+        def load() -> Optional[Document]:
+            index = get_local_index()
+            if index is not None:
+                entries = [entry for entry in index.iter_documents(language) if entry["metadata"].get("id") == document_id]
+            else:
+                entries = self._search({"term": {"metadata.id.keyword": document_id}}, 1)
+            if not entries:
+                return None
+            return Document(page_content=entries[0]["page_content"], metadata=entries[0]["metadata"])
+        return self._cached(("document", document_id), load)
+
+    def programs(self, language: str) -> List[str]:
+        """
+        List the programs that have an aggregate document.
+
+        Args:
+            language: The language of the documents
+
+        Returns:
+            List: The program names
+        """
+        def load() -> List[str]:
+            index = get_local_index()
+            if index is not None:
+                entries = list(index.iter_documents(language))
+            else:
+                entries = self._search({"bool": {"filter": [
+                    {"prefix": {"metadata.id.keyword": "all_programs_"}},
+                    {"term": {"metadata.language": language}},
+                ]}}, 1000)
+            return sorted({
+                entry["metadata"]["program"] for entry in entries
+                if str(entry["metadata"].get("id", "")).startswith("all_programs_") and entry["metadata"].get("program")
+            })
+        return self._cached(("programs", language), load)
+
+class IntentRouter:
+    def __init__(
+            self,
+            store: AggregateStore,
+            embeddings: Optional[Embeddings] = None,
+            similarity_threshold: float = ROUTER_SIMILARITY,
+            mode: str = ROUTER_MODE
+            ):
+        """
+
+        Route listing questions to the aggregate documents
+
+        Args:
+            store: Where the aggregate documents are fetched from
+            embeddings: Embeddings of the classifier, keyword rules only if None
+            similarity_threshold: Minimum cosine similarity to the nearest example question
+            mode: "template" to render a table, "context" to answer from the aggregate document
+        """
+        self.store = store
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self.mode = mode
+        self._examples: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "rule_matches": 0, "classifier_matches": 0, "topical": 0, "misses": 0, "templates": 0, "contexts": 0, "not_found": 0
+        }
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def _example_vectors(self, language: str) -> tuple:
+        with self._lock:
+            if language not in self._examples:
+                intents, texts = [], []
+                for intent, examples in EXAMPLES[language].items():
+                    intents.extend([intent] * len(examples))
+                    texts.extend(examples)
+                vectors = np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+                vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+                self._examples[language] = (intents, vectors)
+            return self._examples[language]
+
+    def classify(self, message: str, language: str) -> Optional[str]:
+        """
+        Classify the question with the keyword rules, then with the nearest example question.
+
+        Args:
+            message: The user question
+            language: "en" or "fr"
+
+        Returns:
+            str: PROGRAM_LISTING, COURSE_COUNTS or None
+        """
+        text = normalize_text(message)
+        for intent, pattern in KEYWORD_RULES[language]:
+            if pattern.search(text):
+                self._count("rule_matches")
+                return intent
+        if self.embeddings is None:
+            return None
+        intents, vectors = self._example_vectors(language)
+        query = np.asarray(self.embeddings.embed_query(message), dtype=np.float32)
+        similarities = vectors @ (query / (np.linalg.norm(query) or 1.0))
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+        self._count("classifier_matches")
+        return intents[best]
+
+    def match_program(self, message: str, language: str) -> Optional[str]:
+        """
+        Find the program named in the question, exactly or as a close match of the same number of words.
+
+        Args:
+            message: The user question
+            language: The language of the programs
+
+        Returns:
+            str: The program name, None if no program matches
+        """
+        text = normalize_text(message)
+        programs = self.store.programs(language)
+        exact = [program for program in programs if normalize_text(program) in text]
+        if exact:
+            return max(exact, key=len)
+        words = text.split()
+        best, best_ratio = None, 0.85
+        for program in programs:
+            name = normalize_text(program)
+            size = len(name.split())
+            for i in range(max(len(words) - size + 1, 1)):
+                ratio = difflib.SequenceMatcher(None, name, " ".join(words[i:i + size])).ratio()
+                if ratio > best_ratio:
+                    best, best_ratio = program, ratio
+        return best
+
+    def topical_words(self, message: str, language: str, program: Optional[str]) -> List[str]:
+        """
+        List the words of the question that are neither listing words nor part of the program name.
+
+        Args:
+            message: The user question
+            language: "en" or "fr"
+            program: The program matched in the question, its words (or close matches) are not topical
+
+        Returns:
+            List: The leftover words, empty for a plain listing request
+        """
+        program_words = re.findall(r"\w+", normalize_text(program)) if program else []
+        leftover = []
+        for word in re.findall(r"\w+", normalize_text(message)):
+            if word in LISTING_WORDS[language] or word in program_words:
+                continue
+            if any(difflib.SequenceMatcher(None, word, name).ratio() >= 0.8 for name in program_words):
+                continue
+            leftover.append(word)
+        return leftover
+
+    def route(self, message: str, language: Optional[str], type_of_chat: Optional[str]) -> Optional[RoutedIntent]:
+        """
+        Route a question to an aggregate document.
+
+        Args:
+            message: The user question
+            language: The language of the conversation
+            type_of_chat: The type of chat, program generation is never routed
+
+        Returns:
+            RoutedIntent: The intent with its document and, in template mode, the rendered answer. None when
+            the question goes through the retrieval chain.
+        """
+        if type_of_chat == "program" or language not in KEYWORD_RULES:
+            return None
+        intent = self.classify(message, language)
+        program = self.match_program(message, language) if intent is not None else None
+        if intent == PROGRAM_LISTING and program is None:
+            # A listing without a known program name is left to the retrieval chain
+            intent = None
+        elif intent == COURSE_COUNTS and program is not None:
+            intent = PROGRAM_LISTING
+        if intent is not None:
+            topical = self.topical_words(message, language, program)
+            if topical:
+                # The question mentions a listing but asks about something else, e.g. a topic within the program
+                logger.info(f"Not routed to {intent}, topical words left: {len(topical)}")
+                self._count("topical")
+                intent = None
+        if intent is None:
+            self._count("misses")
+            return None
+
+        document_id = f"all_programs_{program}_{language}" if intent == PROGRAM_LISTING else f"all_courses_{language}"
+        document = self.store.get(document_id, language)
+        if document is None:
+            logger.warning(f"Aggregate document {document_id} not found, using the retrieval chain")
+            self._count("not_found")
+            return None
+        answer = render_aggregate(intent, document, language) if self.mode == "template" else None
+        self._count("templates" if answer is not None else "contexts")
+        logger.info(f"Routed to {intent} ({document_id}), {'template' if answer is not None else 'context'} answer")
+        return RoutedIntent(intent, document_id, program, [document], answer)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Report the routing counters.
+
+        Returns:
+            Dict: Rule and classifier matches, matches left to retrieval for their topical words, misses,
+            template and context answers, missing documents
+        """
+        with self._lock:
+            return dict(self._stats)
@@ -1,13 +1,38 @@
 import boto3
+import hashlib
 import importlib.util
+import json
+import logging
+import os
 import sys
+import threading
+import time
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+PROMPTS_BUCKET = os.environ.get("PROMPTS_BUCKET", "llm-aihub-prompts")
+PROMPTS_KEY = os.environ.get("PROMPTS_KEY", "snippet_prompts.py")
+PROMPTS_CACHE_DIR = os.environ.get("PROMPTS_CACHE_DIR", "/tmp/prompts")
+PROMPTS_REFRESH_SECONDS = int(os.environ.get("PROMPTS_REFRESH_SECONDS", "30"))
+
+def _module_from_source(content, key, module_name):
+    spec = importlib.util.spec_from_loader(
+        module_name,
+        loader=importlib.machinery.SourceFileLoader(module_name, key)
+    )
+
+    module = importlib.util.module_from_spec(spec)
+    exec(content, module.__dict__)
+    sys.modules[module_name] = module
+    return module
 
 def load_prompts_from_s3(bucket_name, key, module_name="snippet_prompts"):
     """
-    
+
     Download the Python module from s3 and import direcly into memory
-    
-    
+
+
     Args:
         bucket_name: The name of the bucket
         key: The key of the object
@@ -20,20 +45,159 @@ def load_prompts_from_s3(bucket_name, key, module_name="snippet_prompts"):
     s3_client = boto3.client('s3')
     response = s3_client.get_object(Bucket=bucket_name, Key=key)
     content = response['Body'].read()
-    
-    spec = importlib.util.spec_from_loader(
-        module_name,
-        loader=importlib.machinery.SourceFileLoader(module_name, key)
-    )
+    return _module_from_source(content, key, module_name)
 
-    module = importlib.util.module_from_spec(spec)
-    sys.modules[module_name] = module
-    exec(content, module.__dict__)
-    return module
+class PromptStore:
+    def __init__(
+            self,
+            bucket_name=PROMPTS_BUCKET,
+            key=PROMPTS_KEY,
+            module_name="snippet_prompts",
+            cache_dir=PROMPTS_CACHE_DIR,
+            refresh_seconds=PROMPTS_REFRESH_SECONDS
+            ):
+        """
+
+        Versioned cache of the prompts module. The module body and its ETag are kept in memory and under
+        cache_dir, and revalidated against S3 with a conditional get at most every refresh_seconds, off
+        the caller's thread once a module is loaded.
+        When the object changed, the new module is swapped in and the listeners are called.
+
+        Args:
+            bucket_name: The name of the bucket
+            key: The key of the object
+            module_name: The name of the module
+            cache_dir: The directory where the body and ETag are persisted
+            refresh_seconds: Minimum interval between two revalidations
+        """
+        self.bucket_name = bucket_name
+        self.key = key
+        self.module_name = module_name
+        self.cache_dir = cache_dir
+        self.refresh_seconds = refresh_seconds
+        self.module = None
+        self.etag = None
+        self.version = None
+        self._last_check = 0.0
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._s3_client = None
+
+    def add_listener(self, callback):
+        """
+        Register a callback called with the new module after every swap.
+        """
+        self._listeners.append(callback)
+
+    def _paths(self):
+        return os.path.join(self.cache_dir, self.key + ".body"), os.path.join(self.cache_dir, self.key + ".meta.json")
+
+    def _load_cached(self):
+        body_path, meta_path = self._paths()
+        try:
+            with open(meta_path) as f:
+                etag = json.load(f)["etag"]
+            with open(body_path, "rb") as f:
+                content = f.read()
+        except (OSError, ValueError, KeyError):
+            return False
+        self._swap(content, etag, notify=False)
+        logger.info(f"Loaded prompts from {body_path}, ETag {etag}")
+        return True
+
+    def _save_cached(self, content, etag):
+        body_path, meta_path = self._paths()
+        try:
+            os.makedirs(os.path.dirname(body_path), exist_ok=True)
+            with open(body_path, "wb") as f:
+                f.write(content)
+            with open(meta_path, "w") as f:
+                json.dump({"etag": etag}, f)
+        except OSError as e:
+            logger.warning(f"Could not persist the prompts under {self.cache_dir}: {str(e)}")
+
+    def _swap(self, content, etag, notify=True):
+        module = _module_from_source(content, self.key, self.module_name)
+        self.module = module
+        self.etag = etag
+        self.version = hashlib.sha256(content).hexdigest()[:16]
+        if notify:
+            for callback in self._listeners:
+                try:
+                    callback(module)
+                except Exception as e:
+                    logger.error(f"Prompt swap listener failed: {str(e)}")
+
+    def _fetch(self, etag):
+        # Conditional get, None when the object did not change since etag
+        if self._s3_client is None:
+            self._s3_client = boto3.client('s3')
+        params = {"Bucket": self.bucket_name, "Key": self.key}
+        if etag:
+            params["IfNoneMatch"] = etag
+        try:
+            response = self._s3_client.get_object(**params)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("304", "NotModified"):
+                return None
+            raise
+        return response['Body'].read(), response["ETag"]
+
+    def _apply(self, content, etag):
+        # Called with the lock held
+        changed = self.module is not None
+        self._swap(content, etag, notify=changed)
+        self._save_cached(content, etag)
+        logger.info(f"{'Swapped' if changed else 'Loaded'} prompts s3://{self.bucket_name}/{self.key}, ETag {etag}")
+
+    def _revalidate_in_background(self):
+        # The S3 round trip runs without the lock, readers keep getting the current module meanwhile
+        try:
+            fetched = self._fetch(self.etag)
+            if fetched is not None:
+                with self._lock:
+                    self._apply(*fetched)
+        except Exception as e:
+            logger.warning(f"Could not revalidate the prompts, keeping ETag {self.etag}: {str(e)}")
+        finally:
+            self._refreshing = False
+
+    def get(self):
+        """
+        Get the prompts module, revalidating it when the refresh interval has elapsed.
+        A failed revalidation keeps serving the current module.
+
+        Returns:
+            The module
+        """
+        return self.snapshot()[0]
+
+    def snapshot(self):
+        """
+        Get the prompts module together with its version, so what is built from the module and what is
+        keyed by the version always match, even if a swap happens right after.
+        Only the first load waits for S3. Once a module is loaded, a stale one is returned as is and
+        revalidated by a background thread, the new module is swapped in when it completes.
+
+        Returns:
+            tuple: The module and its version
+        """
+        with self._lock:
+            if self.module is None:
+                self._load_cached()
+            if self.module is None:
+                self._last_check = time.monotonic()
+                fetched = self._fetch(None)
+                self._apply(*fetched)
+            elif not self._refreshing and time.monotonic() - self._last_check >= self.refresh_seconds:
+                self._last_check = time.monotonic()
+                self._refreshing = True
+                threading.Thread(target=self._revalidate_in_background, name="prompts-revalidate", daemon=True).start()
+            return self.module, self.version
+
+PROMPT_STORE = PromptStore()
 
 def main():
-    prompts_module = load_prompts_from_s3(
-        "llm-aihub-prompts",
-        "snippet_prompts.py"
-    )
-    return prompts_module
\ No newline at end of file
+    prompts_module = PROMPT_STORE.get()
+    return prompts_module
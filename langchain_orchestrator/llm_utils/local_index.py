@@ -0,0 +1,318 @@
+"""
+Project:
+Dialectic Snippet Bot
+
+Purpose:
+In-process replica of the vector index, loaded from a versioned snapshot written by the indexers.
+
+Comments:
+The snapshot lives under s3://VECTOR_SNAPSHOT_BUCKET/VECTOR_SNAPSHOT_PREFIX/: a manifest.json naming the
+current base version and the deltas appended since by the incremental updates, and per version or delta and
+per language a float32 vectors.npy, its squared norms and the documents as JSON lines. Each segment (the base
+or a delta) is downloaded once under /tmp and the vectors are memory mapped, so warm containers search without
+any network hop; documents deleted or replaced by a later delta are masked out. The language is a partition rather than a filter, and the exact L2 search
+is one matrix-vector product over the partition. Scores follow the OpenSearch l2 space: 1 / (1 + d^2).
+OpenSearch stays the fallback when no snapshot is configured or it cannot be loaded.
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import boto3
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+logger = logging.getLogger()
+
+VECTOR_SNAPSHOT_BUCKET = os.environ.get("VECTOR_SNAPSHOT_BUCKET")
+VECTOR_SNAPSHOT_PREFIX = os.environ.get("VECTOR_SNAPSHOT_PREFIX", "vector_snapshot")
+VECTOR_SNAPSHOT_DIR = os.environ.get("VECTOR_SNAPSHOT_DIR", "/tmp/vector_snapshot")
+VECTOR_SNAPSHOT_REFRESH_SECONDS = int(os.environ.get("VECTOR_SNAPSHOT_REFRESH_SECONDS", "300"))
+
+# Language -> (vectors, squared norms, documents) of one segment
+Segment = Dict[str, Tuple[np.ndarray, np.ndarray, List[Dict[str, Any]]]]
+
+def snapshot_key(manifest: Dict[str, Any]) -> tuple:
+    """
+    Identify the content of a manifest: its base version and its deltas.
+
+    Args:
+        manifest: The snapshot manifest
+
+    Returns:
+        tuple: The version followed by the delta ids
+    """
+    return (manifest["version"],) + tuple(delta["id"] for delta in manifest.get("deltas", []))
+
+def _segments(manifest: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any], List[str]]]:
+    segments = [(manifest["version"], manifest["languages"], [])]
+    segments += [(delta["id"], delta["languages"], delta["deleted"]) for delta in manifest.get("deltas", [])]
+    return segments
+
+def _load_segment(directory: str, languages: Dict[str, Any]) -> Segment:
+    segment = {}
+    for language, files in languages.items():
+        vectors = np.load(os.path.join(directory, files["vectors"]), mmap_mode="r")
+        norms = np.load(os.path.join(directory, files["norms"]), mmap_mode="r")
+        with open(os.path.join(directory, files["documents"]), encoding="utf-8") as f:
+            documents = [json.loads(line) for line in f if line.strip()]
+        if len(documents) != vectors.shape[0]:
+            raise ValueError(f"Snapshot partition {language} has {vectors.shape[0]} vectors for {len(documents)} documents")
+        segment[language] = (vectors, norms, documents)
+    return segment
+
+class LocalVectorIndex:
+    def __init__(
+            self,
+            version: str,
+            partitions: Dict[str, List[Tuple[np.ndarray, np.ndarray, List[Dict[str, Any]], Optional[np.ndarray]]]],
+            key: Optional[tuple] = None,
+            segments: Optional[Dict[str, Segment]] = None
+            ):
+        """
+
+        Vectors, squared norms and documents per language, one entry per segment of the snapshot
+
+        Args:
+            version: The base version of the snapshot
+            partitions: Language -> [(vectors, squared norms, documents, alive mask or None if all alive)]
+            key: The version and delta ids, see snapshot_key
+            segments: The loaded segments by name, reused by the next load
+        """
+        self.version = version
+        self.partitions = partitions
+        self.key = key or (version,)
+        self.segments = segments or {}
+
+    @classmethod
+    def load(cls, directory: str, manifest: Dict[str, Any], loaded: Optional[Dict[str, Segment]] = None) -> "LocalVectorIndex":
+        """
+        Load a snapshot from its downloaded segments, memory mapping the vectors. The documents of a segment
+        whose metadata.id a later delta deleted or replaced are masked out.
+
+        Args:
+            directory: The directory holding one sub-directory per segment
+            manifest: The snapshot manifest
+            loaded: Segments already loaded by the previous index, reused instead of being read again
+
+        Returns:
+            LocalVectorIndex: The loaded index
+        """
+        segments = _segments(manifest)
+        # The ids deleted by the deltas after each segment
+        deleted_after = []
+        deleted: set = set()
+        for _, _, segment_deleted in reversed(segments):
+            deleted_after.append(set(deleted))
+            deleted |= set(segment_deleted)
+        deleted_after.reverse()
+
+        loaded = loaded or {}
+        by_name = {}
+        partitions: Dict[str, list] = {}
+        for (name, languages, _), deleted in zip(segments, deleted_after):
+            segment = loaded.get(name)
+            if segment is None:
+                segment = _load_segment(os.path.join(directory, name), languages)
+            by_name[name] = segment
+            for language, (vectors, norms, documents) in segment.items():
+                alive = None
+                if deleted:
+                    alive = np.fromiter((document["metadata"].get("id") not in deleted for document in documents), dtype=bool, count=len(documents))
+                    if alive.all():
+                        alive = None
+                partitions.setdefault(language, []).append((vectors, norms, documents, alive))
+        return cls(manifest["version"], partitions, snapshot_key(manifest), by_name)
+
+    def iter_documents(self, language: Optional[str] = None):
+        """
+        Iterate the documents of the language partition, all partitions if language is None.
+
+        Args:
+            language: The language partition
+
+        Returns:
+            Iterator: The documents as {"page_content", "metadata"} dicts
+        """
+        names = [language] if language is not None else list(self.partitions)
+        for name in names:
+            for _, _, documents, alive in self.partitions.get(name, []):
+                for i, document in enumerate(documents):
+                    if alive is None or alive[i]:
+                        yield document
+
+    def search(self, query_vector: List[float], k: int, language: Optional[str] = None) -> List[Tuple[Document, float]]:
+        """
+        Exact L2 search in the language partition, all partitions if language is None.
+
+        Args:
+            query_vector: The query embedding
+            k: The number of documents to return
+            language: The language partition
+
+        Returns:
+            List: (document, score) pairs, best first
+        """
+        if language is not None:
+            names = [language] if language in self.partitions else []
+        else:
+            names = list(self.partitions)
+        query = np.asarray(query_vector, dtype=np.float32)
+        query_norm = float(query @ query)
+        candidates = []
+        for name in names:
+            for position, (vectors, norms, documents, alive) in enumerate(self.partitions[name]):
+                if not documents:
+                    continue
+                # ||x - q||^2 = ||x||^2 - 2 x.q + ||q||^2, one matrix-vector product for the whole segment
+                distances = norms - 2 * (vectors @ query) + query_norm
+                if alive is not None:
+                    distances = np.where(alive, distances, np.inf)
+                top = min(k, len(documents))
+                best = np.argpartition(distances, top - 1)[:top]
+                candidates.extend((float(distances[i]), name, position, int(i)) for i in best if np.isfinite(distances[i]))
+        candidates.sort()
+        results = []
+        for distance, name, position, i in candidates[:k]:
+            entry = self.partitions[name][position][2][i]
+            document = Document(page_content=entry["page_content"], metadata=entry["metadata"])
+            results.append((document, 1.0 / (1.0 + max(distance, 0.0))))
+        return results
+
+class LocalIndexRetriever(BaseRetriever):
+    """
+    Retriever over the local vector index, with the same k and language filter as the OpenSearch retriever.
+    The index is resolved on every query, so a refreshed snapshot is picked up by cached chains, and the
+    fallback retriever is used whenever no snapshot is loaded.
+    """
+
+    embeddings: Any
+    fallback: Optional[BaseRetriever] = None
+    k: int = 15
+    language: Optional[str] = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        index = get_local_index()
+        if index is None:
+            if self.fallback is None:
+                raise RuntimeError("No vector snapshot loaded and no fallback retriever")
+            return self.fallback.invoke(query, config={"callbacks": run_manager.get_child()})
+        query_vector = self.embeddings.embed_query(query)
+        results = index.search(query_vector, self.k, self.language)
+        for document, score in results:
+            document.metadata = {**document.metadata, "score": score}
+        return [document for document, _ in results]
+
+_index: Optional[LocalVectorIndex] = None
+_manifest_etag: Optional[str] = None
+_last_check = 0.0
+_refreshing = False
+_lock = threading.Lock()
+
+def _download_snapshot(s3_client, manifest: Dict[str, Any]) -> str:
+    # Segments already on disk are kept, only the new deltas (or a new base version) are downloaded
+    for name, languages, _ in _segments(manifest):
+        directory = os.path.join(VECTOR_SNAPSHOT_DIR, name)
+        if os.path.exists(os.path.join(directory, "segment.json")):
+            continue
+        os.makedirs(directory, exist_ok=True)
+        for files in languages.values():
+            for file in ("vectors", "norms", "documents"):
+                s3_client.download_file(
+                    VECTOR_SNAPSHOT_BUCKET,
+                    f"{VECTOR_SNAPSHOT_PREFIX}/{name}/{files[file]}",
+                    os.path.join(directory, files[file])
+                )
+        # Written last, it marks the segment as complete
+        with open(os.path.join(directory, "segment.json"), "w") as f:
+            json.dump(languages, f)
+    return VECTOR_SNAPSHOT_DIR
+
+def _remove_old_segments(manifest: Dict[str, Any]) -> None:
+    # The memory maps of the previous index stay valid after the files are unlinked
+    current = {name for name, _, _ in _segments(manifest)}
+    for name in os.listdir(VECTOR_SNAPSHOT_DIR):
+        if name not in current:
+            shutil.rmtree(os.path.join(VECTOR_SNAPSHOT_DIR, name), ignore_errors=True)
+
+def _refresh(index: Optional[LocalVectorIndex], etag: Optional[str]) -> None:
+    # The S3 round trips and the download run without the lock, readers keep the current index meanwhile
+    global _index, _manifest_etag, _refreshing
+    try:
+        s3_client = boto3.client("s3")
+        params = {"Bucket": VECTOR_SNAPSHOT_BUCKET, "Key": f"{VECTOR_SNAPSHOT_PREFIX}/manifest.json"}
+        if etag and index is not None:
+            params["IfNoneMatch"] = etag
+        try:
+            response = s3_client.get_object(**params)
+        except s3_client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("304", "NotModified"):
+                return
+            raise
+        manifest = json.loads(response["Body"].read())
+        loaded = index
+        if index is None or snapshot_key(manifest) != index.key:
+            start = time.perf_counter()
+            loaded = LocalVectorIndex.load(
+                _download_snapshot(s3_client, manifest),
+                manifest,
+                index.segments if index is not None else None
+            )
+            logger.info(
+                f"Loaded vector snapshot {loaded.version} with {len(manifest.get('deltas', []))} deltas "
+                f"in {time.perf_counter() - start:.2f} seconds"
+            )
+        with _lock:
+            _index, _manifest_etag = loaded, response["ETag"]
+        if loaded is not index:
+            try:
+                _remove_old_segments(manifest)
+            except OSError as e:
+                logger.warning(f"Could not remove the old snapshot segments: {str(e)}")
+    except Exception as e:
+        logger.error(f"Could not load the vector snapshot, keeping {index.version if index else 'OpenSearch'}: {str(e)}")
+    finally:
+        with _lock:
+            _refreshing = False
+
+def get_local_index() -> Optional[LocalVectorIndex]:
+    """
+    Get the local vector index. The snapshot is checked at most every VECTOR_SNAPSHOT_REFRESH_SECONDS,
+    whether an index is loaded or the last attempt failed. The first load runs in the calling request,
+    later checks in a background thread, and the new index is swapped in when it is ready; requests
+    arriving during a load get the current index, or None and the OpenSearch fallback.
+
+    Returns:
+        LocalVectorIndex: The index, or None when no snapshot is configured or none is loaded yet
+    """
+    global _last_check, _refreshing
+    if not VECTOR_SNAPSHOT_BUCKET:
+        return None
+    with _lock:
+        now = time.monotonic()
+        if _refreshing or (_last_check and now - _last_check < VECTOR_SNAPSHOT_REFRESH_SECONDS):
+            return _index
+        _last_check = now
+        _refreshing = True
+        index, etag = _index, _manifest_etag
+    if index is None:
+        _refresh(None, None)
+        return _index
+    threading.Thread(target=_refresh, args=(index, etag), name="vector-snapshot-refresh", daemon=True).start()
+    return index
+
+def get_snapshot_generation() -> Optional[str]:
+    """
+    Get the manifest ETag of the loaded snapshot, it changes with every snapshot written by the indexers.
+
+    Returns:
+        str: The ETag, None when no snapshot is loaded
+    """
+    return _manifest_etag if _index is not None else None
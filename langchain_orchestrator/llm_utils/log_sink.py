@@ -0,0 +1,101 @@
+"""
+Project:
+Dialectic Snippet Bot
+
+Purpose:
+Keep log I/O off the streaming path.
+
+Comments:
+configure_logging() moves the handlers of the root logger behind a queue drained by a background
+thread, so logger calls only enqueue the record. flush_logs() waits for the queue to drain and is
+called before the handler returns, as Lambda freezes the container once the invocation ends.
+Message and chunk contents are only logged for a sampled fraction of the requests
+(LOG_CONTENT_SAMPLE_RATE), and Lambda events are logged as a redacted summary.
+"""
+
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_ASYNC = os.environ.get("LOG_ASYNC", "true").lower() == "true"
+LOG_CONTENT_SAMPLE_RATE = float(os.environ.get("LOG_CONTENT_SAMPLE_RATE", "0"))
+
+_queue: Optional[queue.Queue] = None
+_listener: Optional[QueueListener] = None
+
+def configure_logging(level: str = LOG_LEVEL) -> logging.Logger:
+    """
+    Set the root log level and hand the records to the background flusher, once per container.
+
+    Args:
+        level: The root log level
+
+    Returns:
+        logging.Logger: The root logger
+    """
+    global _queue, _listener
+    root = logging.getLogger()
+    root.setLevel(level)
+    if not LOG_ASYNC or _listener is not None:
+        return root
+    handlers = root.handlers[:] or [logging.StreamHandler()]
+    for handler in handlers:
+        root.removeHandler(handler)
+    _queue = queue.Queue(-1)
+    root.addHandler(QueueHandler(_queue))
+    _listener = QueueListener(_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return root
+
+def flush_logs() -> None:
+    """
+    Wait for the background flusher to write every queued record.
+    """
+    if _queue is not None:
+        _queue.join()
+
+def should_log_content() -> bool:
+    """
+    Decide whether the contents of this request are logged.
+
+    Returns:
+        bool: True for a LOG_CONTENT_SAMPLE_RATE fraction of the calls
+    """
+    return LOG_CONTENT_SAMPLE_RATE > 0 and random.random() < LOG_CONTENT_SAMPLE_RATE
+
+def redact(text: Optional[str], sampled: bool = False) -> str:
+    """
+    Redact a content for logging unless the request is sampled.
+
+    Args:
+        text: The content
+        sampled: Whether the contents of this request are logged
+
+    Returns:
+        str: The content, or its length only
+    """
+    if text is None:
+        return "None"
+    return text if sampled else f"<redacted {len(text)} chars>"
+
+def summarize_event(event: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Summarize a WebSocket event for logging, without the message body or the headers.
+
+    Args:
+        event: The Lambda event
+
+    Returns:
+        Dict: Route, connection ID, request ID and body size
+    """
+    request_context = event.get("requestContext", {})
+    return {
+        "routeKey": request_context.get("routeKey"),
+        "connectionId": request_context.get("connectionId"),
+        "requestId": request_context.get("requestId"),
+        "bodyBytes": len(event.get("body") or ""),
+    }
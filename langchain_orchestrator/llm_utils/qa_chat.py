@@ -15,63 +15,103 @@ Comments:
 This module takes our defined prompt and generates a response based on the chat history and user input.
 """
 
-from .load_prompts import main
+from typing import Optional
+from .load_prompts import main, PROMPT_STORE
+from .history_aware import PROMPT_HISTORY_MESSAGES
 from langchain.prompts import ChatPromptTemplate
 from langchain_core.prompts import MessagesPlaceholder
 
-try:
-    prompts = main()
-    SNIPPET_PROMPT = prompts.SNIPPET_PROMPT
-    SNIPPET_PROGRAM_PROMPT = prompts.SNIPPET_PROGRAM_PROMPT
+def get_prompts():
+    """
+    
+    Function to get the prompts module. It is downloaded on first use rather than at import time,
+    and revalidated against S3 by the prompt store.
+    
+    Returns:
+        The prompts module with SNIPPET_PROMPT and SNIPPET_PROGRAM_PROMPT
+    """
+    return main()
 
-except Exception as e:
-    print(e)
+def get_prompt_version() -> str:
+    """
+    
+    Function to get the version of the prompts. It changes whenever the prompts change, cached answers are partitioned by it.
+    
+    Returns:
+        str: A short hash of the prompts module
+    """
+    return PROMPT_STORE.snapshot()[1]
 
-question_answer_prompt: ChatPromptTemplate = ChatPromptTemplate.from_messages(
-    [
-        ("system", SNIPPET_PROMPT),
-        MessagesPlaceholder("chat_history", n_messages=10),
-        ("human", "{input}"),
-    ]
-)
+def get_prompt_snapshot():
+    """
+    
+    Function to get the prompts module and its version at once. Chains built from the module and answers
+    cached under the version then always refer to the same prompts.
+    
+    Returns:
+        tuple: The prompts module and its version
+    """
+    return PROMPT_STORE.snapshot()
 
-snippet_program_prompt: ChatPromptTemplate = ChatPromptTemplate.from_messages(
-    [
-        ("system", SNIPPET_PROGRAM_PROMPT),
-        MessagesPlaceholder("chat_history", n_messages=5),
-        ("human", "{input}"),
-    ]
-)
+def __getattr__(name: str):
+    # Module level prompts, built on first access so importing this module does not download them
+    if name == "SNIPPET_PROMPT":
+        return get_prompts().SNIPPET_PROMPT
+    if name == "SNIPPET_PROGRAM_PROMPT":
+        return get_prompts().SNIPPET_PROGRAM_PROMPT
+    if name == "PROMPT_VERSION":
+        return get_prompt_version()
+    if name == "question_answer_prompt":
+        return ChatPromptTemplate.from_messages(
+            [
+                ("system", get_prompts().SNIPPET_PROMPT),
+                MessagesPlaceholder("chat_history", n_messages=10),
+                ("human", "{input}"),
+            ]
+        )
+    if name == "snippet_program_prompt":
+        return ChatPromptTemplate.from_messages(
+            [
+                ("system", get_prompts().SNIPPET_PROGRAM_PROMPT),
+                MessagesPlaceholder("chat_history", n_messages=PROMPT_HISTORY_MESSAGES),
+                ("human", "{input}"),
+            ]
+        )
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-def create_snippet_prompt(language: str, prompt: str = SNIPPET_PROMPT) -> ChatPromptTemplate:
+def create_snippet_prompt(language: str, prompt: Optional[str] = None) -> ChatPromptTemplate:
     """
     
     Function to create a snippet prompt.
     
     Args:
-        prompt: The prompt to use
+        prompt: The prompt to use, SNIPPET_PROMPT if None
     """
+    if prompt is None:
+        prompt = get_prompts().SNIPPET_PROMPT
     return ChatPromptTemplate.from_messages(
         [
             ("system", prompt.replace("{language}", language)),
-            MessagesPlaceholder("chat_history", n_messages=5),
+            MessagesPlaceholder("chat_history", n_messages=PROMPT_HISTORY_MESSAGES),
             ("human", "{input}"),
         ]
     )
 
-def create_program_prompt(language: str, prompt: str = SNIPPET_PROGRAM_PROMPT) -> ChatPromptTemplate:
+def create_program_prompt(language: str, prompt: Optional[str] = None) -> ChatPromptTemplate:
     """
     
     Function to create a program prompt.
     
     Args:
-        prompt: The prompt to use
+        prompt: The prompt to use, SNIPPET_PROGRAM_PROMPT if None
     """
+    if prompt is None:
+        prompt = get_prompts().SNIPPET_PROGRAM_PROMPT
 
     return ChatPromptTemplate.from_messages(
         [
             ("system", prompt.replace("{language}", language)),
-            MessagesPlaceholder("chat_history", n_messages=5),
+            MessagesPlaceholder("chat_history", n_messages=PROMPT_HISTORY_MESSAGES),
             ("human", "{input}"),
         ]
     )
\ No newline at end of file
@@ -1,50 +1,113 @@
+import asyncio
 from collections.abc import AsyncGenerator
 from typing import Dict, Any, List, Optional
+from langchain_core.documents import Document
 from langchain_core.messages import HumanMessage, AIMessage
-from .session_history import get_session_history
+from .session_history import open_session_history
+from .answer_cache import AnswerCache
 import logging
 
-async def get_ai_response(message: str, chain, session_id: str) -> AsyncGenerator:
+# Cached answers are replayed in pieces of this size so they go through the normal stream frames
+REPLAY_CHUNK_CHARS = 256
+
+async def get_ai_response(
+        message: str,
+        chain,
+        session_id: str,
+        cancel_event: Optional[asyncio.Event] = None,
+        answer_cache: Optional[AnswerCache] = None,
+        cache_scope: Optional[tuple] = None,
+        callbacks: Optional[List[Any]] = None,
+        answer: Optional[str] = None,
+        context: Optional[List[Document]] = None
+        ) -> AsyncGenerator:
     """
     Function to get the AI response, sending only incremental chunks
+
+    Once cancel_event is set the chain stream is closed, which closes the Bedrock stream.
+    The partial answer is deliberately not written to the session history: the session is
+    the WebSocket connection, and a cancelled stream means that connection is gone.
+
+    When the session has no history the question is standalone, and the answer cache is
+    consulted first. A cached answer is replayed and written to the history like a generated one.
+
+    The session history is read once here and shared with the chain. New turns are only buffered;
+    the caller persists them with close_session_history() once the answer is sent.
+
+    Routed questions come with either a rendered answer, replayed like a cached one without running
+    the chain, or the documents to answer from, passed to the chain as its "context" input.
+
     Args:
     message: The message
     chain: The chain
     session_id: The session ID
+    cancel_event: Optional event that stops the generation when set
+    answer_cache: Optional cache for the answers to standalone questions
+    cache_scope: The (language, type_of_chat, index generation, prompt version) partition of the answer cache
+    callbacks: Optional callback handlers passed to the chain run, e.g. the stage tracer
+    answer: Optional precomputed answer, replayed instead of running the chain
+    context: Optional documents given to the chain instead of retrieved ones
     """
     logger = logging.getLogger()
     logger.info("Getting AI response")
     
-    history = get_session_history(session_id)
-    chat_history = []
-    for msg in history.messages:
-        if isinstance(msg, HumanMessage):
-            chat_history.append({"type": "human", "content": msg.content})
-        elif isinstance(msg, AIMessage):
-            chat_history.append({"type": "ai", "content": msg.content})
-    
+    history = await open_session_history(session_id)
+    has_history = bool(await history.aget_messages())
+
+    use_cache = answer_cache is not None and cache_scope is not None and not has_history and answer is None
+    if use_cache:
+        answer = await asyncio.to_thread(answer_cache.lookup, cache_scope, message)
+        if answer is not None:
+            logger.info(f"Answer cache hit, replaying {len(answer)} chars")
+    if answer is not None:
+        for start in range(0, len(answer), REPLAY_CHUNK_CHARS):
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            yield answer[start:start + REPLAY_CHUNK_CHARS]
+        history.add_messages([HumanMessage(content=message), AIMessage(content=answer)])
+        return
+
     # For debugging
     chunk_counter = 0
     total_length = 0
+    answer_parts = []
+    completed = False
     
     logger.info("Starting AI response stream")
+    config = {"configurable": {"session_id": session_id}}
+    if callbacks:
+        config["callbacks"] = callbacks
+    inputs = {"input": message}
+    if context is not None:
+        inputs["context"] = context
+    stream = chain.astream(
+        inputs,
+        config=config
+    )
     try:
-        async for chunk in chain.astream(
-            {"input": message},
-            config={"configurable": {"session_id": session_id}}
-        ):
+        async for chunk in stream:
+            if cancel_event is not None and cancel_event.is_set():
+                logger.warning(f"Generation cancelled after {chunk_counter} chunks, {total_length} chars")
+                break
             if 'answer' in chunk and chunk['answer'] != "":
                 chunk_counter += 1
                 new_content = chunk['answer']
                 
+                # Per chunk only counters, the totals are logged once the stream ends
                 total_length += len(new_content)
-                logger.info(f"Sending chunk #{chunk_counter}: {len(new_content)} chars, total so far: {total_length}")
-                logger.info(f"Chunk content: {new_content}")
+                answer_parts.append(new_content)
                 
                 yield new_content
-        
+        else:
+            completed = True
         logger.info(f"Streaming complete: {chunk_counter} chunks, {total_length} total chars")
         
     except Exception as e:
         logger.error(f"Error in get_ai_response streaming: {str(e)}")
-        yield f"Error generating response: {str(e)}"
\ No newline at end of file
+        yield f"Error generating response: {str(e)}"
+    finally:
+        # Closing the stream before the end aborts the model call, the history is only written on completion
+        await stream.aclose()
+
+    if use_cache and completed and answer_parts:
+        await asyncio.to_thread(answer_cache.store, cache_scope, message, "".join(answer_parts))
\ No newline at end of file
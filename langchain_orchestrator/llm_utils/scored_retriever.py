@@ -0,0 +1,48 @@
+"""
+Project:
+Dialectic Snippet Bot
+
+Purpose:
+Vector store retriever that keeps the similarity score of every document.
+
+Comments:
+VectorStoreRetriever drops the scores, which the context packer needs for its adaptive k. This retriever
+runs the same similarity search with the same search kwargs and stores the score in metadata["score"],
+like the LocalIndexRetriever does. With the OpenSearch l2 space the score is 1 / (1 + d^2).
+With include_vectors the whole _source is fetched and the stored vector is kept in metadata["vector"],
+for the re-ranking compressor.
+"""
+
+from typing import Any, Dict, List
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+
+class ScoredVectorStoreRetriever(BaseRetriever):
+    """
+    Similarity search retriever that adds the score to the metadata of each document.
+    """
+
+    vectorstore: VectorStore
+    search_kwargs: Dict[str, Any] = {}
+    include_vectors: bool = False
+    vector_field: str = "vector_field"
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        if not self.include_vectors:
+            results = self.vectorstore.similarity_search_with_score(query, **self.search_kwargs)
+            for document, score in results:
+                document.metadata = {**document.metadata, "score": float(score)}
+            return [document for document, _ in results]
+        # metadata_field="*" returns the whole _source as metadata, split it back into metadata and vector
+        results = self.vectorstore.similarity_search_with_score(query, metadata_field="*", **self.search_kwargs)
+        documents = []
+        for document, score in results:
+            source = document.metadata
+            metadata = {**source.get("metadata", {}), "score": float(score)}
+            if source.get(self.vector_field) is not None:
+                metadata["vector"] = source[self.vector_field]
+            documents.append(Document(page_content=document.page_content, metadata=metadata))
+        return documents
@@ -1,27 +1,259 @@
-from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, messages_from_dict
+import asyncio
+import json
+import logging
 import os
-from langchain_community.chat_message_histories import DynamoDBChatMessageHistory
+import time
+import zlib
+from typing import Callable, Dict, List, Optional, Sequence
+import boto3
+from botocore.exceptions import ClientError
 from dotenv import load_dotenv
+from .history_aware import PROMPT_HISTORY_MESSAGES
 
 load_dotenv()
 
+logger = logging.getLogger()
+
 DYNAMODB_TABLE_NAME = os.environ.get("DYNAMO_TABLE_NAME")
 DYNAMODB_MESSAGE_TTL = int(os.environ.get("DYNAMODB_MESSAGE_TTL"))  # 24 hours default TTL
+# Older turns are dropped or, with a summarizer, folded into the summary. With a summarizer the window
+# is capped at PROMPT_HISTORY_MESSAGES - 1, so the summary message stays within what the prompts read.
+HISTORY_MAX_MESSAGES = int(os.environ.get("HISTORY_MAX_MESSAGES", "6"))
+PRIMARY_KEY_NAME = "SessionId"
+
+_MESSAGE_TYPES = {"human": HumanMessage, "ai": AIMessage, "system": SystemMessage}
+
+def _compress_messages(messages: Sequence[BaseMessage]) -> bytes:
+    # Only the type and the content are needed to rebuild the prompt, the metadata is dropped
+    compact = [{"t": message.type, "c": message.content} for message in messages]
+    return zlib.compress(json.dumps(compact, separators=(",", ":")).encode("utf-8"))
+
+def _decompress_messages(data: bytes) -> List[BaseMessage]:
+    compact = json.loads(zlib.decompress(bytes(data)).decode("utf-8"))
+    return [_MESSAGE_TYPES.get(message["t"], HumanMessage)(content=message["c"]) for message in compact]
+
+def make_llm_summarizer(llm) -> Callable[[str, List[BaseMessage]], str]:
+    """
+    Create a summarizer that folds dropped turns into the rolling summary with an LLM call.
+
+    Args:
+        llm: The chat model used to write the summary
+
+    Returns:
+        Callable: Takes the previous summary and the dropped messages, returns the new summary
+    """
+    def summarize(summary: str, messages: List[BaseMessage]) -> str:
+        turns = "\n".join(f"{message.type}: {message.content}" for message in messages)
+        response = llm.invoke(
+            "Update the running summary of a conversation with the new turns. "
+            "Keep the snippet titles, programs and user preferences, in at most 5 sentences.\n\n"
+            f"Current summary:\n{summary or 'None'}\n\nNew turns:\n{turns}"
+        )
+        return response.content
+    return summarize
+
+_table = None
+
+def _get_table():
+    global _table
+    if _table is None:
+        _table = boto3.resource("dynamodb").Table(DYNAMODB_TABLE_NAME)
+    return _table
+
+class BufferedDynamoDBChatMessageHistory(BaseChatMessageHistory):
+    """
+    Chat message history that reads the DynamoDB item once and writes the new turns back once.
+
+    The item holds a bounded window of the last max_messages messages, zlib compressed in "HistoryZ",
+    an optional rolling "Summary" of the older turns, and a "Version" counter that makes the write
+    conditional, so concurrent writers never lose turns. Items in the DynamoDBChatMessageHistory
+    layout ("History") are still read, and rewritten in the compact layout on the next write.
+    Messages added while answering are only buffered; flush() persists them with a single put.
+    """
+
+    def __init__(
+            self,
+            session_id: str,
+            table_name: str = DYNAMODB_TABLE_NAME,
+            ttl: int = DYNAMODB_MESSAGE_TTL,
+            max_messages: int = HISTORY_MAX_MESSAGES,
+            summarizer: Optional[Callable[[str, List[BaseMessage]], str]] = None,
+            write_behind: bool = True
+            ):
+        self.session_id = session_id
+        self.table_name = table_name
+        self.ttl = ttl
+        self.max_messages = max_messages
+        if summarizer is not None:
+            # The summary is prepended as one more message
+            self.max_messages = min(max_messages, PROMPT_HISTORY_MESSAGES - 1)
+        self.summarizer = summarizer
+        self.write_behind = write_behind
+        self._messages: Optional[List[BaseMessage]] = None
+        self._pending: List[BaseMessage] = []
+        self._summary = ""
+        self._version = 0
+
+    def load(self) -> None:
+        """
+        Read the session item, the only read for the message.
+        """
+        response = _get_table().get_item(Key={PRIMARY_KEY_NAME: self.session_id})
+        item = response.get("Item") or {}
+        if "HistoryZ" in item:
+            self._messages = _decompress_messages(item["HistoryZ"].value)
+        else:
+            self._messages = messages_from_dict(item.get("History", []))
+        self._summary = item.get("Summary", "")
+        self._version = int(item.get("Version", 0))
+
+    async def aload(self) -> None:
+        if self._messages is None:
+            await asyncio.to_thread(self.load)
+
+    def _with_summary(self) -> List[BaseMessage]:
+        if not self._summary:
+            return list(self._messages)
+        return [SystemMessage(content=f"Summary of the earlier conversation: {self._summary}")] + self._messages
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        if self._messages is None:
+            self.load()
+        return self._with_summary()
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        await self.aload()
+        return self._with_summary()
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        if self._messages is None:
+            self.load()
+        self._messages.extend(messages)
+        self._pending.extend(messages)
+        if not self.write_behind:
+            self.flush()
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        await self.aload()
+        self.add_messages(messages)
+
+    def flush(self) -> None:
+        """
+        Persist the buffered turns with one conditional write. If another writer got there first,
+        reload the item and append the buffered turns to it once more.
+        """
+        if not self._pending:
+            return
+        for attempt in range(2):
+            try:
+                self._put()
+                self._pending = []
+                return
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException" or attempt == 1:
+                    raise
+                logger.warning(f"Session {self.session_id} changed concurrently, merging the new turns")
+                self.load()
+                self._messages.extend(self._pending)
+
+    def _trim(self) -> None:
+        # Keep the window bounded so the item size, and the read and write costs, stay constant
+        overflow = len(self._messages) - self.max_messages
+        if overflow <= 0:
+            return
+        dropped = self._messages[:overflow]
+        self._messages = self._messages[overflow:]
+        if self.summarizer is not None:
+            try:
+                self._summary = self.summarizer(self._summary, dropped)
+            except Exception as e:
+                logger.warning(f"Could not summarize the history of session {self.session_id}: {str(e)}")
+
+    def _put(self) -> None:
+        self._trim()
+        item = {
+            PRIMARY_KEY_NAME: self.session_id,
+            "HistoryZ": _compress_messages(self._messages),
+            "Version": self._version + 1,
+        }
+        if self._summary:
+            item["Summary"] = self._summary
+        if self.ttl:
+            item["expireAt"] = int(time.time()) + self.ttl
+        _get_table().put_item(
+            Item=item,
+            ConditionExpression="attribute_not_exists(#version) OR #version = :version",
+            ExpressionAttributeNames={"#version": "Version"},
+            ExpressionAttributeValues={":version": self._version},
+        )
+        self._version += 1
+
+    def clear(self) -> None:
+        _get_table().delete_item(Key={PRIMARY_KEY_NAME: self.session_id})
+        self._messages = []
+        self._pending = []
+        self._summary = ""
+        self._version = 0
+
+# Summarizer of the dropped turns, set with set_history_summarizer() to enable the rolling summary
+_summarizer: Optional[Callable[[str, List[BaseMessage]], str]] = None
+
+def set_history_summarizer(summarizer: Optional[Callable[[str, List[BaseMessage]], str]]) -> None:
+    """
+    Enable, or disable with None, the rolling summary of the turns that fall out of the window.
+
+    Args:
+        summarizer: Takes the previous summary and the dropped messages, returns the new summary
+    """
+    global _summarizer
+    _summarizer = summarizer
+
+# Histories opened for the message being processed, so the chain reuses the already loaded item
+_open_histories: Dict[str, BufferedDynamoDBChatMessageHistory] = {}
+
+async def open_session_history(session_id: str) -> BufferedDynamoDBChatMessageHistory:
+    """
+    Load the chat message history of a session once for the message being processed.
+
+    Args:
+        session_id: The session ID for the conversation
+
+    Returns:
+        BufferedDynamoDBChatMessageHistory: The loaded history, also returned by get_session_history
+    """
+    history = _open_histories.get(session_id)
+    if history is None:
+        history = BufferedDynamoDBChatMessageHistory(session_id, summarizer=_summarizer)
+        _open_histories[session_id] = history
+    await history.aload()
+    return history
+
+async def close_session_history(session_id: str) -> None:
+    """
+    Persist the turns buffered while answering and forget the opened history.
+
+    Args:
+        session_id: The session ID for the conversation
+    """
+    history = _open_histories.pop(session_id, None)
+    if history is not None:
+        await asyncio.to_thread(history.flush)
 
 def get_session_history(session_id: str) -> BaseChatMessageHistory:
     """
     Retrieve chat message history for a session from DynamoDB.
-    
+
     Args:
         session_id: The session ID for the conversation
-    
+
     Returns:
         BaseChatMessageHistory: The chat message history for the session
     """
-    return DynamoDBChatMessageHistory(
-        table_name=DYNAMODB_TABLE_NAME,
-        session_id=session_id,
-        primary_key_name="SessionId",
-        ttl=DYNAMODB_MESSAGE_TTL
-    )
\ No newline at end of file
+    history = _open_histories.get(session_id)
+    if history is not None:
+        return history
+    # Not opened for a message, so there is no later flush: write the turns through
+    return BufferedDynamoDBChatMessageHistory(session_id, summarizer=_summarizer, write_behind=False)
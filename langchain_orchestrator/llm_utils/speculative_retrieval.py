@@ -0,0 +1,125 @@
+"""
+Project:
+Dialectic Snippet Bot
+
+Purpose:
+History-aware retrieval that runs the vector search on the raw input while the question is rephrased.
+
+Comments:
+create_history_aware_retriever rephrases the question with the LLM and only then searches, so every
+follow-up turn pays a full LLM round trip before retrieval starts. Here both run at the same time. When
+the rephrased question is close to the raw input (embedding cosine similarity above
+SPECULATIVE_RETRIEVAL_THRESHOLD) the speculative documents are kept, otherwise the rephrased question is
+searched. Both embeddings go through the embedding cache, so the comparison costs at most the embedding
+the re-query needs anyway. The outcome of every speculation is dispatched as a "speculative_retrieval"
+custom event, counted per request by the StageTracer, and in the process-wide get_speculation_stats().
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import numpy as np
+from langchain_core.callbacks.manager import adispatch_custom_event, dispatch_custom_event
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import BasePromptTemplate
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import RunnableBranch, RunnableConfig, RunnableLambda
+
+from .embedding_cache import normalize_text
+
+logger = logging.getLogger()
+
+SPECULATIVE_RETRIEVAL_ENABLED = os.environ.get("SPECULATIVE_RETRIEVAL_ENABLED", "true").lower() == "true"
+SPECULATIVE_RETRIEVAL_THRESHOLD = float(os.environ.get("SPECULATIVE_RETRIEVAL_THRESHOLD", "0.9"))
+
+SPECULATION_EVENT = "speculative_retrieval"
+
+_stats = {"hits": 0, "misses": 0}
+_stats_lock = threading.Lock()
+
+def get_speculation_stats() -> Dict[str, Any]:
+    """
+    Report how often the speculative retrieval was kept.
+
+    Returns:
+        Dict: hits, misses and the hit rate
+    """
+    with _stats_lock:
+        total = _stats["hits"] + _stats["misses"]
+        return {**_stats, "hit_rate": round(_stats["hits"] / total, 3) if total else None}
+
+def _similarity(embeddings: Embeddings, original: str, rephrased: str) -> float:
+    if normalize_text(original) == normalize_text(rephrased):
+        return 1.0
+    a = np.asarray(embeddings.embed_query(original), dtype=np.float32)
+    b = np.asarray(embeddings.embed_query(rephrased), dtype=np.float32)
+    denominator = float(np.linalg.norm(a) * np.linalg.norm(b))
+    return float(a @ b) / denominator if denominator else 0.0
+
+def _record(similarity: float, threshold: float) -> Dict[str, Any]:
+    hit = similarity >= threshold
+    with _stats_lock:
+        _stats["hits" if hit else "misses"] += 1
+    logger.debug(f"Speculative retrieval {'kept' if hit else 'discarded'}, similarity {similarity:.3f}")
+    return {"hit": hit, "similarity": similarity}
+
+def create_speculative_history_aware_retriever(
+        llm: BaseLanguageModel,
+        retriever: BaseRetriever,
+        prompt: BasePromptTemplate,
+        embeddings: Embeddings,
+        threshold: float = SPECULATIVE_RETRIEVAL_THRESHOLD
+        ):
+    """
+
+    Drop-in replacement for create_history_aware_retriever that searches the raw input while the
+    question is rephrased, and only searches again when the rephrased question drifted.
+
+    Args:
+        llm: The model rephrasing the question
+        retriever: The retriever
+        prompt: The contextualize prompt, with "input" and "chat_history"
+        embeddings: Embeddings used to compare the raw and rephrased questions
+        threshold: Minimum cosine similarity to keep the speculative documents
+
+    Returns:
+        Runnable: Returns the documents for {"input", "chat_history"}
+    """
+    rephrase = prompt | llm | StrOutputParser()
+
+    def speculate(inputs: Dict[str, Any], config: RunnableConfig) -> List[Document]:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            rephrased_future = executor.submit(rephrase.invoke, inputs, config)
+            speculative_future = executor.submit(retriever.invoke, inputs["input"], config)
+            rephrased = rephrased_future.result()
+            speculative = speculative_future.result()
+        outcome = _record(_similarity(embeddings, inputs["input"], rephrased), threshold)
+        dispatch_custom_event(SPECULATION_EVENT, outcome, config=config)
+        return speculative if outcome["hit"] else retriever.invoke(rephrased, config)
+
+    async def aspeculate(inputs: Dict[str, Any], config: RunnableConfig) -> List[Document]:
+        rephrased, speculative = await asyncio.gather(
+            rephrase.ainvoke(inputs, config),
+            retriever.ainvoke(inputs["input"], config)
+        )
+        # Both embeddings are usually cached: the raw input was just searched
+        similarity = await asyncio.to_thread(_similarity, embeddings, inputs["input"], rephrased)
+        outcome = _record(similarity, threshold)
+        await adispatch_custom_event(SPECULATION_EVENT, outcome, config=config)
+        return speculative if outcome["hit"] else await retriever.ainvoke(rephrased, config)
+
+    # Same shape and run name as create_history_aware_retriever, so the tracer sees the rephrase stage
+    return RunnableBranch(
+        (
+            lambda x: not x.get("chat_history", False),
+            (lambda x: x["input"]) | retriever,
+        ),
+        RunnableLambda(speculate, afunc=aspeculate),
+    ).with_config(run_name="chat_retriever_chain")
@@ -0,0 +1,135 @@
+"""
+Project:
+Dialectic Snippet Bot
+
+Purpose:
+Profile the cold start of the orchestrator Lambda.
+
+Comments:
+Imports and resources are initialized lazily, on the first route that needs them. Each import and
+resource initialization is timed, and the profile is emitted once per container as a single JSON
+line, on the first invocation. Only the standard library is used so profiling costs nothing itself.
+
+Run as a script to check the import time of the connect/disconnect path against a budget:
+python -m llm_utils.startup_profile --budget-ms 400
+"""
+
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+logger = logging.getLogger()
+
+STARTUP_BUDGET_MS = float(os.environ.get("STARTUP_BUDGET_MS", "400"))
+
+_PROCESS_START = time.perf_counter()
+_import_times: Dict[str, float] = {}
+_resource_times: Dict[str, float] = {}
+_emitted = False
+
+@contextmanager
+def profile_import(name: str) -> Iterator[None]:
+    """
+    Time the imports inside the block under the given name.
+
+    Args:
+        name: The module or group of modules imported
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _import_times[name] = _import_times.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+@contextmanager
+def profile_resource(name: str) -> Iterator[None]:
+    """
+    Time the initialization of a resource (client, model, table) under the given name.
+
+    Args:
+        name: The resource initialized
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _resource_times[name] = _resource_times.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+def get_startup_profile() -> Dict[str, object]:
+    """
+    Report the startup profile so far.
+
+    Returns:
+        Dict: Import and resource init times in milliseconds, their total and the time since process start
+    """
+    total = sum(_import_times.values()) + sum(_resource_times.values())
+    return {
+        "imports_ms": {name: round(ms, 1) for name, ms in _import_times.items()},
+        "resources_ms": {name: round(ms, 1) for name, ms in _resource_times.items()},
+        "total_ms": round(total, 1),
+        "since_process_start_ms": round((time.perf_counter() - _PROCESS_START) * 1000, 1),
+    }
+
+def emit_startup_profile(route: str) -> None:
+    """
+    Emit the startup profile once per container, on the first invocation.
+
+    Args:
+        route: The route of the first invocation
+    """
+    global _emitted
+    if _emitted:
+        return
+    _emitted = True
+    profile = {"startup_profile": get_startup_profile(), "route": route, "budget_ms": STARTUP_BUDGET_MS}
+    print(json.dumps(profile))
+    if profile["startup_profile"]["total_ms"] > STARTUP_BUDGET_MS:
+        logger.warning(f"Cold start of route {route} over budget: {profile['startup_profile']['total_ms']} ms > {STARTUP_BUDGET_MS} ms")
+
+def main() -> int:
+    """
+    Import the orchestrator in a fresh process and check the connect/disconnect import cost against the budget.
+
+    Returns:
+        int: 0 within budget, 1 over budget, for use as a regression gate
+    """
+    import argparse
+    import subprocess
+    import sys
+
+    parser = argparse.ArgumentParser(description="Check the orchestrator cold start against a time budget")
+    parser.add_argument("--budget-ms", type=float, default=STARTUP_BUDGET_MS)
+    args = parser.parse_args()
+
+    code = (
+        "import json, time; start = time.perf_counter(); import langchain_orchestrator; "
+        "from llm_utils.startup_profile import get_startup_profile; "
+        "profile = get_startup_profile(); profile['import_orchestrator_ms'] = round((time.perf_counter() - start) * 1000, 1); "
+        "profile['heavy_modules_loaded'] = sorted(m for m in ('langchain', 'langchain_aws', 'langchain_community', 'opensearchpy') "
+        "if m in __import__('sys').modules); print(json.dumps(profile))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        return 1
+    profile = json.loads(result.stdout.strip().splitlines()[-1])
+    print(json.dumps(profile, indent=2))
+    if profile["heavy_modules_loaded"]:
+        print(f"FAIL: connect/disconnect path imports {profile['heavy_modules_loaded']}")
+        return 1
+    if profile["import_orchestrator_ms"] > args.budget_ms:
+        print(f"FAIL: import took {profile['import_orchestrator_ms']} ms, budget {args.budget_ms} ms")
+        return 1
+    print(f"OK: import took {profile['import_orchestrator_ms']} ms, budget {args.budget_ms} ms")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
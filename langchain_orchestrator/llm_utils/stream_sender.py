@@ -0,0 +1,260 @@
+"""
+Project:
+Dialectic Snippet Bot
+
+Purpose:
+Coalesce the streamed LLM chunks into fewer WebSocket frames.
+
+Comments:
+Every frame is one post_to_connection round trip, so sending one frame per token is dominated by
+API Gateway latency. The sender buffers chunks and flushes when the buffer reaches a byte threshold,
+when the time window since the last frame has elapsed, or at the end of the stream. The first chunk
+is always sent on its own so the time to first token is not delayed by the buffering.
+
+The PipelinedSender decouples the model stream from the socket: the model stream fills a bounded
+queue and a single sender task drains it. A single task per connection keeps the frames in order,
+and whatever piles up in the queue while a frame is in flight is coalesced into the next frame.
+
+When a send reports that the client is gone, the pipeline sets its `cancelled` event so the
+producer can stop pulling tokens from the model, and every later chunk is dropped.
+"""
+
+import asyncio
+import os
+import time
+from collections.abc import Awaitable, Callable
+from typing import Dict, Optional
+
+STREAM_FLUSH_BYTES = int(os.environ.get("STREAM_FLUSH_BYTES", "512"))
+STREAM_FLUSH_INTERVAL_MS = int(os.environ.get("STREAM_FLUSH_INTERVAL_MS", "40"))
+STREAM_QUEUE_SIZE = int(os.environ.get("STREAM_QUEUE_SIZE", "256"))
+
+class CoalescingSender:
+    def __init__(
+            self,
+            send: Callable[[str, str], Awaitable[Optional[bool]]],
+            flush_bytes: int = STREAM_FLUSH_BYTES,
+            flush_interval_ms: int = STREAM_FLUSH_INTERVAL_MS
+            ):
+        """
+
+        Initializing the sender around a coroutine that sends one frame
+
+        Args:
+            send: Coroutine taking the frame content and the frame type ("stream", "done" or "error"),
+                returning False once the client is gone
+            flush_bytes: Flush once this many bytes are buffered
+            flush_interval_ms: Flush once this many milliseconds passed since the last frame
+        """
+        self._send = send
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval_ms / 1000
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._last_flush = time.monotonic()
+        self.chunks_received = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.gone = False
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._buffer)
+
+    def time_until_flush(self) -> float:
+        """
+        Seconds left before the time window forces a flush of the buffered chunks.
+        """
+        return max(0.0, self.flush_interval - (time.monotonic() - self._last_flush))
+
+    def append(self, chunk: str) -> None:
+        """
+        Buffer a chunk without flushing.
+
+        Args:
+            chunk: The streamed content
+        """
+        if not chunk:
+            return
+        self.chunks_received += 1
+        self._buffer.append(chunk)
+        self._buffered_bytes += len(chunk.encode('utf-8'))
+
+    async def maybe_flush(self) -> None:
+        """
+        Flush if this is the first frame, or if the byte threshold or the time window is reached.
+        """
+        if self._buffer and (
+            self.frames_sent == 0
+            or self._buffered_bytes >= self.flush_bytes
+            or self.time_until_flush() == 0
+        ):
+            await self.flush()
+
+    async def push(self, chunk: str) -> None:
+        """
+        Buffer a chunk and flush if the byte threshold or the time window is reached.
+
+        Args:
+            chunk: The streamed content
+        """
+        self.append(chunk)
+        await self.maybe_flush()
+
+    async def flush(self) -> None:
+        """
+        Send the buffered chunks as a single "stream" frame.
+        """
+        if not self._buffer:
+            return
+        data = "".join(self._buffer)
+        size = self._buffered_bytes
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._last_flush = time.monotonic()
+        if self.gone:
+            return
+        if await self._send(data, "stream") is False:
+            self.gone = True
+            return
+        self.frames_sent += 1
+        self.bytes_sent += size
+
+    async def close(self, type: str = "done", data: str = "") -> None:
+        """
+        Flush what is left and send the closing frame.
+
+        Args:
+            type: The closing frame type, "done" or "error"
+            data: The closing frame content
+        """
+        await self.flush()
+        if self.gone:
+            return
+        if await self._send(data, type) is False:
+            self.gone = True
+            return
+        self.frames_sent += 1
+
+    def metrics(self) -> Dict[str, int]:
+        """
+        Report the frame and byte counts of the stream.
+
+        Returns:
+            Dict: Chunks received, frames and bytes sent
+        """
+        return {
+            "chunks_received": self.chunks_received,
+            "frames_sent": self.frames_sent,
+            "bytes_sent": self.bytes_sent
+        }
+
+
+# Marks the end of the stream in the queue
+_END = object()
+
+class PipelinedSender:
+    def __init__(self, sender: CoalescingSender, maxsize: int = STREAM_QUEUE_SIZE):
+        """
+
+        Initializing the pipeline, call start() before putting chunks
+
+        Args:
+            sender: The coalescing sender drained by the sender task
+            maxsize: Number of chunks the queue holds before put() waits for the sender
+        """
+        self.sender = sender
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._task: Optional[asyncio.Task] = None
+        self._error: Optional[BaseException] = None
+        self._closing = None
+        self.max_queue_depth = 0
+        self.cancelled = asyncio.Event()
+
+    def start(self) -> "PipelinedSender":
+        self._task = asyncio.create_task(self._drain())
+        return self
+
+    async def put(self, chunk: str) -> None:
+        """
+        Queue a chunk for sending. Waits while the queue is full, which is the backpressure on the model stream.
+
+        Args:
+            chunk: The streamed content
+        """
+        if self.cancelled.is_set():
+            return
+        await self._queue.put(chunk)
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    async def close(self, type: str = "done", data: str = "") -> None:
+        """
+        Wait for the queued chunks to be sent, then send the closing frame.
+
+        Args:
+            type: The closing frame type, "done" or "error"
+            data: The closing frame content
+        """
+        if not self._task.done():
+            self._closing = (type, data)
+            await self._queue.put(_END)
+            await self._task
+        if self._error is not None:
+            raise self._error
+
+    async def _next(self):
+        # With chunks buffered, wait no longer than the time window before flushing them
+        while True:
+            if not self.sender.pending:
+                return await self._queue.get()
+            try:
+                return await asyncio.wait_for(self._queue.get(), timeout=self.sender.time_until_flush())
+            except asyncio.TimeoutError:
+                await self.sender.flush()
+                if self.sender.gone:
+                    self.cancelled.set()
+
+    async def _drain(self) -> None:
+        while True:
+            if self._error is None:
+                try:
+                    item = await self._next()
+                except Exception as e:
+                    self._error = e
+                    continue
+            else:
+                item = await self._queue.get()
+            if item is _END:
+                break
+            if self._error is not None or self.cancelled.is_set():
+                # Keep consuming so the producer never blocks on a dead sender
+                continue
+            self.sender.append(item)
+            # Take everything that queued up while the previous frame was in flight
+            while not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is _END:
+                    break
+                self.sender.append(item)
+            try:
+                await self.sender.maybe_flush()
+            except Exception as e:
+                self._error = e
+            if self.sender.gone:
+                self.cancelled.set()
+            if item is _END:
+                break
+        if self._error is None and not self.cancelled.is_set():
+            try:
+                await self.sender.close(*self._closing)
+            except Exception as e:
+                self._error = e
+
+    def metrics(self) -> Dict[str, int]:
+        """
+        Report the sender metrics and the deepest the queue got.
+
+        Returns:
+            Dict: Chunks received, frames and bytes sent, maximum queue depth
+        """
+        return {**self.sender.metrics(), "max_queue_depth": self.max_queue_depth}
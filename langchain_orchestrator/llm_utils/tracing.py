@@ -0,0 +1,330 @@
+"""
+Project:
+Dialectic Snippet Bot
+
+Purpose:
+Per-stage latency instrumentation of the RAG pipeline: rephrase, retrieve, generate and send.
+
+Comments:
+A RequestTrace collects the spans of one message. The StageTracer callback is passed to the chain
+through the runnable config and attributes every LLM and retriever run to its stage, using the run
+names set by create_history_aware_retriever ("chat_retriever_chain") and create_stuff_documents_chain
+("stuff_documents_chain"). It also counts the outcome of speculative retrievals and context packing.
+Sends are timed by the orchestrator.
+
+When the request finishes, the process-wide latency histograms are updated and the summary goes to
+the exporters: CloudWatch EMF lines by default, or an InMemoryExporter to assert the same data locally.
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+logger = logging.getLogger()
+
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "SnippetBot")
+
+# Chains whose descendant runs belong to a stage
+STAGE_RUN_NAMES = {
+    "chat_retriever_chain": "rephrase",
+    "stuff_documents_chain": "generate",
+}
+
+# Upper bounds of the histogram buckets in milliseconds, the last bucket is unbounded
+HISTOGRAM_BOUNDS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+class LatencyHistogram:
+    def __init__(self, bounds_ms: List[float] = HISTOGRAM_BOUNDS_MS):
+        """
+
+        Fixed bucket latency histogram
+
+        Args:
+            bounds_ms: Upper bounds of the buckets in milliseconds
+        """
+        self.bounds_ms = bounds_ms
+        self.counts = [0] * (len(bounds_ms) + 1)
+        self.total_ms = 0.0
+
+    def observe(self, value_ms: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds_ms, value_ms)] += 1
+        self.total_ms += value_ms
+
+    def percentile(self, q: float) -> Optional[float]:
+        """
+        Upper bound of the bucket holding the q-th percentile, None without observations.
+        """
+        total = sum(self.counts)
+        if total == 0:
+            return None
+        rank = q / 100 * total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.bounds_ms[i] if i < len(self.bounds_ms) else float("inf")
+        return float("inf")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"count": sum(self.counts), "total_ms": round(self.total_ms, 1), "buckets": self.counts}
+
+STAGE_HISTOGRAMS: Dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+_HISTOGRAMS_LOCK = threading.Lock()
+
+class RequestTrace:
+    def __init__(self, **dimensions: str):
+        """
+
+        Spans and counters of one message
+
+        Args:
+            dimensions: Dimensions of the emitted metrics, e.g. type_of_chat and language
+        """
+        self.dimensions = {key: str(value) for key, value in dimensions.items()}
+        self.start = time.perf_counter()
+        self.spans: List[tuple] = []
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.first_token_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def add_span(self, stage: str, start: float, end: float) -> None:
+        with self._lock:
+            self.spans.append((stage, start, end))
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    def mark_first_token(self) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+    @asynccontextmanager
+    async def span(self, stage: str):
+        """
+        Time the block as a span of the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(stage, start, time.perf_counter())
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Summarize the request: time per stage, time to first token, token counts and throughput.
+
+        Returns:
+            Dict: The request summary
+        """
+        end = time.perf_counter()
+        stages: Dict[str, Dict[str, float]] = {}
+        for stage, start, stop in self.spans:
+            entry = stages.setdefault(stage, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            duration = (stop - start) * 1000
+            entry["count"] += 1
+            entry["total_ms"] += duration
+            entry["max_ms"] = max(entry["max_ms"], duration)
+        summary = {
+            "dimensions": self.dimensions,
+            "total_ms": round((end - self.start) * 1000, 1),
+            "ttft_ms": round((self.first_token_at - self.start) * 1000, 1) if self.first_token_at else None,
+            "stages": {stage: {key: round(value, 1) for key, value in entry.items()} for stage, entry in stages.items()},
+            "counters": dict(self.counters),
+        }
+        generate = [span for span in self.spans if span[0] == "generate"]
+        completion_tokens = self.counters.get("completion_tokens") or self.counters.get("streamed_tokens", 0)
+        if generate and self.first_token_at and completion_tokens:
+            streaming_seconds = max(span[2] for span in generate) - self.first_token_at
+            if streaming_seconds > 0:
+                summary["tokens_per_second"] = round(completion_tokens / streaming_seconds, 1)
+        return summary
+
+class StageTracer(BaseCallbackHandler):
+    """
+    Callback that records the LLM and retriever runs of the chain as stage spans of a RequestTrace.
+    """
+
+    # Timing is only accurate when the callbacks are not deferred to an executor
+    run_inline = True
+
+    def __init__(self, trace: RequestTrace):
+        self.trace = trace
+        self._parents: Dict[UUID, Optional[UUID]] = {}
+        self._stage_roots: Dict[UUID, str] = {}
+        self._starts: Dict[UUID, tuple] = {}
+
+    def _stage_of(self, run_id: Optional[UUID], default: str) -> str:
+        while run_id is not None:
+            if run_id in self._stage_roots:
+                return self._stage_roots[run_id]
+            run_id = self._parents.get(run_id)
+        return default
+
+    def _start(self, run_id: UUID, parent_run_id: Optional[UUID], stage: str) -> None:
+        self._parents[run_id] = parent_run_id
+        self._starts[run_id] = (stage, time.perf_counter())
+
+    def _end(self, run_id: UUID) -> Optional[str]:
+        started = self._starts.pop(run_id, None)
+        if started is None:
+            return None
+        self.trace.add_span(started[0], started[1], time.perf_counter())
+        return started[0]
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs) -> None:
+        self._parents[run_id] = parent_run_id
+        name = kwargs.get("name") or (serialized or {}).get("name")
+        if name in STAGE_RUN_NAMES:
+            self._stage_roots[run_id] = STAGE_RUN_NAMES[name]
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs) -> None:
+        self._start(run_id, parent_run_id, self._stage_of(parent_run_id, "llm"))
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs) -> None:
+        self._start(run_id, parent_run_id, self._stage_of(parent_run_id, "llm"))
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs) -> None:
+        started = self._starts.get(run_id)
+        if started is not None and started[0] == "generate":
+            self.trace.mark_first_token()
+            self.trace.count("streamed_tokens")
+
+    def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        stage = self._end(run_id)
+        usage = (response.llm_output or {}).get("usage") or {}
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        if not usage:
+            for generations in response.generations:
+                for generation in generations:
+                    metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                    prompt_tokens += metadata.get("input_tokens", 0)
+                    completion_tokens += metadata.get("output_tokens", 0)
+        self.trace.count(f"{stage}_prompt_tokens", prompt_tokens)
+        self.trace.count(f"{stage}_completion_tokens", completion_tokens)
+        if stage == "generate":
+            self.trace.count("completion_tokens", completion_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs) -> None:
+        self._start(run_id, parent_run_id, "retrieve")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+        self.trace.count("retrieved_documents", len(documents))
+
+    def on_retriever_error(self, error, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_custom_event(self, name, data, *, run_id, **kwargs) -> None:
+        if name == "speculative_retrieval":
+            self.trace.count("speculation_hits" if data["hit"] else "speculation_misses")
+        elif name == "context_packing":
+            for key in ("documents_out", "tokens_in", "tokens_out", "tokens_saved"):
+                self.trace.count(f"context_{key}", data[key])
+
+class EMFExporter:
+    """
+    Print the request summary as a CloudWatch Embedded Metric Format line.
+    """
+
+    def __init__(self, namespace: str = METRICS_NAMESPACE):
+        self.namespace = namespace
+
+    def export(self, summary: Dict[str, Any]) -> None:
+        metrics = {"total_ms": summary["total_ms"]}
+        if summary["ttft_ms"] is not None:
+            metrics["ttft_ms"] = summary["ttft_ms"]
+        for stage, entry in summary["stages"].items():
+            metrics[f"{stage}_ms"] = entry["total_ms"]
+        for name, value in summary["counters"].items():
+            metrics[name] = value
+        if "tokens_per_second" in summary:
+            metrics["tokens_per_second"] = summary["tokens_per_second"]
+        dimensions = summary["dimensions"]
+        line = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [sorted(dimensions)],
+                    "Metrics": [
+                        {"Name": name, "Unit": "Milliseconds" if name.endswith("_ms") else "Count"}
+                        for name in metrics
+                    ],
+                }],
+            },
+            **dimensions,
+            **metrics,
+            "stages": summary["stages"],
+        }
+        print(json.dumps(line))
+
+class InMemoryExporter:
+    """
+    Keep the request summaries in memory, to assert them in tests and benchmarks.
+    """
+
+    def __init__(self):
+        self.summaries: List[Dict[str, Any]] = []
+
+    def export(self, summary: Dict[str, Any]) -> None:
+        self.summaries.append(summary)
+
+_exporters: List[Any] = [EMFExporter()]
+
+def set_exporters(exporters: List[Any]) -> None:
+    """
+    Replace the exporters the request summaries are sent to.
+
+    Args:
+        exporters: Objects with an export(summary) method
+    """
+    global _exporters
+    _exporters = list(exporters)
+
+def get_stage_histograms() -> Dict[str, Dict[str, Any]]:
+    """
+    Report the process-wide latency histograms per stage.
+
+    Returns:
+        Dict: Count, total and bucket counts per stage
+    """
+    with _HISTOGRAMS_LOCK:
+        return {stage: histogram.to_dict() for stage, histogram in STAGE_HISTOGRAMS.items()}
+
+def finish_trace(trace: RequestTrace) -> Dict[str, Any]:
+    """
+    Update the latency histograms and export the request summary.
+
+    Args:
+        trace: The finished request trace
+
+    Returns:
+        Dict: The request summary
+    """
+    summary = trace.summary()
+    with _HISTOGRAMS_LOCK:
+        STAGE_HISTOGRAMS["total"].observe(summary["total_ms"])
+        if summary["ttft_ms"] is not None:
+            STAGE_HISTOGRAMS["ttft"].observe(summary["ttft_ms"])
+        for stage, start, end in trace.spans:
+            STAGE_HISTOGRAMS[stage].observe((end - start) * 1000)
+    for exporter in _exporters:
+        try:
+            exporter.export(summary)
+        except Exception as e:
+            logger.error(f"Metrics exporter failed: {str(e)}")
+    return summary
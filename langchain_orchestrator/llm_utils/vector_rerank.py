@@ -0,0 +1,87 @@
+"""
+Project:
+Dialectic Snippet Bot
+
+Purpose:
+Re-rank and threshold the retrieved documents without embedding them again.
+
+Comments:
+EmbeddingsFilter embeds every candidate document through Bedrock to compare it with the query, 15 extra
+embedding calls per question. The documents were embedded at indexing time, and the search already
+compared them with the query, so the similarity is computed from what the hit carries:
+- the stored vector_field, when the retriever returns it in metadata["vector"], against the query vector
+  (an embedding cache hit, the retriever just embedded the same query), in one matrix-vector product;
+- otherwise the kNN score in metadata["score"]. Titan v2 embeddings are unit length, so the l2 score
+  1 / (1 + d^2) gives the cosine similarity exactly: cos = 1 - d^2 / 2.
+Documents carrying neither are passed through unchanged.
+"""
+
+import logging
+import os
+from typing import Any, Optional, Sequence
+
+import numpy as np
+from langchain_core.callbacks import Callbacks
+from langchain_core.documents import BaseDocumentCompressor, Document
+
+logger = logging.getLogger()
+
+RERANK_ENABLED = os.environ.get("RERANK_ENABLED", "true").lower() == "true"
+RERANK_SIMILARITY_THRESHOLD = float(os.environ.get("RERANK_SIMILARITY_THRESHOLD", "0.05"))
+RERANK_USE_VECTORS = os.environ.get("RERANK_USE_VECTORS", "false").lower() == "true"
+
+def cosine_from_l2_score(scores: np.ndarray) -> np.ndarray:
+    """
+    Convert OpenSearch l2 scores of unit vectors to cosine similarities.
+
+    Args:
+        scores: Scores 1 / (1 + d^2)
+
+    Returns:
+        np.ndarray: The cosine similarities
+    """
+    squared_distances = 1.0 / np.maximum(scores, 1e-9) - 1.0
+    return 1.0 - squared_distances / 2.0
+
+class VectorSimilarityFilter(BaseDocumentCompressor):
+    """
+    Document compressor that sorts the documents by similarity to the query and drops those below
+    the threshold, from the stored vectors or the kNN scores.
+    """
+
+    embeddings: Any = None
+    similarity_threshold: Optional[float] = RERANK_SIMILARITY_THRESHOLD
+
+    def _similarities(self, documents: Sequence[Document], query: str) -> Optional[np.ndarray]:
+        if self.embeddings is not None and all("vector" in document.metadata for document in documents):
+            vectors = np.asarray([document.metadata["vector"] for document in documents], dtype=np.float32)
+            query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector)
+            return (vectors @ query_vector) / np.maximum(norms, 1e-9)
+        if all(document.metadata.get("score") is not None for document in documents):
+            return cosine_from_l2_score(np.asarray([document.metadata["score"] for document in documents], dtype=np.float32))
+        return None
+
+    def compress_documents(
+            self,
+            documents: Sequence[Document],
+            query: str,
+            callbacks: Optional[Callbacks] = None
+            ) -> Sequence[Document]:
+        if not documents:
+            return documents
+        similarities = self._similarities(documents, query)
+        if similarities is None:
+            logger.warning("Retrieved documents carry neither vectors nor scores, re-ranking skipped")
+            return documents
+        order = np.argsort(-similarities, kind="stable")
+        ranked = []
+        for i in order:
+            if self.similarity_threshold is not None and similarities[i] < self.similarity_threshold:
+                continue
+            document = documents[i]
+            metadata = {key: value for key, value in document.metadata.items() if key != "vector"}
+            metadata["similarity"] = float(similarities[i])
+            ranked.append(Document(page_content=document.page_content, metadata=metadata))
+        logger.debug(f"Re-ranked {len(documents)} documents, {len(ranked)} above {self.similarity_threshold}")
+        return ranked
@@ -0,0 +1,46 @@
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+from llm_utils.answer_cache import AnswerCache
+
+SCOPE = ("en", "chat", "generation", "prompts")
+
+class EntityBlindEmbeddings(Embeddings):
+    """
+    Embeds every question to the same vector, like a real model does for questions that only differ in
+    a program or course name.
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self.calls += 1
+        return [1.0, 0.0, 0.0]
+
+def test_questions_differing_in_an_entity_name_do_not_share_an_answer():
+    embeddings = EntityBlindEmbeddings()
+    cache = AnswerCache(embeddings=embeddings)
+    cache.store(SCOPE, "What snippets cover inflation in the Economics program?", "Economics answer")
+
+    assert cache.lookup(SCOPE, "What snippets cover inflation in the History program?") is None
+    assert cache.stats()["similar_hits"] == 0
+    # Exact matches never embed the question
+    assert embeddings.calls == 0
+
+def test_the_same_question_matches_after_normalization():
+    cache = AnswerCache(embeddings=EntityBlindEmbeddings())
+    cache.store(SCOPE, "What snippets cover inflation in the Economics program?", "Economics answer")
+
+    assert cache.lookup(SCOPE, "  what snippets cover inflation in the ECONOMICS program?") == "Economics answer"
+    assert cache.lookup(("fr",) + SCOPE[1:], "What snippets cover inflation in the Economics program?") is None
+
+def test_near_duplicate_matching_is_opt_in():
+    cache = AnswerCache(embeddings=EntityBlindEmbeddings(), similarity_threshold=0.97)
+    cache.store(SCOPE, "What snippets cover inflation in the Economics program?", "Economics answer")
+
+    assert cache.lookup(SCOPE, "What snippets cover inflation in the History program?") == "Economics answer"